@@ -0,0 +1,104 @@
+"""
+A module for augmenting the training features with random phase shifts.
+
+The shifted copies are produced by a single fancy-index gather on the
+stacked [nsamples x nfeatures] matrix, instead of np.roll-ing one
+candidate at a time.
+
+"""
+import numpy as np
+
+
+def shift_augment(data, shifts, shape=None):
+    """
+    roll every sample along the phase (last) axis, once for every shift
+
+    Args:
+    data : [nsamples x nfeatures] feature matrix
+    shifts : [nsamples] or [nsamples x ncopies] integer phase shifts
+    shape : (nrows, ncols) shape of a single sample (eg. (32,32) for 'intervals:32'),
+            default None = 1D feature, shape (1, nfeatures)
+
+    returns:
+    [(nsamples*ncopies) x nfeatures], copy k of sample i is row i*ncopies + k
+    (so the targets are expanded with np.repeat(target, ncopies))
+
+    Notes:
+    row j of the result equals np.roll(sample.reshape(shape), shift, axis=-1).ravel()
+
+    """
+    data = np.asarray(data)
+    nsamples = data.shape[0]
+    shifts = np.asarray(shifts, dtype=np.intp)
+    if shifts.ndim == 1:
+        shifts = shifts[:, np.newaxis]
+    ncopies = shifts.shape[1]
+    if shape is None:
+        shape = (1, data.shape[1])
+    nrows, ncols = shape
+
+    imgs = data.reshape(nsamples, nrows, ncols)
+    # np.roll(x, s)[j] = x[(j - s) % ncols]
+    cols = (np.arange(ncols)[np.newaxis, np.newaxis, :] - shifts[:, :, np.newaxis]) % ncols
+    out = imgs[np.arange(nsamples)[:, np.newaxis, np.newaxis, np.newaxis],
+               np.arange(nrows)[np.newaxis, np.newaxis, :, np.newaxis],
+               cols[:, :, np.newaxis, :]] #nsamples x ncopies x nrows x ncols
+    return out.reshape(nsamples*ncopies, nrows*ncols)
+
+
+class shiftbatches(object):
+    """
+    Lazily generate randomly shifted minibatches of the training data,
+    instead of materializing ncopies shifted copies of the whole set.
+
+    Every pass (epoch) over the minibatches visits each sample ncopies times,
+    each time with a new random shift.
+
+    Usage:
+    sb = shiftbatches(X, y, shape=(48,48), ncopies=3)
+    for Xb, yb in sb.minibatches(200):
+        ...
+
+    """
+    def __init__(self, data, target, shape=None, ncopies=3, maxshift=None, rng=None):
+        """
+        Args:
+        data : [nsamples x nfeatures] feature matrix
+        target : [nsamples] labels
+        shape : (nrows, ncols) of a single sample, default None = 1D feature
+        ncopies : number of shifted copies of each sample per epoch
+        maxshift : shifts are drawn from [0, maxshift), default = ncols - 1
+        rng : np.random.RandomState, default np.random
+
+        """
+        self.data = np.asarray(data)
+        self.target = np.asarray(target)
+        if shape is None:
+            shape = (1, self.data.shape[1])
+        self.shape = tuple(shape)
+        self.ncopies = ncopies
+        if maxshift is None:
+            maxshift = self.shape[1] - 1
+        self.maxshift = max(1, maxshift)
+        if rng is None:
+            rng = np.random
+        self.rng = rng
+
+    def __len__(self):
+        return self.data.shape[0] * self.ncopies
+
+    def minibatches(self, batch_size, shuffle=True):
+        """
+        yield (Xbatch, ybatch) minibatches covering one epoch,
+        the last batch holds the remainder (len(self) % batch_size) if non-zero
+
+        """
+        nsamples = self.data.shape[0]
+        if shuffle:
+            order = self.rng.permutation(len(self)) % nsamples
+        else:
+            order = np.repeat(np.arange(nsamples), self.ncopies)
+        for bi in range(0, order.size, batch_size):
+            rows = order[bi:bi+batch_size]
+            shifts = self.rng.randint(0, self.maxshift, rows.size)
+            yield shift_augment(self.data[rows], shifts, self.shape), self.target[rows]
@@ -0,0 +1,93 @@
+"""
+A module for checkpointing long training runs
+(pulsar_nnetwork.NeuralNetwork.fit, sktheano_cnn.MetaCNN.fit),
+so an interrupted (eg. preempted) run resumes where it stopped.
+
+The checkpoint is a pickled dictionary of the training state
+(weights, optimizer state, epoch/iteration, random state,
+ including the own random generator of a minibatch loader, see random_state),
+written atomically (to a temporary file, then renamed) at most every 'interval' seconds,
+and removed once the training completes.
+Training with the same checkpoint filename again resumes from it.
+
+Usage:
+nn = pnn.NeuralNetwork(design=[25], fit_type='adam', checkpoint='nn6.ckpt')
+cnn = MetaCNN(n_epochs=65, checkpoint='nn2.ckpt', checkpoint_interval=600)
+
+"""
+import cPickle
+import os
+import time
+import numpy as np
+
+
+class checkpointer(object):
+    """
+    save/load the training state to/from a checkpoint file
+
+    """
+    def __init__(self, fname, interval=300.):
+        """
+        Args:
+        fname : the checkpoint file
+        interval : minimum number of seconds between checkpoints (see self.due)
+
+        """
+        self.fname = fname
+        self.interval = interval
+        self.last = time.time()
+
+    def due(self):
+        """ True if the last checkpoint is older than self.interval """
+        return time.time() - self.last >= self.interval
+
+    def load(self, **expected):
+        """
+        return the saved state, or None if there is no checkpoint
+        (or it is for another model, ie. doesn't have the expected values,
+         eg. load(fit_type='adam', nparams=1234))
+
+        """
+        if not os.access(self.fname, os.R_OK):
+            return None
+        with open(self.fname, 'rb') as f:
+            state = cPickle.load(f)
+        for k, v in expected.iteritems():
+            if state.get(k) != v:
+                print "ignoring checkpoint %s (%s = %s, expected %s)" % (self.fname, k, state.get(k), v)
+                return None
+        print "resuming from checkpoint %s" % self.fname
+        return state
+
+    def save(self, state):
+        """ write the state dictionary """
+        tmpname = '%s.%s.tmp' % (self.fname, os.getpid())
+        with open(tmpname, 'wb') as f:
+            cPickle.dump(state, f, protocol=cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, self.fname)
+        self.last = time.time()
+
+    def remove(self):
+        """ delete the checkpoint (the training completed) """
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+def random_state(loader=None):
+    """
+    the global numpy random state, and that of the loader's own
+    random generator (loader.rng, eg. featurestore.streamloader) if it has one
+
+    """
+    state = {'global':np.random.get_state(), 'loader':None}
+    rng = getattr(loader, 'rng', None)
+    if rng is not None and rng is not np.random:
+        state['loader'] = rng.get_state()
+    return state
+
+def set_random_state(state, loader=None):
+    """ restore the random state from random_state(loader) """
+    np.random.set_state(state['global'])
+    rng = getattr(loader, 'rng', None)
+    if state['loader'] is not None and rng is not None and rng is not np.random:
+        rng.set_state(state['loader'])
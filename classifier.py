@@ -1,3 +1,4 @@
+import ast
 import numpy.random as random
 import numpy as np
 from sklearn.decomposition import RandomizedPCA as PCA
@@ -7,6 +8,7 @@ from sklearn.ensemble import GradientBoostingClassifier as GBC
 from ubc_AI.training import split_data
 from ubc_AI import pulsar_nnetwork as pnn 
 from ubc_AI import sktheano_cnn as skcnn
+from ubc_AI.augment import shift_augment
 
 #multiprocess only works in non-interactive mode:
 from ubc_AI.threadit import threadit
@@ -366,6 +368,219 @@ class combinedAI(object):
             return F1score
 
 
+class cascadeAI(combinedAI):
+    """
+    A sparse/early-exit version of combinedAI.
+
+    The stages are evaluated in order (cheapest first). After each stage
+    only the candidates whose stage-score (predict_proba[:,1]) is at or above
+    that stage's threshold are passed on to the next stage, the rest
+    keep the probabilities of the stage which rejected them.
+    Since features are extracted lazily by pfd.getdata, the expensive
+    features (DM curves, interval/subband images) of the later stages are
+    never computed for the rejected candidates.
+
+    Usage:
+    cheap = LRclf(C=0.07, penalty='l2', feature={'phasebins':64})
+    full = combinedAI(AIs, strategy='lr', C=0.1, penalty='l2')
+    clf = cascadeAI([cheap, full])
+    clf.fit(pfds, target)
+    clf.tune_thresholds(xval_pfds, xval_target, max_recall_loss=0.01)
+
+    """
+    def __init__(self, stages, thresholds=None, score_mapper=equaleval):
+        """
+        inputs
+        stages: list of classifiers (member classifiers or combinedAIs),
+                ordered from cheapest to most expensive. The last stage
+                decides the final score for the candidates which reach it.
+        thresholds: list of len(stages)-1 stage-score thresholds.
+                Default None = 0. (every candidate reaches the last stage,
+                ie. the same result as running the last stage alone),
+                use tune_thresholds to determine them.
+        *score_map: see combinedAI
+
+        """
+        self.list_of_AIs = stages
+        self.strategy = 'cascade'
+        self.AIonAIs = []
+        self.req_predict = []
+        if thresholds is None:
+            thresholds = [0.] * (len(stages) - 1)
+        if len(thresholds) != len(stages) - 1:
+            note = "need %s thresholds for %s stages" % (len(stages)-1, len(stages))
+            raise MyError(note)
+        self.thresholds = list(thresholds)
+        self.nclasses = None
+        self.score_mapper = score_mapper
+        self.stage_counts = None
+
+    def fit(self, pfds, target, **kwds):
+        """
+        args: [list of pfd instances], target
+
+        Notes:
+        every stage is trained on the full training set,
+        the thresholds are not changed (see tune_thresholds)
+
+        """
+        for stage in self.list_of_AIs:
+            stage.fit(pfds, target, **kwds)
+        self.nclasses = len(np.unique(target))
+
+    def stage_scores(self, pfds):
+        """
+        evaluate every stage on every pfd (no early exit)
+
+        returns:
+        list of len(stages) arrays [nsamples x nclasses]
+
+        """
+        if not type(pfds) in [list, np.ndarray]:
+            pfds = [pfds]
+        return [stage.predict_proba(pfds) for stage in self.list_of_AIs]
+
+    def predict_proba(self, pfds):
+        """
+        Returns array of [n_samples x nclasses], the probability of being in each class,
+        taken from the stage at which each candidate exited the cascade.
+
+        Notes:
+        self.stage_counts keeps the number of candidates evaluated by each stage
+
+        """
+        if not type(pfds) in [list, np.ndarray]:
+            pfds = [pfds]
+        pfds = np.array(pfds)
+        nsamples = len(pfds)
+
+        active = np.arange(nsamples)
+        result = None
+        self.stage_counts = []
+        for si, stage in enumerate(self.list_of_AIs):
+            self.stage_counts.append(active.size)
+            if active.size == 0:
+                break
+            proba = np.asarray(stage.predict_proba(list(pfds[active])))
+            if result is None:
+                result = np.zeros((nsamples, proba.shape[1]), dtype=proba.dtype)
+            result[active] = proba
+            if si < len(self.thresholds):
+                active = active[proba[:, 1] >= self.thresholds[si]]
+        self.stage_counts.extend([0] * (len(self.list_of_AIs) - len(self.stage_counts)))
+        return result
+
+    def predict(self, pfds, pred_mat=False):
+        """
+        args:
+          pfds : list of pfddata objects
+
+        returns:
+        array of [nsamples], giving label of most-likely class
+
+        """
+        self.predictions = self.predict_proba(pfds).argmax(axis=1)
+        return self.predictions
+
+    def tune_thresholds(self, pfds, target, max_recall_loss=0.01, verbose=False):
+        """
+        determine the stage thresholds on a labelled set of pfds,
+        rejecting as many candidates as possible at each stage while
+        keeping the fraction of pulsars lost by the cascade (with respect
+        to sending everything to the final stage) below max_recall_loss.
+
+        Args:
+        pfds : list of labelled pfds (preferably not the training set)
+        target : the pfd labels (pulsars are class 1)
+        max_recall_loss : the allowed fraction of pulsars rejected before the last stage,
+                          split evenly between the early stages.
+        verbose : print the per-stage thresholds, recall loss and pass fraction
+
+        returns:
+        the thresholds (also stored in self.thresholds)
+
+        Notes:
+        only the candidates which pass a stage are evaluated by the next one,
+        so tuning costs about as much as scoring the set once with the cascade.
+
+        """
+        if target.ndim == 1:
+            psrtarget = target
+        else:
+            psrtarget = target[...,0]
+        pfds = np.array(pfds)
+        npsr = float(max(1, (psrtarget == 1).sum()))
+        nearly = len(self.list_of_AIs) - 1
+        budget = max_recall_loss / max(1, nearly)
+
+        active = np.arange(len(pfds))
+        thresholds = []
+        for si in range(nearly):
+            if active.size == 0:
+                thresholds.append(0.)
+                continue
+            score = np.asarray(self.list_of_AIs[si].predict_proba(list(pfds[active])))[:, 1]
+            psrscore = np.sort(score[psrtarget[active] == 1])
+            # number of pulsars we may lose at this stage
+            nlose = int(np.floor(budget * npsr))
+            if psrscore.size == 0:
+                thr = 0.
+            else:
+                #at most nlose pulsars score strictly below this
+                thr = psrscore[min(nlose, psrscore.size - 1)]
+            thresholds.append(thr)
+            passed = score >= thr
+            if verbose:
+                lost = ((psrtarget[active] == 1) & ~passed).sum()
+                print "stage %s: threshold %.4f, recall loss %.4f, passed %s/%s" %\
+                    (si, thr, lost/npsr, passed.sum(), active.size)
+            active = active[passed]
+
+        self.thresholds = thresholds
+        return thresholds
+
+    def tune_pass_fraction(self, pfds, pass_frac=0.1, verbose=False):
+        """
+        determine the stage thresholds so that each early stage passes
+        (about) pass_frac of the candidates it scores, 
+        eg. a distilled student scoring everything in front of the full ensemble
+        which only scores the student's top pass_frac (see classifier.distill).
+        No labels needed.
+
+        Args:
+        pfds : list of pfds, representative of the candidates to score
+        pass_frac : fraction of the candidates passed on by every early stage,
+                    or a list of one fraction per early stage
+        verbose : print the per-stage thresholds and pass fraction
+
+        returns:
+        the thresholds (also stored in self.thresholds)
+
+        """
+        pfds = np.array(pfds)
+        nearly = len(self.list_of_AIs) - 1
+        if not isinstance(pass_frac, (list, tuple)):
+            pass_frac = [pass_frac] * nearly
+        active = np.arange(len(pfds))
+        thresholds = []
+        for si in range(nearly):
+            if active.size == 0:
+                thresholds.append(0.)
+                continue
+            score = np.asarray(self.list_of_AIs[si].predict_proba(list(pfds[active])))[:, 1]
+            #the score of the last candidate passed
+            npass = max(1, int(np.ceil(pass_frac[si] * active.size)))
+            thr = np.sort(score)[::-1][min(npass, score.size) - 1]
+            thresholds.append(thr)
+            passed = score >= thr
+            if verbose:
+                print "stage %s: threshold %.4f, passed %s/%s" %\
+                    (si, thr, passed.sum(), active.size)
+            active = active[passed]
+
+        self.thresholds = thresholds
+        return thresholds
+
 
 class classifier(object):
     """
@@ -378,6 +593,7 @@ class classifier(object):
     clf1 = svmclf(gamma=0.1, C=0.8, scale_C=False, feature={'phasebins':32})
 
     the feature has to be a diction like {'phasebins':32}, where 'phasebins' being the name of the feature, 32 is the size.
+    Image features ('intervals', 'subbands') may also be sized (rows, cols), eg. {'intervals':(32,64)}
     """
     targetmap={'phasebins':1, 'DMbins':2, 'intervals':3, 'subbands':4, }
     def __init__(self, feature=None, use_pca=False, n_comp=12, **kwds):
@@ -388,6 +604,15 @@ class classifier(object):
         self.n_components = n_comp
         super(classifier, self).__init__( **kwds)
 
+    def getfeatures(self, pfds):
+        """
+        args: pfds
+        pfds: list of pfddata objects
+
+        Returns: array [Nsamples x Nfeatures] of self.feature
+        """
+        return np.array([pfd.getdata(**self.feature) for pfd in pfds])
+
     def fit(self, pfds, target, randomshift=False):
         """
         args: pfds, target
@@ -395,29 +620,38 @@ class classifier(object):
         target: the training targets
         randomshift: add a random shift to the phase, otherwise use the phase .5 aligned feature
         """
-        MaxN = max([self.feature[k] for k in self.feature])
-        feature = [k for k in self.feature if self.feature[k] == MaxN][0]
+        return self.fit_features(self.getfeatures(pfds), target, randomshift=randomshift)
+
+    def fit_features(self, data, target, randomshift=False):
+        """
+        same as fit, but on the already-extracted feature matrix
+        (eg. shared by several classifiers using the same feature)
+
+        args: data, target
+        data: [Nsamples x Nfeatures] array from self.getfeatures
+        target: the training targets
+        randomshift: add a random shift to the phase, otherwise use the phase .5 aligned feature
+        """
+        MaxN = max([np.prod(self.feature[k]) for k in self.feature])
+        feature = [k for k in self.feature if np.prod(self.feature[k]) == MaxN][0]
+        #(rows, cols) of an image feature, the columns being the phase
+        nrows, ncols = feature_shape(self.feature[feature])
         #print '%s %s MaxN:%s'%(self.orig_class, self.feature, MaxN)
-        #shift = random.randint(0, MaxN-1)
-        shift = random.randint(0, MaxN-1, len(pfds))
-        if not randomshift:
-            shift *= 0
         Nspam = 3
 
-        if feature in ['phasebins', 'timebins', 'freqbins']:
-            #print '%s %s 1D shift:%s'%(self.orig_class, self.feature, shift)
-            data = np.array([np.roll(pfd.getdata(**self.feature), shift[i])  for i, pfd in enumerate(pfds)])
-        elif feature in ['intervals', 'subbands']:
-            #print '%s %s 2D shift:%s'%(self.orig_class, self.feature, shift)
-            if not randomshift:
-                data = np.array([np.roll(pfd.getdata(**self.feature).reshape(MaxN, MaxN), shift[i], axis=1).ravel() for i, pfd in enumerate(pfds)])
-            else:
-                data = np.vstack([np.array([np.roll(pfd.getdata(**self.feature).reshape(MaxN, MaxN), shift, axis=1).ravel() for shift in random.randint(0, MaxN-1, Nspam)]) for i, pfd in enumerate(pfds)])
-            #print data.shape
-        else:
-            data = np.array([pfd.getdata(**self.feature) for pfd in pfds])
+        nsamples = data.shape[0]
+        if randomshift:
+            if feature in ['phasebins', 'timebins', 'freqbins']:
+                data = shift_augment(data, random.randint(0, MaxN-1, nsamples))
+            elif feature in ['intervals', 'subbands']:
+                #Nspam shifted copies of each image
+                data = shift_augment(data, random.randint(0, ncols-1, (nsamples, Nspam)),
+                                     shape=(nrows, ncols))
+        if isinstance(self, skcnn.MetaCNN) and feature in ['intervals', 'subbands']:
+            self.image_shape = (nrows, ncols)
         current_class = self.__class__
         self.__class__ = self.orig_class
+        results = None
         try:
             if target.ndim == 1:
                 mytarget = target
@@ -429,10 +663,10 @@ class classifier(object):
                 data = self.pca.transform(data)
 
             if feature in ['intervals', 'subbands'] and randomshift:
-                exptargets = np.array([ [t]*Nspam for t in mytarget]).ravel()
-                mytarget = exptargets
+                mytarget = np.repeat(mytarget, Nspam)
             results = self.fit( data, mytarget)
         except KeyboardInterrupt as detail:
+            #stop training early (a checkpointed fit can be resumed later)
             import sys
             print sys.exc_info()[0], detail
         finally:
@@ -441,6 +675,73 @@ class classifier(object):
         return results
         #return self.orig_class.fit(self, data, target)
 
+    def fit_stream(self, loader, **kwds):
+        """
+        same as fit, but streaming minibatches of the feature from disk
+        (for the minibatch trainers: pnnclf with fit_type='sgd'/'adam', and cnnclf)
+
+        args: loader
+        loader: ubc_AI.featurestore.streamloader of self.feature 
+                (see featurestore.create_store)
+        kwds: passed on to the fit of the original class
+        """
+        if self.use_pca:
+            raise MyError('use_pca is not supported when streaming the features')
+        imgs = [k for k in self.feature if k in ['intervals', 'subbands']]
+        if isinstance(self, skcnn.MetaCNN) and len(imgs) > 0:
+            self.image_shape = feature_shape(self.feature[imgs[0]])
+        current_class = self.__class__
+        self.__class__ = self.orig_class
+        try:
+            results = self.fit(loader, None, **kwds)
+        finally:
+            self.__class__ = current_class
+        return results
+
+    def distill(self, teacher, pfds, soft=None, report=True, **kwds):
+        """
+        knowledge distillation: train this (small, fast) classifier, the student,
+        to reproduce the scores of the teacher (eg. the full combinedAI) on a 
+        large (unlabelled) pool of candidates.
+        The student can then score everything, and the teacher only the candidates 
+        the student ranks highest (see cascadeAI.tune_pass_fraction and agreement_report)
+
+        args: teacher, pfds
+        teacher: the trained teacher (eg. combinedAI)
+        pfds: the candidate pool (no labels needed)
+        soft: train on the soft targets [1-score, score] (only pnnclf supports them),
+              otherwise on the labels score >= 0.5.
+              default None = soft for pnnclf students
+        report: learn the teacher's report_score (the survey score, with the period prior)
+                if it has one, otherwise (or if False) its predict_proba[:,1].
+                Use report=False for a cascadeAI first stage, whose report_score
+                applies the prior to the scores of all stages.
+        kwds: passed on to the fit of the original class
+
+        returns: the teacher's scores of the pfds
+        """
+        if not type(pfds) in [list, np.ndarray]:
+            pfds = [pfds]
+        score = np.clip(teacher_score(teacher, pfds, report), 0., 1.)
+        if soft is None:
+            soft = isinstance(self, pnn.NeuralNetwork)
+        if soft:
+            target = np.column_stack([1. - score, score])
+        else:
+            target = np.where(score >= 0.5, 1, 0)
+        data = self.getfeatures(pfds)
+
+        current_class = self.__class__
+        self.__class__ = self.orig_class
+        try:
+            if self.use_pca:
+                self.pca = PCA(n_components=self.n_components).fit(data[score >= 0.5])
+                data = self.pca.transform(data)
+            self.fit(data, target, **kwds)
+        finally:
+            self.__class__ = current_class
+        return score
+
     def predict(self, pfds):
         """
         args: 
@@ -450,7 +751,15 @@ class classifier(object):
         """
         if not type(pfds) in [list, np.ndarray]:
             pfds = [pfds]
-        data = np.array([pfd.getdata(**self.feature) for pfd in pfds])
+        return self.predict_features(self.getfeatures(pfds))
+
+    def predict_features(self, data):
+        """
+        args: 
+        data: [Nsamples x Nfeatures] array from self.getfeatures
+
+        Returns: array(Nsamples), giving the most-likely class
+        """
         #self.test_data = data
         current_class = self.__class__
         self.__class__ = self.orig_class
@@ -488,8 +797,17 @@ class classifier(object):
         """ 
         if not type(pfds) in [list, np.ndarray]:
             pfds = [pfds]
+        return self.predict_proba_features(self.getfeatures(pfds))
+
+    def predict_proba_features(self, data):
+        """
+        same as predict_proba, but on the already-extracted feature matrix
+
+        args: 
+        data: [Nsamples x Nfeatures] array from self.getfeatures
 
-        data = np.array([pfd.getdata(**self.feature) for pfd in pfds])
+        Returns: array [n_samples, n_classes]
+        """
         current_class = self.__class__
         self.__class__ = self.orig_class
         if self.use_pca:
@@ -516,7 +834,7 @@ class classifier(object):
             #self.last_feature = str(self.feature)
         if not target.ndim == 1:
             target = target[...,0]#feature labeling
-        data = np.array([pfd.getdata(**self.feature) for pfd in pfds])
+        data = self.getfeatures(pfds)
         current_class = self.__class__
         self.__class__ = self.orig_class
         if self.use_pca:
@@ -580,6 +898,123 @@ class cnnclf(classifier, skcnn.MetaCNN):
     orig_class = skcnn.MetaCNN
     pass
 
+class mcnnclf(classifier, skcnn.MetaCNN):
+    """
+    the mixed in class for a multi-channel convolutional neural network,
+    learning several features of the same size jointly, one input channel each.
+    (one conv stack per candidate, instead of one cnnclf per feature)
+
+    Usage:
+    clf = mcnnclf(feature={'intervals':48, 'subbands':48, 'phasebins':48}, n_epochs=65)
+
+    Notes:
+    * the channels are stacked in the fixed order of mcnnclf.channel_order,
+      so the same feature dict always gives the same network input
+    * the image features ('intervals', 'subbands') must all be the same size (N or (rows, cols)),
+      1D features are tiled to an image of that size:
+      'phasebins' as identical rows (so a phase shift rolls it along with the images),
+      the others (eg. 'DMbins') as identical columns
+    * n_channels is set from the feature (in fit_features)
+
+    """
+    orig_class = skcnn.MetaCNN
+    channel_order = ['intervals', 'subbands', 'phasebins', 'DMbins', 'timebins', 'freqbins']
+
+    def channels(self):
+        """
+        return the feature names in channel order
+        """
+        known = [k for k in self.channel_order if k in self.feature]
+        return known + sorted([k for k in self.feature if k not in self.channel_order])
+
+    def getfeatures(self, pfds):
+        """
+        args: pfds
+        pfds: list of pfddata objects
+
+        Returns: array [Nsamples x (n_channels*nrows*ncols)] of the stacked channels,
+        (nrows, ncols) being the size of the image features
+        """
+        nrows, ncols = self.channel_shape()
+        data = []
+        for k in self.channels():
+            d = np.array([pfd.getdata(**{k:self.feature[k]}) for pfd in pfds])
+            if k not in ['intervals', 'subbands']:
+                #profile along the phase (cols), the others along the rows
+                n = ncols if k == 'phasebins' else nrows
+                if d.shape[1] != n:
+                    raise MyError('feature %s:%s can not be tiled to %sx%s images' % (k, self.feature[k], nrows, ncols))
+                if k == 'phasebins':
+                    d = np.tile(d[:, np.newaxis, :], (1, nrows, 1))
+                else:
+                    d = np.tile(d[:, :, np.newaxis], (1, 1, ncols))
+            data.append(d.reshape(len(pfds), nrows*ncols))
+        return np.hstack(data)
+
+    def channel_shape(self):
+        """
+        return the (rows, cols) of the channels, 
+        the size of the image features (which must all be the same)
+        """
+        imgs = [feature_shape(self.feature[k]) for k in self.feature if k in ['intervals', 'subbands']]
+        if len(set(imgs)) > 1:
+            raise MyError('image features must be the same size, got %s' % self.feature)
+        if len(imgs) > 0:
+            return imgs[0]
+        return feature_shape(max(self.feature.values()))
+
+    def fit_features(self, data, target, randomshift=False):
+        """
+        same as fit, but on the already-extracted feature matrix
+
+        args: data, target
+        data: [Nsamples x (n_channels*nrows*ncols)] array from self.getfeatures
+        target: the training targets
+        randomshift: add Nspam randomly phase-shifted copies of each sample
+                     (every channel shifted alike)
+        """
+        if self.use_pca:
+            raise MyError('use_pca is not supported by the multi-channel CNN')
+        nchan = len(self.feature)
+        nrows, ncols = self.channel_shape()
+        Nspam = 3
+
+        if target.ndim == 1:
+            mytarget = target
+        else:
+            mytarget = target[...,classifier.targetmap[self.channels()[0]]]
+        if randomshift:
+            nsamples = data.shape[0]
+            #the channels are stacked along the rows, the columns are the phase
+            data = shift_augment(data, random.randint(0, ncols-1, (nsamples, Nspam)),
+                                 shape=(nchan*nrows, ncols))
+            mytarget = np.repeat(mytarget, Nspam)
+
+        current_class = self.__class__
+        self.__class__ = self.orig_class
+        results = None
+        try:
+            self.n_channels = nchan
+            self.image_shape = (nrows, ncols)
+            results = self.fit(data, mytarget)
+        except KeyboardInterrupt as detail:
+            #stop training early (a checkpointed fit can be resumed later)
+            import sys
+            print sys.exc_info()[0], detail
+        finally:
+            self.__class__ = current_class
+
+        return results
+
+    def fit_stream(self, loader, **kwds):
+        """
+        same as classifier.fit_stream, for a store of the stacked channels
+        (eg. from dataloader.feature_store(clf, fname))
+        """
+        self.n_channels = len(self.feature)
+        self.image_shape = self.channel_shape()
+        return super(mcnnclf, self).fit_stream(loader, **kwds)
+
 class adaboost(object):
     """
     a class to help with ensembles. 
@@ -649,39 +1084,39 @@ class adaboost(object):
         else:
             npreds = train_preds.shape[1]
         
-        #'True' for wrong prediction, 'False' for correct prediction
-        Wrong_pred = np.transpose([v != train_target for v in train_preds.transpose()]) 
-
         #remap predictions/targets from 0 to -1 if necessary
         y = np.where(train_target != 1, -1, 1)
         preds2 = np.where(train_preds != 1, -1,1)
 
         #indicator function  or scouting matrix(1 for wrong, 0 for right prediction)
-        I = np.where(Wrong_pred, 1., 0.)
+        I = (train_preds != train_target[:, np.newaxis]).astype(np.float)
+        #y*h_i(x): +1 for right, -1 for wrong prediction [nsamples x npreds]
+        margin = y[:, np.newaxis] * preds2
 
         clfs = {}
         alphas = {}
         #Weight of each data point
         D = np.ones(len(y), dtype=np.float)/len(y)
-        allclfs = set(range(npreds))
+        used = np.zeros(npreds, dtype=bool)
         for t in range(npreds):
             # find best remaining classifier
-            idcs = list(allclfs - set(clfs.values()))
             W_e = np.dot(D,I) 
-            best = np.argmax(np.abs(0.5-W_e[idcs])) #same as np.argmin(W_e[idcs])
-            h_t = np.where(W_e == W_e[idcs][best])[0][0]
+            gap = np.abs(0.5 - W_e) #same as np.argmin(W_e)
+            gap[used] = -1.
+            h_t = gap.argmax()
 
             e_t = W_e[h_t] 
-#            print h_t, e_t, W_e
             if np.abs(0.5 - e_t) <= .10: break # we've done enough, error<10%ish
                                                 # lowering threshold brings in more error
 
             clfs[t] = h_t
+            used[h_t] = True
             alpha_t = np.log((1.-e_t)/e_t)/2.
             alphas[t] = alpha_t
             
-            Z_t = D*np.exp(-alpha_t*y*preds2[:,h_t]).sum()
-            D = D*np.exp(-alpha_t*y*preds2[:,h_t])/Z_t
+            #re-weight the data points, normalized to sum(D) = 1
+            D = np.exp(-alpha_t*margin[:,h_t])
+            D /= D.sum()
 
         #append the classifier weights (in order of list_of_AIs)
         if len(clfs) <= 2:
@@ -694,6 +1129,8 @@ class adaboost(object):
         self.weights = w
         self.clfs = clfs
         self.alphas = alphas
+        #precompute the weights applied in predict_proba
+        self.class_weights = self._class_weights(max(2, len(np.unique(targets))))
 
         #finally, fit the platt calibration for predict_proba functionality
         if self.platt != None:
@@ -711,7 +1148,8 @@ class adaboost(object):
         we only return labels (0, 1)
         """
         #GBC assumes labels are -1, +1, so re-map
-        if 0 in np.unique(list_of_predictions):
+        list_of_predictions = np.asarray(list_of_predictions)
+        if (list_of_predictions == 0).any():
             tmp = np.where(list_of_predictions != 1, -1, 1)
         else:
             tmp = list_of_predictions
@@ -758,26 +1196,127 @@ class adaboost(object):
             return  self.platt.predict_proba(f)
         else:
             #self.weight is for 1 class, lops may have several
-            npreds = len(self.weights)
-            if lops.ndim == 2:
-                nclass = lops.shape[1] // npreds
-                nsamples = lops.shape[0]
-            else:
-                nclass = lops.shape[0] // npreds
-                nsamples = 1
+            w = getattr(self, 'class_weights', None)
+            if w is None or w.shape[1] != nclass:
+                w = self.class_weights = self._class_weights(nclass)
 
             # H(x) works on sign(sum_i w[i]h_i(x))
-            # so shift all predictions (0 < lops < 1) to (-1 < lops < 1)
-            lops = 2.*lops - 1.
-
-            #so repeat the weights nclass times
-            #weights are only for 'class 1', so use uniform weight on non-'1' classes
-            w = np.ones((npreds,nclass), dtype=np.float)/float(npreds)
-            w[:,1] = self.weights
-            f = np.transpose([np.dot( lops[:,c::nclass], v)\
-                                  for c, v in enumerate(w.transpose())])
+            # so shift all predictions (0 < lops < 1) to (-1 < lops < 1),
+            # ie. sum_i w[i](2h_i(x) - 1) = 2 sum_i w[i]h_i(x) - sum_i w[i]
+            # lops is ordered [clf0:(class0, class1..), clf1:(class0, ...), ...]
+            f = np.einsum('spc,pc->sc', lops.reshape(nsamples, npreds, nclass), w)
+            f *= 2.
+            f -= w.sum(axis=0)
             #use sigmoid to get final predict_proba
-            return 1./(1.0 + np.exp(-f))
+            np.negative(f, f)
+            np.exp(f, f)
+            f += 1.
+            return np.reciprocal(f, f)
+
+    def _class_weights(self, nclass):
+        """
+        the weights applied to each class of the predict_proba's
+
+        returns:
+        array of [npredictions x nclass]
+
+        """
+        #weights are only for 'class 1', so use uniform weight on non-'1' classes
+        npreds = len(self.weights)
+        w = np.ones((npreds,nclass), dtype=np.float)/float(npreds)
+        w[:,1] = self.weights
+        return w
+
+def teacher_score(teacher, pfds, report=True):
+    """
+    the teacher's score of the pfds: its report_score if report and it has one,
+    otherwise predict_proba[:,1]
+    """
+    if report and hasattr(teacher, 'report_score'):
+        return np.asarray(teacher.report_score(pfds), dtype=float)
+    return np.asarray(teacher.predict_proba(pfds))[:, 1]
+
+def agreement_report(student, teacher, pfds, target=None, report=True,
+                     fractions=[0.01, 0.05, 0.1, 0.2], threshold=0.5, verbose=True):
+    """
+    compare a distilled student (see classifier.distill) with its teacher, 
+    for running the teacher only on the candidates the student ranks highest.
+
+    Args:
+    student : the trained student classifier
+    teacher : the teacher
+    pfds : candidates, preferably not the distillation pool
+    target : optional labels (pulsars are class 1), for the pulsar recall
+    report : compare with the teacher's report_score (as in classifier.distill)
+    fractions : fractions of the candidates (the student's top scores) passed to the teacher
+    threshold : teacher scores >= threshold are the teacher's positives
+    verbose : print the report
+
+    returns:
+    dictionary of
+      'corr', 'rank_corr' : linear and rank correlation of the student and teacher scores
+      'mean_dscore' : mean |student - teacher| score
+      'agreement' : fraction of candidates on the same side of threshold
+      'recall' : {fraction: fraction of the teacher's positives in the student's top fraction}
+      'psr_recall' : {fraction: fraction of the pulsars in the student's top fraction} (with target)
+      'time', 'teacher_time' : scoring time per candidate [s] 
+                               (features already extracted by the other are not timed again)
+
+    """
+    from time import time
+    if not type(pfds) in [list, np.ndarray]:
+        pfds = [pfds]
+    N = len(pfds)
+    t0 = time()
+    sscore = np.asarray(student.predict_proba(pfds))[:, 1]
+    t1 = time()
+    tscore = teacher_score(teacher, pfds, report)
+    t2 = time()
+
+    def rank(x):
+        r = np.empty(x.size)
+        r[np.argsort(x)] = np.arange(x.size)
+        return r
+
+    tpos = tscore >= threshold
+    order = np.argsort(sscore)[::-1]
+    results = {'corr': np.corrcoef(sscore, tscore)[0, 1],
+               'rank_corr': np.corrcoef(rank(sscore), rank(tscore))[0, 1],
+               'mean_dscore': np.abs(sscore - tscore).mean(),
+               'agreement': np.mean((sscore >= threshold) == tpos),
+               'recall': {}, 'psr_recall': {},
+               'time': (t1 - t0)/N, 'teacher_time': (t2 - t1)/N}
+    if target is not None:
+        target = np.asarray(target)
+        if target.ndim > 1:
+            target = target[..., 0]
+    for f in fractions:
+        top = np.zeros(N, dtype=bool)
+        top[order[:int(np.ceil(f*N))]] = True
+        results['recall'][f] = (top & tpos).sum()/float(max(1, tpos.sum()))
+        if target is not None:
+            psr = target == 1
+            results['psr_recall'][f] = (top & psr).sum()/float(max(1, psr.sum()))
+
+    if verbose:
+        print "%s candidates, %s teacher positives (score >= %s)" % (N, tpos.sum(), threshold)
+        print "score correlation %.4f (rank %.4f), mean |difference| %.4f, agreement %.4f" %\
+            (results['corr'], results['rank_corr'], results['mean_dscore'], results['agreement'])
+        print "time per candidate: student %.2e s, teacher %.2e s" % (results['time'], results['teacher_time'])
+        print "%10s %16s %16s" % ('top frac', 'teacher recall', 'pulsar recall')
+        for f in fractions:
+            psr = '%16.4f' % results['psr_recall'][f] if f in results['psr_recall'] else '%16s' % '-'
+            print "%10.3f %16.4f %s" % (f, results['recall'][f], psr)
+    return results
+
+def feature_shape(size):
+    """
+    return the (rows, cols) of an image feature size, 
+    either (rows, cols) or N for square N x N images
+    """
+    if isinstance(size, (tuple, list)):
+        return tuple(size)
+    return (size, size)
 
 def extractfeatures(AIlist, pfds):
     """
@@ -797,8 +1336,9 @@ def extractfeatures(AIlist, pfds):
 
     newf = set([ '%s:%s'% (f,v)  for f,v in items]) - set(pfds[0].extracted_feature.keys())
     for p in newf:
-        f,v = p.split(':')
-        vargf.append({f:int(v)})
+        #the size may be an int, or (rows, cols) for images
+        f,v = p.split(':', 1)
+        vargf.append({f:ast.literal_eval(v)})
     if len(vargf) > 0:
         def getfeature(pfd):
             pfd.getdata(*vargf, **features)
@@ -195,6 +195,351 @@ def cross_validation(classifier, pfds, target, cv=5, verbose=False):
     return scores
 
 
+def F1score(predict, target):
+    """
+    return the F1 score of the predictions, assuming pulsars are labelled 1
+    (0 if nothing is predicted to be, or is, a pulsar)
+    """
+    #precision P: the fraction of predicted pulsars that are pulsars,
+    #recall R: the fraction of pulsars predicted to be
+    P = np.mean(target[predict == 1]) if (predict == 1).any() else 0.
+    R = np.mean(predict[target == 1]) if (target == 1).any() else 0.
+    if P + R == 0:
+        return 0.
+    return 2 * P * R / (P + R)
+
+def featurekey(feature):
+    """the (hashable) key identifying a feature dictionary, eg. {'phasebins':32}"""
+    return repr(sorted(feature.items()))
+
+def trialkey(params):
+    """the (hashable) key identifying a classifier configuration"""
+    return repr(sorted([(k, featurekey(v) if isinstance(v, dict) else v)
+                        for k, v in params.items()]))
+
+def feature_matrix(pfds, feature):
+    """
+    extract (in parallel) the feature from all pfds,
+    returns the [nsamples x nfeatures] matrix.
+
+    The pfds in the list are replaced by their copies with the feature extracted,
+    so the extraction is not repeated.
+    """
+    from ubc_AI.threadit import threadit
+    keys = ['%s:%s' % f for f in feature.items()]
+    if len(pfds) and [k for k in keys if k not in pfds[0].extracted_feature]:
+        def getfeature(pfd):
+            pfd.getdata(**feature)
+            return pfd
+        resultdict = threadit(getfeature, [[p] for p in pfds])
+        for n, pfd in resultdict.iteritems():
+            pfds[n] = pfd
+    return np.array([pfd.getdata(**feature) for pfd in pfds])
+
+def split_indices(target, cv=3, pct=0.6):
+    """
+    return cv random (training, testing) index splits of the data,
+    each training set having samples from all classes
+    """
+    L = len(target)
+    cut = int(pct*L)
+    splits = []
+    for i in range(cv):
+        index = range(L)
+        while 1:
+            shuffle(index)
+            training_idx = np.array(index[:cut])
+            if len(np.unique(target[training_idx])) == len(np.unique(target)):
+                break
+        splits.append((training_idx, np.array(index[cut:])))
+    return splits
+
+def param_search(clfclass, pfds, target, param_grid, base_params=None,
+                 n_iter=None, cv=3, pct=0.6, checkpoint=None, seed=None, verbose=False):
+    """
+    grid or random search of the hyperparameters of a member classifier,
+    evaluating the configurations in parallel.
+
+    Args:
+    clfclass : a classifier mixin class, eg. classifier.svmclf, LRclf, pnnclf, cnnclf
+    pfds : list of pfds
+    target : their targets
+    param_grid : dictionary of {parameter: list of values}, 
+                 the 'feature' is searched here or fixed in base_params
+                 Eg. {'gamma':[0.01, 0.1], 'C':[1., 10.], 'feature':[{'phasebins':32}, {'phasebins':64}]}
+                 for random search the values can also be distributions with a .rvs() method (scipy.stats)
+    base_params : dictionary of fixed parameters, Eg. {'probability':True}
+    n_iter : None = search the full grid,
+             otherwise the number of randomly drawn configurations
+             (a configuration drawn more than once is evaluated once)
+    cv : number of random training/testing splits each configuration is scored on,
+         the same splits are used for all configurations
+    pct : fraction of the data used for training in each split
+    checkpoint : filename, the finished trials are pickled to this file,
+                 and are not repeated when the search is restarted with the same file
+    seed : seed for the random draws and splits
+    verbose : print each finished configuration
+
+    returns:
+    list of (params, mean F1, std F1), best first
+
+    Notes:
+    * the feature matrix of each feature is extracted once and shared (through the fork)
+      by all configurations using that feature
+    * parameter 'n_comp' is the number of PCA components (with use_pca=True)
+
+    """
+    from itertools import product
+    from ubc_AI.threadit import threadit, num_cpus
+    if base_params is None:
+        base_params = {}
+    if seed is not None:
+        np.random.seed(seed)
+        import random
+        random.seed(seed)
+
+    # the configurations to try
+    keys = sorted(param_grid.keys())
+    trials = []
+    if n_iter is None:
+        for vals in product(*[param_grid[k] for k in keys]):
+            trials.append(dict(zip(keys, vals)))
+    else:
+        for i in range(n_iter):
+            params = {}
+            for k in keys:
+                v = param_grid[k]
+                if hasattr(v, 'rvs'):
+                    params[k] = v.rvs()
+                else:
+                    params[k] = v[np.random.randint(len(v))]
+            trials.append(params)
+    for params in trials:
+        for k, v in base_params.iteritems():
+            params.setdefault(k, v)
+        if 'feature' not in params:
+            raise ValueError("param_search needs a 'feature' in param_grid or base_params")
+    # each configuration once (random draws can repeat)
+    unique = {}
+    for params in trials:
+        unique.setdefault(trialkey(params), params)
+    trials = [params for params in trials if unique[trialkey(params)] is params]
+
+    if target.ndim == 1:
+        psrtarget = target
+    else:
+        psrtarget = target[...,0]
+
+    # restore the finished trials
+    done = {}
+    if checkpoint is not None and os.access(checkpoint, os.R_OK):
+        done = cPickle.load(open(checkpoint, 'rb'))
+        splits = done.pop('__splits__')
+    else:
+        splits = split_indices(psrtarget, cv=cv, pct=pct)
+
+    # extract each feature once
+    features = {}
+    for params in trials:
+        features[featurekey(params['feature'])] = params['feature']
+    matrices = {}
+    for fkey, feature in features.iteritems():
+        matrices[fkey] = feature_matrix(pfds, feature)
+
+    def runtrial(params, si):
+        tr_idx, te_idx = splits[si]
+        data = matrices[featurekey(params['feature'])]
+        clf = clfclass(**params)
+        clf.fit_features(data[tr_idx], target[tr_idx])
+        return F1score(clf.predict_features(data[te_idx]), psrtarget[te_idx])
+
+    todo = [params for params in trials if trialkey(params) not in done]
+    chunk = max(1, num_cpus)
+    for ci in range(0, len(todo), chunk):
+        arglist = [[params, si] for params in todo[ci:ci+chunk] for si in range(len(splits))]
+        resultdict = threadit(runtrial, arglist)
+        for n, args in enumerate(arglist):
+            tkey = trialkey(args[0])
+            if tkey not in done:
+                done[tkey] = (args[0], [])
+            done[tkey][1].append(resultdict[n])
+        if checkpoint is not None:
+            state = dict(done)
+            state['__splits__'] = splits
+            cPickle.dump(state, open(checkpoint + '.tmp', 'wb'), protocol=2)
+            os.rename(checkpoint + '.tmp', checkpoint)
+        if verbose:
+            for params in todo[ci:ci+chunk]:
+                F1s = done[trialkey(params)][1]
+                print "F1 %.3f (+/- %.3f) %s" % (np.mean(F1s), np.std(F1s) / 2, params)
+
+    results = []
+    for params in trials:
+        F1s = done[trialkey(params)][1]
+        results.append((params, np.mean(F1s), np.std(F1s)))
+    results.sort(key=lambda x: -x[1])
+    return results
+
+def oof_predictions(AIs, pfds, target, cv=5):
+    """
+    compute the out-of-fold predict_proba matrix of each candidate member classifier:
+    the data is split into 'cv' folds, and each fold is predicted by a copy
+    of the classifier trained on the other folds. The (member, fold) fits run in parallel.
+
+    Args:
+    AIs : list of (untrained) member classifiers, they must provide predict_proba
+          (eg. svmclf with probability=True)
+    pfds : list of pfds
+    target : their targets
+    cv : number of folds
+
+    returns:
+    list of [nsamples x nclasses] arrays, one per classifier in AIs
+
+    """
+    from copy import deepcopy
+    from ubc_AI.threadit import threadit
+    if target.ndim == 1:
+        psrtarget = target
+    else:
+        psrtarget = target[...,0]
+    L = len(target)
+    index = range(L)
+    # keep shuffling until every training set has samples from all classes
+    while 1:
+        shuffle(index)
+        folds = [np.array(index[i::cv]) for i in range(cv)]
+        if all([len(np.unique(np.delete(psrtarget, f))) == len(np.unique(psrtarget)) for f in folds]):
+            break
+
+    matrices = {}
+    for clf in AIs:
+        fkey = featurekey(clf.feature)
+        if fkey not in matrices:
+            matrices[fkey] = feature_matrix(pfds, clf.feature)
+
+    def foldpredict(ci, fi):
+        clf = deepcopy(AIs[ci])
+        data = matrices[featurekey(clf.feature)]
+        te_idx = folds[fi]
+        tr_idx = np.delete(np.arange(L), te_idx)
+        clf.fit_features(data[tr_idx], target[tr_idx])
+        return clf.predict_proba_features(data[te_idx])
+
+    arglist = [[ci, fi] for ci in range(len(AIs)) for fi in range(cv)]
+    resultdict = threadit(foldpredict, arglist)
+    oof = []
+    for ci in range(len(AIs)):
+        for fi in range(cv):
+            proba = np.asarray(resultdict[ci*cv + fi])
+            if fi == 0:
+                pred = np.zeros((L, proba.shape[1]))
+            pred[folds[fi]] = proba
+        oof.append(pred)
+    return oof
+
+def subset_search(oof, target, strategy='lr', method='greedy', max_members=None,
+                  cv=5, verbose=False, **kwds):
+    """
+    search for the best subset of the member classifiers, by refitting only the
+    AIonAI (the combinedAI's meta-learner) on the cached out-of-fold predictions.
+    The candidate subsets are evaluated in parallel.
+
+    Args:
+    oof : list of out-of-fold predict_proba matrices (from oof_predictions)
+    target : the targets
+    strategy : the combinedAI strategy, one of combinedAI.AIonAIs, or 'vote' (Default 'lr')
+               'vote' fits nothing: a candidate is a pulsar (class 1) if at least nvote 
+               members of the subset predict it, nvote=kwds['nvote'] capped at the 
+               subset size, default a majority of the subset 
+               (use the same nvote for the combinedAI of the best subset)
+    method : 'greedy' forward selection (add the member which most improves F1,
+                       until nothing improves)
+             'exhaustive' try every subset (only practical for ~<15 members)
+    max_members : maximum subset size (Default None = no limit)
+    cv : number of random training/testing splits the AIonAI is scored on
+    verbose : print the progress
+    **kwds : passed to the AIonAI, eg. C=0.1, penalty='l2' (or nvote for 'vote')
+
+    returns:
+    best_combo, best_F1, history
+    best_combo : list of the indices of the best members
+    history : list of (combo, mean F1) of every evaluated subset
+
+    """
+    from copy import deepcopy
+    from itertools import combinations
+    from ubc_AI.threadit import threadit
+    from ubc_AI.classifier import combinedAI
+    if target.ndim == 1:
+        psrtarget = target
+    else:
+        psrtarget = target[...,0]
+    nAIs = len(oof)
+    if max_members is None:
+        max_members = nAIs
+    splits = split_indices(psrtarget, cv=cv)
+    if strategy == 'vote':
+        nvote = kwds.get('nvote')
+        if nvote is not None and nvote < 1:
+            raise ValueError("nvote must be at least 1, not %s" % nvote)
+        votes = [p.argmax(axis=1) == 1 for p in oof]
+    else:
+        template = combinedAI([None]*nAIs, strategy=strategy, **kwds)
+        if strategy in template.req_predict:
+            # these AIonAIs train on the predicted labels
+            columns = [np.transpose([p.argmax(axis=1)]) for p in oof]
+        else:
+            columns = oof
+
+    def scorevote(combo):
+        if nvote is None:
+            n = len(combo)//2 + 1
+        else:
+            n = min(nvote, len(combo))
+        pred = np.where(np.sum([votes[i] for i in combo], axis=0) >= n, 1, 0)
+        return np.mean([F1score(pred[te_idx], psrtarget[te_idx]) for tr_idx, te_idx in splits])
+
+    def scorecombo(combo):
+        if strategy == 'vote':
+            return scorevote(combo)
+        X = np.hstack([columns[i] for i in combo])
+        if strategy == 'nn' and 'design' not in kwds:
+            meta = combinedAI([None]*len(combo), strategy=strategy, **kwds).AIonAI
+        else:
+            meta = deepcopy(template.AIonAI)
+        F1s = []
+        for tr_idx, te_idx in splits:
+            meta.fit(X[tr_idx], psrtarget[tr_idx])
+            F1s.append(F1score(meta.predict(X[te_idx]), psrtarget[te_idx]))
+        return np.mean(F1s)
+
+    history = []
+    if method == 'exhaustive':
+        combos = [list(c) for n in range(1, max_members+1)
+                  for c in combinations(range(nAIs), n)]
+        resultdict = threadit(scorecombo, [[c] for c in combos])
+        history = [(c, resultdict[n]) for n, c in enumerate(combos)]
+        best_combo, best_F1 = max(history, key=lambda x: x[1])
+    elif method == 'greedy':
+        best_combo, best_F1 = [], 0.
+        while len(best_combo) < max_members:
+            combos = [best_combo + [i] for i in range(nAIs) if i not in best_combo]
+            resultdict = threadit(scorecombo, [[c] for c in combos])
+            trials = [(c, resultdict[n]) for n, c in enumerate(combos)]
+            history.extend(trials)
+            combo, F1 = max(trials, key=lambda x: x[1])
+            if verbose:
+                print "members %s: F1 %.3f" % (combo, F1)
+            if F1 <= best_F1:
+                break
+            best_combo, best_F1 = combo, F1
+    else:
+        raise ValueError("method %s is not recognized" % method)
+
+    return sorted(best_combo), best_F1, history
+
+
 
 
 
@@ -343,6 +688,59 @@ class dataloader(object):
         print "Accuracy: %0.2f (+/- %0.2f)" % (scores.mean(), scores.std() / 2)
         return scores
 
+    def param_search(self, clfclass, param_grid, **kwds):
+        """
+        search the hyperparameters of a member classifier (in parallel)
+        input: clfclass, param_grid, **kwds
+        clfclass: the classifier mixin class, eg. svmclf
+        param_grid: dictionary of {parameter: list of values}
+        refer to ubc_AI.data.param_search for the other options
+
+        returns: list of (params, mean F1, std F1), best first
+        """
+        results = param_search(clfclass, self.pfds, self.target, param_grid, **kwds)
+        print "Best F1: %0.2f (+/- %0.2f) %s" % (results[0][1], results[0][2] / 2, results[0][0])
+        return results
+
+    def member_search(self, AIs, strategy='lr', method='greedy', cv=5, **kwds):
+        """
+        select the members of a combinedAI from a pool of candidate classifiers.
+        The out-of-fold predictions of each candidate are computed once (and kept in self.oof),
+        then subsets are scored by refitting only the AIonAI on them.
+        input: AIs, strategy='lr', method='greedy', cv=5, **kwds
+        AIs: list of candidate member classifiers
+        strategy: the combinedAI strategy
+        method: 'greedy' or 'exhaustive'
+        refer to ubc_AI.data.subset_search for the other options
+
+        returns: best_combo, best_F1, history
+        """
+        if not 'oof' in self.__dict__ or len(self.oof) != len(AIs):
+            self.oof = oof_predictions(AIs, self.pfds, self.target, cv=cv)
+        best_combo, best_F1, history = subset_search(self.oof, self.target, strategy=strategy,
+                                                     method=method, cv=cv, **kwds)
+        print "Best F1: %0.2f %s" % (best_F1, best_combo)
+        return best_combo, best_F1, history
+
+    def feature_store(self, clf, fname, **kwds):
+        """
+        write the feature of a member classifier, for all pfds, to a memory-mapped file,
+        to train it out-of-core with clf.fit_stream(loader)
+        input: clf, fname, **kwds
+        clf: the classifier (its .getfeatures of the pfds are stored)
+        fname: the .npy file to create
+        refer to ubc_AI.featurestore.create_store for the other options
+
+        returns: featurestore.streamloader for the file
+        """
+        from ubc_AI.featurestore import create_store
+        from ubc_AI.classifier import classifier
+        if self.target.ndim == 1:
+            target = self.target
+        else:
+            target = self.target[..., classifier.targetmap[clf.feature.keys()[0]]]
+        return create_store(fname, self.pfds, clf.getfeatures, target, **kwds)
+
     def learning_curve(self, classifier,
                        pct=0.6,
                        plot=True):
@@ -537,7 +935,8 @@ class dataloader(object):
                         feature = [k for k in sorted(self.kwds, key=lambda x:self.kwds.get(x), reverse=True)][0]
                         if feature in ['intervals', 'subbands']:
                             N = self.kwds[feature]
-                            ax.imshow(test_data[what[i]].reshape(N,N))
+                            shape = N if isinstance(N, tuple) else (N, N)
+                            ax.imshow(test_data[what[i]].reshape(shape))
                         else:
                             ax.plot(test_data[what[i]])
                     except IndexError:pass
@@ -586,7 +985,8 @@ class dataloader(object):
                     feature = [k for k in sorted(self.kwds, key=lambda x:self.kwds.get(x), reverse=True)][0]
                     if feature in ['intervals', 'subbands']:
                         N = self.kwds[feature]
-                        ax.imshow(test_data[sample_list[i]].reshape(N,N), cmap=plt.get_cmap("binary"))
+                        shape = N if isinstance(N, tuple) else (N, N)
+                        ax.imshow(test_data[sample_list[i]].reshape(shape), cmap=plt.get_cmap("binary"))
                                   #cmap=plt.cmap.gray)
                     else:
                         ax.plot(test_data[sample_list[i]])
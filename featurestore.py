@@ -0,0 +1,220 @@
+"""
+A module for training on feature matrices too large to hold in memory.
+
+The features are extracted once into a memory-mapped .npy file (the "feature store"),
+and streamloader serves shuffled minibatches from it, reading contiguous blocks
+of rows in a background thread while the trainer works on the previous batches.
+
+Usage:
+loader = create_store('intervals48.npy', pfds, {'intervals':48}, target)
+#or, for an existing store:
+loader = streamloader('intervals48.npy', target, shape=(48,48), randomshift=True, seed=1)
+
+nn = pnn.NeuralNetwork(design=[25], fit_type='adam')
+nn.fit(loader, None)
+cnn = MetaCNN(n_epochs=65, batch_size=20)
+cnn.fit(loader, None)
+
+"""
+import numpy as np
+import threading
+import Queue
+from ubc_AI.augment import shift_augment
+
+
+def create_store(fname, pfds, feature, target, chunksize=2000, dtype=np.float32, **kwds):
+    """
+    extract the feature of the pfds into a memory-mapped .npy file,
+    one chunk of pfds at a time (in parallel), so neither the features nor
+    the pfds' cached copies of them need to fit in memory
+
+    Args:
+    fname : the .npy file to create
+    pfds : list of pfds (pfdreader objects)
+    feature : the feature dictionary, eg. {'intervals':48},
+              or a function returning the features of a list of pfds (eg. clf.getfeatures)
+    target : [nsamples] labels
+    chunksize : number of pfds extracted per chunk
+    dtype : dtype of the stored features, default float32 (half the size of float64)
+    **kwds : passed on to streamloader
+
+    returns:
+    streamloader for the new store
+
+    """
+    from ubc_AI.threadit import threadit
+    nsamples = len(pfds)
+    def getfeature(pfd):
+        if callable(feature):
+            return np.asarray(feature([pfd])[0], dtype=dtype)
+        return np.asarray(pfd.getdata(**feature), dtype=dtype)
+    first = getfeature(pfds[0])
+    data = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+                                     shape=(nsamples, first.size))
+    for ci in range(0, nsamples, chunksize):
+        #threadit forks, so the extracted features are not cached in the parent's pfds
+        resultdict = threadit(getfeature, [[p] for p in pfds[ci:ci+chunksize]])
+        for n, v in resultdict.iteritems():
+            data[ci+n] = v
+    data.flush()
+    del data
+    return streamloader(fname, target, **kwds)
+
+
+class streamloader(object):
+    """
+    Stream shuffled minibatches from a memory-mapped feature matrix.
+
+    Shuffling is done at two levels, so the reads stay sequential on disk:
+    the order of the blocks (of block_size contiguous rows) is permuted,
+    and the rows of nbuffer consecutive blocks are shuffled together.
+    The blocks are read (and optionally randomly shifted) in a background thread,
+    with up to 'prefetch' minibatches queued ahead of the trainer.
+
+    Provides the same interface as ubc_AI.augment.shiftbatches
+    (.minibatches, len, .data and .target), as used by
+    pulsar_nnetwork.NeuralNetwork.fit_minibatch and sktheano_cnn.MetaCNN.fit
+
+    """
+    def __init__(self, data, target, block_size=1024, nbuffer=8, prefetch=4,
+                 shape=None, randomshift=False, maxshift=None, rng=None, seed=None):
+        """
+        Args:
+        data : filename of the .npy feature store (or any [nsamples x nfeatures] array)
+        target : [nsamples] labels
+        block_size : number of contiguous rows read at once
+        nbuffer : number of blocks shuffled together
+        prefetch : number of minibatches queued ahead
+        shape : (nrows, ncols) of a single sample, for randomshift of 2D features
+        randomshift : randomly shift the phase of every sample (each epoch anew)
+        maxshift : shifts are drawn from [0, maxshift), default = ncols - 1
+        rng : np.random.RandomState, default None = a new one, seeded with 'seed'
+        seed : seed of the loader's RandomState
+
+        Notes:
+        The loader has its own random generator (not np.random), which only advances
+        once per epoch, when minibatches() is called (the background thread uses
+        a generator seeded from it), so its state (self.rng.get_state()) 
+        is reproducible and can be checkpointed between epochs
+        (see ubc_AI.checkpoint.random_state)
+
+        """
+        if isinstance(data, str):
+            data = np.load(data, mmap_mode='r')
+        self.data = data
+        self.target = np.asarray(target)
+        if self.target.shape[0] != self.data.shape[0]:
+            raise ValueError("store has %s samples but %s targets" %
+                             (self.data.shape[0], self.target.shape[0]))
+        self.block_size = block_size
+        self.nbuffer = nbuffer
+        self.prefetch = prefetch
+        if shape is None:
+            shape = (1, self.data.shape[1])
+        self.shape = tuple(shape)
+        self.randomshift = randomshift
+        if maxshift is None:
+            maxshift = self.shape[1] - 1
+        self.maxshift = max(1, maxshift)
+        if rng is None:
+            rng = np.random.RandomState(seed)
+        self.rng = rng
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def readbuffers(self, shuffle=True, rng=None):
+        """
+        generate (X, y) buffers of nbuffer blocks, in random block order
+        (shuffled within the buffer) if shuffle=True
+
+        rng : the random generator, default None = self.rng
+
+        """
+        if rng is None:
+            rng = self.rng
+        nsamples = len(self)
+        bs = self.block_size
+        nblocks = (nsamples + bs - 1)//bs
+        if shuffle:
+            order = rng.permutation(nblocks)
+        else:
+            order = np.arange(nblocks)
+        for start in range(0, nblocks, self.nbuffer):
+            blocks = order[start:start+self.nbuffer]
+            if not shuffle:
+                blocks = np.sort(blocks)
+            X = np.concatenate([np.asarray(self.data[b*bs:(b+1)*bs]) for b in blocks])
+            y = np.concatenate([self.target[b*bs:(b+1)*bs] for b in blocks])
+            if shuffle:
+                perm = rng.permutation(y.size)
+                X, y = X[perm], y[perm]
+            yield X, y
+
+    def minibatches(self, batch_size, shuffle=True):
+        """
+        yield (Xbatch, ybatch) minibatches covering one epoch,
+        the last batch holds the remainder (len(self) % batch_size) if non-zero
+
+        """
+        #the background thread draws from its own generator, 
+        #so self.rng is in a known state between epochs
+        rng = np.random.RandomState(self.rng.randint(2**31 - 1))
+        queue = Queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            #give up if the consumer stopped listening
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def reader():
+            try:
+                Xleft, yleft = None, None
+                for X, y in self.readbuffers(shuffle, rng):
+                    if Xleft is not None:
+                        X, y = np.concatenate([Xleft, X]), np.concatenate([yleft, y])
+                    nfull = (y.size//batch_size)*batch_size
+                    for bi in range(0, nfull, batch_size):
+                        if not put(self.augment(X[bi:bi+batch_size], y[bi:bi+batch_size], rng)):
+                            return
+                    Xleft, yleft = X[nfull:], y[nfull:]
+                if yleft is not None and yleft.size:
+                    put(self.augment(Xleft, yleft, rng))
+            except Exception as detail:
+                put(detail)
+            put(None)
+
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            #the trainer may stop early (eg. early stopping)
+            stop.set()
+
+    def augment(self, X, y, rng=None):
+        """
+        randomly shift the phase of the samples (if self.randomshift)
+
+        rng : the random generator, default None = self.rng
+
+        """
+        if rng is None:
+            rng = self.rng
+        if self.randomshift:
+            shifts = rng.randint(0, self.maxshift, y.size)
+            X = shift_augment(X, shifts, self.shape)
+        return X, y
@@ -45,6 +45,20 @@ nn3 = CLF.pnnclf(design=[9], gamma=0.001, use_pca=True, n_comp=24,
                   feature={'timebins':64}, maxiter=None)                         #F1 .83
 nn4 = CLF.cnnclf(feature={'subbands':48}, poolsize=[(3,3),(2,2)],n_epochs=65, batch_size=20, nkerns=[20,40], filters=[16,8], L1_reg=1., L2_reg=1.)
 nn5 = CLF.pnnclf(design=[9], gamma=0.1,feature={'DMbins':60}, maxiter=None)       #F1 .80
+#minibatch (Adam) training instead of fmin_cg, for large training sets:
+#nn6 = CLF.pnnclf(design=[25], gamma=0.5, feature={'phasebins':64}, fit_type='adam', batch_size=200, n_epochs=100, patience=10)
+#or out-of-core, streaming the (randomly shifted) features from a memory-mapped file:
+#loader = ldf.feature_store(nn2, 'intervals48.npy', shape=(48,48), randomshift=True)
+#nn2.fit_stream(loader)
+#a single CNN learning intervals, subbands and the (tiled) profile jointly, instead of nn2 and nn4:
+#nn7 = CLF.mcnnclf(feature={'intervals':48, 'subbands':48, 'phasebins':48}, poolsize=[(3,3),(2,2)],n_epochs=65, batch_size=20, nkerns=[20,40], filters=[16,8], L1_reg=1., L2_reg=1.)
+#on preemptible slots, checkpoint the long fits (rerunning this script resumes them):
+#nn2.set_params(checkpoint='nn2.ckpt', checkpoint_interval=600); nn4.set_params(checkpoint='nn4.ckpt')
+#data-parallel CNN training on a many-core box (run with OMP_NUM_THREADS=1), and its scaling:
+#from ubc_AI.sktheano_cnn import MetaCNN, benchmark_parallel
+#cnn = MetaCNN(n_epochs=65, batch_size=256, nkerns=[20,40], filters=[16,8])
+#cnn.fit_parallel(X, y, nworkers=32)
+#benchmark_parallel(X[:5000], y[:5000], nworkers=[1, 4, 16, 32], batch_size=256, nkerns=[20,40], filters=[16,8])
 clf1 = CLF.svmclf(gamma=0.05, C=1.0, feature={'phasebins':64}, probability=True)
 clf2 = CLF.svmclf(gamma=0.005, C=5, feature={'intervals':64}, use_pca=True, n_comp=24, probability=True)
 clf3 = CLF.svmclf(gamma=0.001, C=24., feature={'subbands':64}, use_pca=True, n_comp=24, probability=True)
@@ -65,10 +79,19 @@ tree3 = CLF.dtreeclf(min_samples_split=8, min_samples_leaf=4, feature={'DMbins':
 #ldf.cross_val_score(nn4, verbose=False)
 #ldf.cross_val_score(nn5, verbose=False)
 
+"""code for searching the hyperparameters of a layer-1 classifier (in parallel, restartable)"""
+#ldf.param_search(CLF.svmclf, {'gamma':[0.005, 0.05, 0.5], 'C':[1., 5., 25.],
+#                              'feature':[{'phasebins':32}, {'phasebins':64}]},
+#                 base_params={'probability':True}, checkpoint='svm_search.pkl', verbose=True)
+#ldf.param_search(CLF.pnnclf, {'design':[[9], [25]], 'gamma':[0.001, 0.1, 0.5]},
+#                 base_params={'feature':{'DMbins':60}}, cv=5, checkpoint='nn_search.pkl')
+
 """ join the layer-1 classifiers into a combined-AI """
 AIs = [nn1, nn2, nn3, nn4, nn5, clf1, clf2, clf3, clf4,  clf5, tree3, lg1, lg2]
 #good combos discovered so far:
 combo = [0, 1, 3, 4, 5, 6, 7, 8] #F1 = 0.9
+#or search for the best combo (the members are trained once, then only the 'lr' is refit):
+#combo, F1, history = ldf.member_search(AIs, strategy='lr', method='greedy', C=0.1, penalty='l2')
 #combo = [ 5, 1, 3, 8] #F1 = 0.9
 #combo = [0, 1, 3, 4] #F1 = 0.9
 #combo = [5, 6, 7, 8] #F1 = 0.9
@@ -88,3 +111,30 @@ clfl2 = CLF.combinedAI([AIs[i] for i in combo], strategy='lr', C=0.1, penalty='l
 clfl2.fit(ldf.pfds, ldf.target)
 cPickle.dump(clfl2, open('clfl2_new.pkl' ,'wb'), protocol=2)
 
+
+"""optional: early-exit cascade, only candidates passing the cheap phasebins LR are scored by clfl2"""
+#lgcheap = CLF.LRclf(C=0.07, penalty='l2', feature={'phasebins':64})
+#lgcheap.fit(ldf.pfds, ldf.target)
+#clfcas = CLF.cascadeAI([lgcheap, clfl2])
+#ldf.split()
+#clfcas.tune_thresholds(ldf.test_pfds, ldf.test_target, max_recall_loss=0.01, verbose=True)
+#cPickle.dump(clfcas, open('clfcas_new.pkl' ,'wb'), protocol=2)
+
+"""optional: int8 quantized NN/CNN members for scoring at survey scale (check the scores first)"""
+#from ubc_AI.quantize import quantize, accuracy_report
+#ldf.split()
+#for clf in clfl2.list_of_AIs:
+#    if hasattr(clf, 'layers') or hasattr(clf, 'cnn'):
+#        accuracy_report(clf, quantize(clf), ldf.test_pfds, ldf.test_target)
+#clfl2.list_of_AIs = [quantize(clf) for clf in clfl2.list_of_AIs]
+#cPickle.dump(clfl2, open('clfl2_int8.pkl' ,'wb'), protocol=2)
+
+"""optional: distill clfl2 into a small, fast student NN, scoring everything, with clfl2 only scoring its top 10%"""
+#pool = unlabelled candidates (the more the better)
+#student = CLF.pnnclf(design=[32], gamma=0.5, feature={'phasebins':64, 'DMbins':60}, fit_type='adam', n_epochs=100)
+#student.distill(clfl2, pool, report=False)
+#ldf.split()
+#CLF.agreement_report(student, clfl2, ldf.test_pfds, ldf.test_target, report=False)
+#clfstu = CLF.cascadeAI([student, clfl2])
+#clfstu.tune_pass_fraction(pool[:5000], pass_frac=0.1, verbose=True)
+#cPickle.dump(clfstu, open('clfstu_new.pkl' ,'wb'), protocol=2)
@@ -5,6 +5,11 @@ Aaron Berndsen (2012)
 a neural network implementation in python, with f2py/fortran 
 optimizations for large data sets
 
+The sigmoid and matrix products go through a selectable backend:
+'numpy' (default): scipy.special.expit and (threaded BLAS) np.dot, both in-place
+'fortran': the f2py/openmp code of nn_optimize.f90 (if nnopt.so can be imported)
+use set_backend(name) to switch, and benchmark_backends() to compare them
+
 """
 import numpy as np
 import cPickle
@@ -12,22 +17,137 @@ import pylab as plt
 from scipy import io
 from scipy import mgrid
 from scipy.optimize import fmin_cg
+from scipy.special import expit
+import random
 import sys
+import time
+from copy import deepcopy
 from sklearn.base import BaseEstimator
+from ubc_AI.checkpoint import random_state, set_random_state
+
+def _expit(z, out=None):
+    """ numerically stable sigmoid, optionally in-place """
+    if out is None:
+        return expit(z)
+    return expit(z, out)
+
+def _dot(a, b, out=None):
+    """ BLAS matrix product, optionally into a preallocated array """
+    if out is None:
+        return np.dot(a, b)
+    return np.dot(a, b, out)
+
+_backends = {'numpy': {'sigmoid':_expit, 'matmult':_dot}}
 
 #Aaron's fortran-optimized openmp code
 try:
-    from nnopt import sigmoid2d, matmult
-    _fort_opt = True
+    import nnopt
+    def _fort_sigmoid(z, out=None):
+        if z.ndim != 2:
+            return _expit(z, out)
+        a = nnopt.sigmoid2d(z)
+        if out is None:
+            return a
+        out[...] = a
+        return out
+    def _fort_matmult(a, b, out=None):
+        c = nnopt.matmult(a, b)
+        if out is None:
+            return c
+        out[...] = c
+        return out
+    _backends['fortran'] = {'sigmoid':_fort_sigmoid, 'matmult':_fort_matmult}
 except(ImportError):
-    print "NeuralNetwork not using fortran-optimized code"
-    print "Refer to nn_optimize.f90 for tips"
-    print "defaulting to vectorized numpy implementation"
-    _fort_opt = False
+    pass
+
+_backend = _backends['numpy']
+
+def set_backend(name='numpy'):
+    """
+    select the sigmoid/matrix-product implementation used by the NeuralNetwork
+
+    Args:
+    name : 'numpy' (default) or 'fortran' (requires nnopt.so, see nn_optimize.f90)
+
+    """
+    global _backend
+    if name not in _backends:
+        raise ValueError("backend %s not available, choose from %s" % (name, _backends.keys()))
+    _backend = _backends[name]
+
+def benchmark_backends(sizes=[(1000, 64, 16), (10000, 64, 25), (50000, 64, 25), (50000, 1024, 64)],
+                       repeat=5, verbose=True):
+    """
+    time the sigmoid and matrix product of every available backend, 
+    on the shapes met in training (nsamples x ninputs) * (ninputs x nneurons)
+
+    Args:
+    sizes : list of (nsamples, ninputs, nneurons)
+    repeat : report the best of 'repeat' timings
+    verbose : print a table of the timings
+
+    returns:
+    dictionary {(backend, 'sigmoid' or 'matmult', size): best time [s]}
+
+    """
+    timings = {}
+    for size in sizes:
+        nsamples, nin, nout = size
+        A = np.random.uniform(-1, 1, (nsamples, nin))
+        B = np.random.uniform(-1, 1, (nin, nout))
+        Z = np.dot(A, B)
+        out = np.empty_like(Z)
+        for name in sorted(_backends):
+            be = _backends[name]
+            for op, func in [('matmult', lambda: be['matmult'](A, B, out)),
+                             ('sigmoid', lambda: be['sigmoid'](Z, out))]:
+                best = np.inf
+                for r in range(repeat):
+                    t0 = time.time()
+                    func()
+                    best = min(best, time.time() - t0)
+                timings[(name, op, size)] = best
+
+    if verbose:
+        names = sorted(_backends)
+        print "%-20s %-8s " % ('size', 'op') + ''.join(['%12s' % n for n in names]) + '   fastest'
+        for size in sizes:
+            for op in ['matmult', 'sigmoid']:
+                t = [timings[(n, op, size)] for n in names]
+                print "%-20s %-8s " % ('x'.join(map(str, size)), op) +\
+                    ''.join(['%12.6f' % v for v in t]) + '   %s' % names[np.argmin(t)]
+    return timings
 
 #number of iterations in training
 _niter = 0
 
+def ntargets_of(y):
+    """
+    the number of targets: of the labels y [nsamples],
+    or the number of columns of soft targets [nsamples x ntargets]
+    """
+    if np.ndim(y) == 2:
+        return np.shape(y)[1]
+    return np.unique(y).size
+
+def min_training_size(y, yval=None):
+    """
+    the size of the smallest training set y[0:n] holding every class
+    (of y and yval): the output layer is sized from the training labels, see ntargets_of.
+    Soft targets [nsamples x ntargets] always hold every class (n=1).
+    """
+    if np.ndim(y) == 2:
+        return 1
+    y = np.asarray(y)
+    classes = np.unique(y) if yval is None else np.union1d(y, np.ravel(yval))
+    first = []
+    for c in classes:
+        idx = np.flatnonzero(y == c)
+        if idx.size == 0:
+            raise ValueError("class %s isn't in the training data" % c)
+        first.append(idx[0])
+    return max(first) + 1
+
 def main():
     """ not really used """
 ################
@@ -75,14 +195,15 @@ class layer(object):
           otherwise randomly initialize theta
           we uniformly initialize theta over [-delta, delta]
           where delta = sqrt(6)/sqrt(N+m), or passed as argument
-    shiftlayer = False. If true, we repeat the first neuron weightings, shifted.
+
+    The fit parameters of the layer (see get_params/set_params) are 
+    the theta itself, flattened into the NeuralNetwork's 'thetas'.
 
     """
-    def __init__(self, n, m, theta=np.array([]), delta=0, shiftlayer=False):
+    def __init__(self, n, m, theta=np.array([]), delta=0):
         #n includes bias
         self.inp = n
         self.output = m
-        self.shiftlayer = shiftlayer
         if len(theta):
             self.theta = theta
         else:
@@ -101,13 +222,96 @@ class layer(object):
             delta = np.sqrt(6)/np.sqrt( N + m)
         self.theta = np.random.uniform(-delta, delta, N*m).reshape(N, m)
 
-        if self.shiftlayer:
-            #make sure the subsequent layers are simply a shifted copy of the first
-            l1 = self.theta[:,0]
-            dshift = N//m
-            for i in range(m-1):
-                shift = dshift * (i+1)
-                self.theta[:,i+1] = np.roll(l1, shift)
+    def nparams(self):
+        """ number of fit parameters """
+        return self.theta.size
+
+    def get_params(self):
+        """ the fit parameters """
+        return self.theta
+
+    def set_params(self, params):
+        """ set the fit parameters (eg. a view into the flattened thetas) """
+        self.theta = params.reshape(self.theta.shape)
+
+    def regularized(self, params):
+        """ the regularized part of params (or of its gradient): all but the bias """
+        return params[1:, :]
+
+    def reg(self):
+        """ sum of squares of the regularized parameters """
+        t = self.regularized(self.get_params()).ravel()
+        return np.dot(t, t)
+
+    def param_gradient(self, a, delta, out):
+        """
+        write the gradient of the fit parameters into 'out', given the
+        input activations 'a' [nsamples x N] and the backpropagated 'delta' [nsamples x m]
+        (summed over the samples)
+
+        """
+        _backend['matmult'](a.transpose(), delta, out)
+
+
+class convlayer(layer):
+    """
+    a shift-invariant layer: the m neurons share a single weight vector (and bias),
+    neuron i seeing the input circularly shifted by i*((N-1)//m) bins. 
+    The layer is a strided circular convolution of the (phase) input with the weights,
+    with N fit parameters instead of N*m. 
+    This is meant to help remove phase-dependence of the pulse.
+
+    The dense theta (N, m) used in the forward pass is gathered from the 
+    shared weights with a precomputed index (ie. the circulant matrix), 
+    and the gradient of theta is folded back onto the shared weights.
+
+    optional:
+    theta = a (N, m) theta to take the shared weights from (its first neuron)
+          otherwise randomly initialize the weights over [-delta, delta]
+
+    """
+    def __init__(self, n, m, theta=np.array([]), delta=0):
+        #n includes bias
+        self.inp = n
+        self.output = m
+        nin = n - 1
+        dshift = max(1, nin//m)
+        #theta[1+j, i] = w[(j - i*dshift) % nin], ie. w rolled by i*dshift
+        self.index = (np.arange(nin)[:, np.newaxis] - dshift*np.arange(m)[np.newaxis, :]) % nin
+        self.theta = np.empty((n, m))
+        if len(theta):
+            self.set_params(np.hstack([theta[0, 0], theta[1:, 0]]))
+        else:
+            self.randomize(delta)
+
+    def randomize(self, delta=None):
+        """
+        randomize the shared weights for each 'fit' call in the neural network
+        """
+        if not delta:
+            delta = np.sqrt(6)/np.sqrt(self.inp + self.output)
+        self.set_params(np.random.uniform(-delta, delta, self.inp))
+
+    def nparams(self):
+        return self.inp
+
+    def get_params(self):
+        """ the fit parameters: [bias, shared weights] """
+        return self.w
+
+    def set_params(self, params):
+        self.w = params
+        self.theta[0, :] = params[0]
+        self.theta[1:, :] = params[1:][self.index]
+
+    def regularized(self, params):
+        return params[1:]
+
+    def param_gradient(self, a, delta, out):
+        G = _backend['matmult'](a.transpose(), delta)
+        out[0] = G[0].sum()
+        out[1:] = np.bincount(self.index.ravel(), weights=G[1:, :].ravel(),
+                              minlength=self.inp - 1)
 
 class NeuralNetwork(BaseEstimator):
     """
@@ -121,15 +325,34 @@ class NeuralNetwork(BaseEstimator):
     * design = None (initialize the NN with neurons/layers determined
               by the list of neurons per layer
               Eg. desing=[25,4] = 2-layers, first with 25, second with 4 
-    * fit_type = ['all','single'] . Fit the individual layers 'all' at once (default)
+    * fit_type = ['all','single','sgd','adam'] . Fit the individual layers 'all' at once (default)
                               or build up the NN, fitting a 'single' layer at a time,
                               then adding the next layer.
+                              'sgd' and 'adam' fit all layers with minibatch 
+                              stochastic gradient descent (see self.fit_minibatch)
     * maxiter : number of iterations in self.fit's conjugate-gradient minimization
                 default = 100, can be overriden elsewhere (self.fit)
     * shiftlayer : if not None, instead of having N independent neurons in this layer,
-                 we reproduce the first neuron N-times, shifting the weights of the first one.
+                 we reproduce the first neuron N-times, shifting the weights of the first one
+                 (a convlayer, with shared weights).
                  This is meant to help remove phase-dependence of the pulse.
                  shiftlayer in [0, 1, 2, ...] number of hidden layers
+    *for fit_type='sgd'/'adam':
+    * learning_rate : default None = 0.1 for 'sgd', 0.001 for 'adam'
+    * momentum : the 'sgd' momentum (and Adam's beta1), default 0.9
+    * batch_size : samples per minibatch, default 100
+    * n_epochs : maximum number of passes over the training data, default 50
+    * lr_schedule : None (constant), 'step' (halve every 10 epochs), 
+                    'inverse' (lr/(1+epoch/10)), or a function f(epoch, learning_rate)
+    * val_frac : fraction of the training data held out for early stopping, default 0.1
+    * patience : stop after this many epochs without improving the validation cost, default 5
+    * nrestarts : fit this many randomly initialized networks (in parallel), 
+                  keeping the best one on a held-out split (see self.fit_restarts), default 1
+    *for long fits (fit_type 'all', 'sgd' or 'adam'):
+    * checkpoint : filename to save the training state to (see ubc_AI.checkpoint), 
+                   every checkpoint_interval seconds and when interrupted.
+                   fit resumes from it if it exists, and removes it when done. default None
+    * checkpoint_interval : seconds between checkpoints, default 300
     
     Notes: 
     * if design != None and thetas != None, we get shape
@@ -139,7 +362,10 @@ class NeuralNetwork(BaseEstimator):
 
     """
     def __init__(self, gamma=0., thetas=None, design=None,
-                 fit_type='all', maxiter=None, shiftlayer=None, verbose=False):
+                 fit_type='all', maxiter=None, shiftlayer=None, verbose=False,
+                 learning_rate=None, momentum=0.9, batch_size=100, n_epochs=50,
+                 lr_schedule=None, val_frac=0.1, patience=5, nrestarts=1,
+                 checkpoint=None, checkpoint_interval=300.):
         self.gamma = gamma
         self.design = design
         self.fit_type = fit_type
@@ -156,6 +382,16 @@ class NeuralNetwork(BaseEstimator):
             self.create_layers(nfeatures, ntargets, thetas=thetas, verbose=verbose,\
                                    shiftlayer=shiftlayer)
         self.verbose = verbose
+        self.learning_rate = learning_rate
+        self.momentum = momentum
+        self.batch_size = batch_size
+        self.n_epochs = n_epochs
+        self.lr_schedule = lr_schedule
+        self.val_frac = val_frac
+        self.patience = patience
+        self.nrestarts = nrestarts
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
         self.nfit = 0 # keep track of number of times the classifier has been 'fit'
 
     def create_layers(self, nfeatures, ntargets, design=None, gamma=None,
@@ -175,8 +411,8 @@ class NeuralNetwork(BaseEstimator):
         thetas = None : can pass neural mappings as list of arrays (a list of thetas),
                         otherwise they are randomly initialized (better).
                       This overrides 'design'
-        shiftlayer = None: if not None, the theta is simply a shifted repeat of the first neuron
-                           in this layer
+        shiftlayer = None: if not None, the theta of this layer is simply a shifted repeat 
+                           of the first neuron (a convlayer)
                    
         """
         if design == None:
@@ -215,13 +451,10 @@ class NeuralNetwork(BaseEstimator):
                 lout = ntargets
             else:
                 lout = design[idx]
-            if shiftlayer is not None:
-                if idx == shiftlayer:
-                    layers.append(layer(lin, lout, theta, shiftlayer=True))
-                else:
-                    layers.append(layer(lin, lout, theta, shiftlayer=False))
+            if shiftlayer is not None and idx == shiftlayer:
+                layers.append(convlayer(lin, lout, theta))
             else:
-                layers.append(layer(lin, lout, theta, shiftlayer=False))
+                layers.append(layer(lin, lout, theta))
                 
         if verbose or self.verbose:
             txt = "Created (network,  gamma) = (%s-->" % (nfeatures)
@@ -248,9 +481,8 @@ class NeuralNetwork(BaseEstimator):
         """
         bi = 0
         for lv in self.layers:
-            shape = lv.theta.shape
-            ei = bi + shape[0] * shape[1]
-            lv.theta = thetas[bi:ei].reshape(shape)
+            ei = bi + lv.nparams()
+            lv.set_params(thetas[bi:ei])
             bi = ei
 
     def flatten_thetas(self):
@@ -262,10 +494,7 @@ class NeuralNetwork(BaseEstimator):
         internal theta's, from earliest to latest layers
 
         """
-        z = np.array([])
-        for lv in self.layers:
-            z = np.hstack([z, lv.theta.flatten()])
-        return z
+        return np.concatenate([lv.get_params().ravel() for lv in self.layers])
 
     def costFunctionU(self, X, y, gamma=None):
         """
@@ -302,27 +531,30 @@ class NeuralNetwork(BaseEstimator):
 # testing: check the theta's are changing while we train: yes!
 #        print "CF",thetas[0:2], thetas[-5:-2]
 
-# update the layer's theta's
-        self.unflatten_thetas(thetas)
-        
         # number of trials
         if X.ndim == 2:
             N = X.shape[0] 
         else:
             N = 1
 
-        # propagate the input through the entire network
-        z, h = self.forward_propagate(X)
-        yy = labels2vectors(y, self.ntargets)
- 
-        J = 0.
-        J = (-np.log(h) * yy.transpose() - np.log(1-h)*(1-yy.transpose())).sum()
-        J = J/N
+        # propagate the input through the entire network 
+        # (shared with self.gradient at the same thetas)
+        self.activations(thetas, X)
+        ws = self._workspace
+        z = ws['z'][-1] #the logits of the output layer
+        yidx, yy = self.targets(y)
+
+# from the logits, with h = sigmoid(z):
+#   -y*log(h) - (1-y)*log(1-h) = log(1 + exp(z)) - y*z
+# which stays finite when the activations saturate
+# (y*z summed over the one-hot, or soft, targets)
+        softplus = np.logaddexp(0., z, ws['scratch'][-1])
+        J = (softplus.sum() - np.vdot(z, yy))/N
 
 # regularize (ignoring bias):
         reg = 0.
         for l in self.layers:
-            reg +=  (l.theta[1:, :]**2).sum()
+            reg += l.reg()
         J = J + gamma*reg/(2*N)
         
         if verbose or self.verbose:
@@ -344,41 +576,180 @@ class NeuralNetwork(BaseEstimator):
         X = [nsamples, nproperties] (no bias)
         nl = number of layers to propagte through
              defaults to end (well, one hundred layers!)
+
+        Notes:
+        each layer writes into arrays allocated with their bias column
+        (no stacking copies), see predict_proba_batch for large X
         """
         if isinstance(z, type([])):
             z = np.array(z)
-        # number of trials
-        if z.ndim == 2:
-            N = z.shape[0] 
-            # add bias
-            a = np.hstack([np.ones((N, 1)), z])
-        else:
-            N = 1
-            # add bias
-            a = np.hstack([np.ones(N), z])
+        single = z.ndim == 1
+        z = np.atleast_2d(z)
+        N = z.shape[0]
+        # add bias
+        a = np.empty((N, z.shape[1] + 1))
+        a[:, 0] = 1.
+        a[:, 1:] = z
 
         final_layer = len(self.layers) - 1
         for li, lv in enumerate(self.layers[0:nl]):
-            z = np.dot(a, lv.theta)
+            z = np.empty((N, lv.theta.shape[1]))
+            _backend['matmult'](a, lv.theta, z)
             # add bias to input of each internal layer
             if li != final_layer:
-                if N == 1 and z.ndim == 1:
-                    a = np.hstack([np.ones(N), sigmoid(z)])
-                else:
-                    if _fort_opt:
-                        a = np.hstack([np.ones((N, 1)), sigmoid2d(z)])
-                    else:
-                        a = np.hstack([np.ones((N, 1)), sigmoid(z)])
+                a = np.empty((N, z.shape[1] + 1))
+                a[:, 0] = 1.
+                sigmoid(z, out=a[:, 1:])
             else:
-                if N == 1:
-                    a = sigmoid(z)
-                else:
-                    if _fort_opt:
-                        a = sigmoid2d(z)
-                    else:
-                        a = sigmoid(z)
+                a = sigmoid(z)
+        if single:
+            return z[0], a[0]
         return z, a
 
+    def activations(self, thetas, X):
+        """
+        propagate the samples through the network with the flattened 'thetas',
+        keeping the activations of every layer for the backpropagation.
+
+        fmin_cg evaluates the costFunction and gradient at the same thetas, 
+        so we cache the activations of the last evaluation and reuse them 
+        (the cache is cleared at the end of self.fit)
+
+        Args:
+        thetas : flattened layer thetas (see flatten_thetas)
+        X = [nsamples, ninputs] (no bias)
+
+        returns:
+        list of activations [input, hidden_1, ..., output], 
+        the input and hidden layers include the bias column
+
+        """
+        # update the layer's theta's
+        self.unflatten_thetas(thetas)
+
+        cache = getattr(self, '_evalcache', None)
+        if cache is not None and cache[1] is X and np.array_equal(cache[0], thetas):
+            return cache[2]
+
+        ws = self.workspace(X)
+        acts = ws['acts']
+        final_layer = len(self.layers) - 1
+        for li, lv in enumerate(self.layers):
+            z = ws['z'][li]
+            _backend['matmult'](acts[li], lv.theta, z)
+            # internal layers write past their (fixed) bias column
+            if li != final_layer:
+                a = acts[li+1][:, 1:]
+            else:
+                a = acts[li+1]
+            sigmoid(z, out=a)
+        self._evalcache = (np.array(thetas, copy=True), X, acts)
+        return acts
+
+    def workspace(self, X):
+        """
+        return the preallocated arrays used by activations/gradient 
+        for the training samples X, only (re)allocating them when the
+        number of samples or the network shape changes.
+
+        The bias columns of the activations are written once, and X is
+        only copied into the input activations when a new X is passed.
+
+        returns:
+        dict of per-layer lists 'acts', 'z', 'delta' and 'scratch'
+
+        """
+        N = X.shape[0]
+        shapes = [lv.theta.shape for lv in self.layers]
+        ws = getattr(self, '_workspace', None)
+        if ws is None or ws['N'] != N or ws['shapes'] != shapes:
+            final_layer = len(shapes) - 1
+            a = np.empty((N, shapes[0][0]))
+            a[:, 0] = 1.
+            acts, zs, deltas = [a], [], []
+            for li, (nin, nout) in enumerate(shapes):
+                zs.append(np.empty((N, nout)))
+                deltas.append(np.empty((N, nout)))
+                if li != final_layer:
+                    a = np.empty((N, nout + 1))
+                    a[:, 0] = 1.
+                else:
+                    a = np.empty((N, nout))
+                acts.append(a)
+            ws = {'N':N, 'shapes':shapes, 'X':None, 
+                  'acts':acts, 'z':zs, 'delta':deltas, 
+                  'scratch':[np.empty_like(d) for d in deltas]}
+            self._workspace = ws
+        if ws['X'] is not X:
+            ws['acts'][0][:, 1:] = X
+            ws['X'] = X
+        return ws
+
+    def targets(self, y):
+        """
+        return the integer labels and the [nsamples x ntargets] one-hot matrix of y,
+        cached in the workspace while the same y is passed 
+        (ie. across the optimizer's iterations)
+
+        soft targets y [nsamples x ntargets] are returned as they are 
+        (with the most-likely class as the label)
+
+        """
+        ws = self._workspace
+        if ws.get('y') is not y:
+            if np.ndim(y) == 2:
+                yy = np.asarray(y, dtype=np.float64)
+                yidx = yy.argmax(axis=1)
+            else:
+                yidx = np.asarray(y, dtype=np.intp)
+                yy = np.zeros((yidx.size, self.ntargets))
+                yy[np.arange(yidx.size), yidx] = 1.
+            ws['yidx'], ws['onehot'], ws['y'] = yidx, yy, y
+        return ws['yidx'], ws['onehot']
+
+    def clear_cache(self):
+        """
+        forget the activations cached by the last cost/gradient evaluation,
+        and release the workspace arrays
+
+        """
+        self._evalcache = None
+        self._workspace = None
+
+    def checkpointer(self):
+        """
+        return the ubc_AI.checkpoint.checkpointer of self.checkpoint, or None
+        (older pickles don't have checkpoint parameters)
+
+        """
+        fname = getattr(self, 'checkpoint', None)
+        if fname is None:
+            return None
+        from ubc_AI.checkpoint import checkpointer
+        return checkpointer(fname, getattr(self, 'checkpoint_interval', 300.))
+
+    def __getstate__(self):
+        """
+        don't pickle the cached activations (or the training data they reference)
+
+        """
+        d = self.__dict__.copy()
+        d.pop('_evalcache', None)
+        d.pop('_workspace', None)
+        return d
+
+    def costGradient(self, thetas, X, y, gamma=None, verbose=None):
+        """
+        compute the cost function and its gradient from a single 
+        forward pass through the network
+
+        returns:
+        J, gradient
+
+        """
+        return (self.costFunction(thetas, X, y, gamma, verbose), 
+                self.gradient(thetas, X, y, gamma, verbose))
+
     def gradientU(self, X, y, gamma=None, shiftlayer=None, verbose=None):
         """
         Convenience function.
@@ -401,7 +772,6 @@ class NeuralNetwork(BaseEstimator):
         y = [nsamples] #the training classifications
         gamma : regularization parameter
                default = None = self.gamma
-        shiftlayer : None, or the layer which 
 
         returns the gradient for the parameters of the neural network
         (the theta's) unrolled into one large vector, ordered from
@@ -416,70 +786,44 @@ class NeuralNetwork(BaseEstimator):
 
         N = X.shape[0]
         nl = len(self.layers)
-# create our grad_theta arrays (init to zero):
-        grads = {}
-        for li, lv in enumerate(self.layers):
-            grads[li] = np.zeros_like(lv.theta)
+        acts = self.activations(thetas, X)
 
-# vectorize sample-loop
-        if 1:
-            for li in range(nl, 0, -1):
-                z, a = self.forward_propagate(X,li)
+        ws = self._workspace
 
-                if li == nl:
-                    ay = labels2vectors(y, self.ntargets).transpose()
-                    delta = (a - ay)
-                else:
-                    theta = self.layers[li].theta
-                    aprime = np.hstack([np.ones((N,1)), sigmoidGradient(z)]) #add in bias
-#use fortran matmult if arrays are large
-                    if _fort_opt and deltan.size * theta.size > 100000:
-                       tmp = matmult(deltan,theta.transpose())
-                    else:
-                       tmp = np.dot(deltan,theta.transpose())#nsamples x neurons(li)
-                    delta = tmp*aprime
-                    
-#find contribution to grad
-                idx = li - 1
-                z, a = self.forward_propagate(X,idx)
-                if idx in grads:
-                    if li == nl:
-                        grads[idx] = np.dot(a.transpose(), delta)/N
-                    else:
-                        #strip off bias
-                        grads[idx] = np.dot(a.transpose(), delta[:,1:])/N
-
-#if this is a "shift-invar" layer, find the average grad 
-                if self.shiftlayer is not None:
-                    if li == self.shiftlayer:
-                        shape = self.layers[li].theta.shape
-                        grads = grads.reshape(shape)
-                        l1 = grads[:,0]
-                        dshift = N//m
-                        for i in range(m-1):
-                            shift = -dshift * (i+1) #undo the previous shifts
-                            self.theta[:,i+1] = np.roll(l1, shift)
-                        grad_avg = self.theta.mean(axis=0)
-                        grads = np.array([grad_avg for i in range(shape[1])]).flatten()
-
-#keep this delta for the next (earlier) layer
-                if li == nl:
-                    deltan = delta
-                else:
-                    deltan = delta[:,1:]
+# the flattened gradient, with a view onto each layer's part
+# (a new array every call, fmin_cg keeps the previous gradient)
+        flatgrad = np.empty(sum(lv.nparams() for lv in self.layers))
+        grads = []
+        bi = 0
+        for lv in self.layers:
+            ei = bi + lv.nparams()
+            grads.append(flatgrad[bi:ei].reshape(lv.get_params().shape))
+            bi = ei
 
+# backpropagate, layer nl-1 down to 0, reusing the forward-pass activations
+        delta = ws['delta'][-1]
+        np.subtract(acts[-1], self.targets(y)[1], out=delta)
+        for li in range(nl-1, -1, -1):
+            self.layers[li].param_gradient(acts[li], delta, grads[li])
+            grads[li] /= N
+            if li > 0:
+                #strip off bias: sigmoidGradient(z) = a*(1-a)
+                a = acts[li][:, 1:]
+                theta = self.layers[li].theta[1:, :]
+                deltan = ws['delta'][li-1]
+                _backend['matmult'](delta, theta.transpose(), deltan)#nsamples x neurons(li)
+                aprime = ws['scratch'][li-1]
+                np.multiply(a, a, out=aprime)
+                np.subtract(a, aprime, out=aprime)
+                deltan *= aprime
+                delta = deltan
 
 #now regularize the grads (bias doesn't get get regularized):
         for li, lv in enumerate(self.layers):
-            theta = lv.theta
-            grads[li][:, 1:] = grads[li][:, 1:] + gamma/N*theta[:, 1:]
+            g = lv.regularized(grads[li])
+            g += gamma/N*lv.regularized(lv.get_params())
             
-#finally, flatten the gradients
-        z = np.array([])
-        for k in sorted(grads):
-            v = grads[k]
-            z = np.hstack([z, v.flatten()])
-        return z
+        return flatgrad
 
     def score(self, X, y):
         """Returns the mean accuracy on the given test data and labels.
@@ -501,7 +845,7 @@ class NeuralNetwork(BaseEstimator):
 
     def fit(self, X, y, design=None, gamma=None,
             gtol=1e-05, epsilon=1.4901161193847656e-08, maxiter=None,
-            raninit=True, info=False, verbose=None, fit_type=None):
+            raninit=True, info=False, verbose=None, fit_type=None, validation=None):
         """
         Train the data.
         minimize the cost function (wrt the Theta's)
@@ -511,10 +855,13 @@ class NeuralNetwork(BaseEstimator):
         ** The number of input features is determined from X.shape[1],
         and the number of targets from np.unique(y), so make sure
         'y' spans your target space.
+        ** y can also be soft targets [nsamples x nclass] (eg. class probabilities
+        of a teacher classifier to distill, see ubc_AI.classifier.classifier.distill)
 
         Args:
         X : the training samples [nsamples x nproperties]
-        y : the sample labels [nsamples], each entry in range 0<=y<nclass
+        y : the sample labels [nsamples], each entry in range 0<=y<nclass,
+            or soft targets [nsamples x nclass], each row summing to 1
         design : list of number of neurons in each layer. 
              Default = None, uses self.create_layers default=[16]
              Eg. design=[12,3] is a neural network with 2 layers of 12, then 3 neurons
@@ -530,6 +877,12 @@ class NeuralNetwork(BaseEstimator):
         
         raninit : T/F randomly initialize the theta's [default = True]
                 (only use 'False' to continue training, not for new NN's) 
+        fit_type : default None = self.fit_type
+        validation : (Xval, yval) for early stopping with fit_type 'sgd'/'adam'
+        
+        Notes:
+        for fit_type 'sgd'/'adam', X can also be a minibatch loader 
+        (with y=None), see self.fit_minibatch
         """
         global _niter
         _niter = 0
@@ -542,13 +895,23 @@ class NeuralNetwork(BaseEstimator):
             fit_type = self.fit_type
         if maxiter == None:
             maxiter = self.maxiter
+
+        # several random initializations, keep the best
+        if raninit and getattr(self, 'nrestarts', 1) > 1:
+            self.fit_restarts(X, y, validation=validation, design=design, gamma=gamma,
+                              gtol=gtol, epsilon=epsilon, maxiter=maxiter,
+                              verbose=verbose, fit_type=fit_type)
+            self.nfit += 1
+            if info:
+                return self.flatten_thetas()
+            return
             
         # train all layers at same time
         if fit_type == 'all':
     #update the NN layers (if necessary)
             if raninit:
                 self.create_layers(X.shape[1], 
-                                   np.unique(y).size, 
+                                   ntargets_of(y), 
                                    design=design,
                                    gamma=gamma,
                                    verbose=verbose,
@@ -557,15 +920,63 @@ class NeuralNetwork(BaseEstimator):
                     lv.randomize()
 
             thetas = self.flatten_thetas()
-            xopt = fmin_cg(f=self.costFunction,
-                           x0=thetas,
-                           fprime=self.gradient,
-                           args=(X, y, gamma, verbose), #extra args to costFunction 
-                           maxiter=maxiter,
-                           epsilon=epsilon,
-                           gtol=gtol,
-                           disp=0,
-                           )
+            #resume from the checkpoint (CG restarts from its thetas)
+            ckpt = self.checkpointer()
+            state = None
+            if ckpt is not None:
+                state = ckpt.load(fit_type='all', nparams=thetas.size)
+            niter = [0]
+            if state is not None:
+                thetas = state['thetas']
+                niter[0] = state['iteration']
+            last = [thetas]
+            def callback(xk):
+                niter[0] += 1
+                last[0] = xk
+                if ckpt is not None and ckpt.due():
+                    ckpt.save({'fit_type':'all', 'nparams':xk.size, 
+                               'thetas':xk.copy(), 'iteration':niter[0]})
+            try:
+                xopt = fmin_cg(f=self.costFunction,
+                               x0=thetas,
+                               fprime=self.gradient,
+                               args=(X, y, gamma, verbose), #extra args to costFunction 
+                               maxiter=max(1, maxiter - niter[0]),
+                               epsilon=epsilon,
+                               gtol=gtol,
+                               disp=0,
+                               callback=callback,
+                               )
+            except KeyboardInterrupt:
+                if ckpt is not None:
+                    ckpt.save({'fit_type':'all', 'nparams':last[0].size,
+                               'thetas':last[0].copy(), 'iteration':niter[0]})
+                self.unflatten_thetas(last[0].copy())
+                self.clear_cache()
+                raise
+            if ckpt is not None:
+                ckpt.remove()
+            # the last evaluation isn't necessarily at the minimum
+            self.unflatten_thetas(xopt)
+            self.clear_cache()
+
+        # minibatch stochastic gradient descent
+        elif fit_type in ['sgd', 'adam']:
+            if hasattr(X, 'minibatches'):
+                nfeatures, targets = X.data.shape[1], X.target
+            else:
+                nfeatures, targets = X.shape[1], y
+            if raninit:
+                self.create_layers(nfeatures, 
+                                   ntargets_of(targets), 
+                                   design=design,
+                                   gamma=gamma,
+                                   verbose=verbose,
+                                   shiftlayer=self.shiftlayer)
+                for lv in self.layers:
+                    lv.randomize()
+            xopt = self.fit_minibatch(X, y, gamma=gamma, fit_type=fit_type,
+                                      validation=validation, verbose=verbose)
 
         # build up the NN, training each layer one at a time
         elif fit_type == 'single':
@@ -573,7 +984,7 @@ class NeuralNetwork(BaseEstimator):
                 design = self.design
             if self.nin == None:
                 self.nin = X.shape[1]
-                self.nout = np.unique(y).size
+                self.nout = ntargets_of(y)
 
             # train the individual layers
             thetas = []
@@ -591,11 +1002,11 @@ class NeuralNetwork(BaseEstimator):
                                  verbose=verbose,
                                  shiftlayer=self.shiftlayer)
                 for lyri, theta in enumerate(thetas):
-                    nn.layers[lyri].theta = theta
+                    nn.layers[lyri].set_params(theta)
                 nn.fit(X, y,
                        gtol=gtol, epsilon=epsilon, maxiter=maxiter,
                        raninit=False, info=info, verbose=verbose)
-                thetas =[nn.layers[i].theta for i in range(lyr+1)] 
+                thetas =[nn.layers[i].get_params().copy() for i in range(lyr+1)] 
 #.append(nn.layers[lyr].theta)
             #end design loop
 
@@ -605,7 +1016,7 @@ class NeuralNetwork(BaseEstimator):
 
             # transfer the Theta's to our NN
             self.create_layers(X.shape[1], 
-                               np.unique(y).size, 
+                               ntargets_of(y), 
                                design=design,
                                gamma=gamma,
                                verbose=verbose,
@@ -613,7 +1024,7 @@ class NeuralNetwork(BaseEstimator):
 #            for lyri, theta in enumerate(thetas):
 #                self.layers[lyri].theta = theta
             for lyri, lyr in enumerate(nn.layers):
-                self.layers[lyri].theta = lyr.theta
+                self.layers[lyri].set_params(lyr.get_params().copy())
 
 #            print "N",len(self.layers),self.layers[-1].theta[0:3,0:3]
 #            print "O",len(thetas),thetas[-1][0:3,0:3]
@@ -629,6 +1040,213 @@ class NeuralNetwork(BaseEstimator):
             print("\n")
             return xopt
         
+    def fit_restarts(self, X, y, nrestarts=None, validation=None, pct=0.8, **kwds):
+        """
+        fit nrestarts randomly initialized copies of the network in parallel
+        (each worker seeded differently), and keep the layers of the one with 
+        the lowest (unregularized) cost on a held-out split.
+
+        Args:
+        X : the training samples [nsamples x nproperties] 
+            (or a minibatch loader, with y=None, see self.fit_minibatch)
+        y : the sample labels [nsamples]
+        nrestarts : number of random initializations, default None = self.nrestarts
+        validation : (Xval, yval) held-out set, 
+                     default None = hold out a fraction 1-pct of X
+        pct : fraction of X used for training when validation=None, default 0.8
+        **kwds : passed on to self.fit (design, gamma, maxiter, fit_type, ...)
+
+        returns:
+        list of the held-out costs of every restart
+
+        """
+        from ubc_AI.threadit import threadit
+        if nrestarts is None:
+            nrestarts = getattr(self, 'nrestarts', 1)
+        if validation is None:
+            if hasattr(X, 'minibatches'):
+                raise ValueError("pass validation=(Xval, yval) to restart a streamed fit")
+            X, y, Xval, yval = split_data(X, y, pct=pct)
+        else:
+            Xval, yval = validation
+
+        #the forked workers would otherwise share the same random state
+        seeds = np.random.randint(0, 2**31 - 1, nrestarts)
+        def restart(seed, n):
+            np.random.seed(seed)
+            nn = deepcopy(self)
+            nn.nrestarts = 1
+            if getattr(self, 'checkpoint', None) is not None:
+                nn.checkpoint = '%s.restart%s' % (self.checkpoint, n)
+            nn.fit(X, y, raninit=True, **kwds)
+            cost = nn.costFunctionU(Xval, yval, gamma=0.)
+            return cost, nn.layers, nn.design, nn.ntargets
+
+        resultdict = threadit(restart, [[s, n] for n, s in enumerate(seeds)])
+        costs = [resultdict[i][0] for i in range(nrestarts)]
+        best = resultdict[int(np.argmin(costs))]
+        self.layers, self.design, self.ntargets = best[1:]
+        self.nlayers = len(self.layers)
+        if kwds.get('verbose') or self.verbose:
+            print "\nrestart held-out costs: %s, keeping %s" % (costs, np.argmin(costs))
+        return costs
+
+    def fit_minibatch(self, X, y=None, gamma=None, fit_type='sgd', 
+                      validation=None, verbose=None):
+        """
+        minimize the cost function (wrt the Theta's of the existing layers)
+        with minibatch stochastic gradient descent, using
+        momentum (fit_type='sgd') or Adam (fit_type='adam').
+
+        Args:
+        X : the training samples [nsamples x nproperties], or a loader with 
+            .minibatches(batch_size, shuffle=True) yielding (Xbatch, ybatch),
+            len(loader) = samples per epoch, and .data/.target attributes
+            (eg. ubc_AI.augment.shiftbatches)
+        y : the sample labels [nsamples] (None for loaders)
+        gamma : regularization parameter, default None = self.gamma
+        fit_type : 'sgd' or 'adam'
+        validation : (Xval, yval) used for early stopping.
+                     default None = hold out self.val_frac of X 
+                     (loaders get no early stopping without 'validation')
+
+        returns:
+        the flattened thetas of the fit
+
+        Notes:
+        * a minibatch of n_b samples is regularized with gamma*n_b/N,
+          so each epoch minimizes the same cost as the full-batch costFunction
+        * with a validation set we keep the thetas with the lowest 
+          (unregularized) validation cost, and stop after self.patience
+          epochs without improvement
+        * with self.checkpoint, the state (thetas, momentum/Adam moments, epoch, 
+          early-stopping and random state, including the loader's own generator) 
+          is saved after an epoch 
+          every self.checkpoint_interval seconds, and the fit resumes from it
+
+        """
+        if gamma == None:
+            gamma = self.gamma
+        if verbose or self.verbose:
+            verbose = True
+        # (older pickles don't have the minibatch parameters)
+        lr0 = getattr(self, 'learning_rate', None)
+        if lr0 is None:
+            lr0 = {'sgd':0.1, 'adam':0.001}[fit_type]
+        momentum = getattr(self, 'momentum', 0.9)
+        batch_size = getattr(self, 'batch_size', 100)
+        n_epochs = getattr(self, 'n_epochs', 50)
+        lr_schedule = getattr(self, 'lr_schedule', None)
+        val_frac = getattr(self, 'val_frac', 0.1)
+        patience = getattr(self, 'patience', 5)
+        beta2, eps = 0.999, 1.e-8
+
+        ckpt = self.checkpointer()
+        state = None
+        if ckpt is not None:
+            state = ckpt.load(fit_type=fit_type, nparams=self.flatten_thetas().size)
+        if state is not None:
+            #the same validation split
+            random.setstate(state['pyrandom'])
+        pyrandom = random.getstate()
+
+        if hasattr(X, 'minibatches'):
+            loader = X
+        else:
+            X = np.asarray(X)
+            y = np.asarray(y)
+            if validation is None and val_frac > 0:
+                X, y, Xval, yval = split_data(X, y, pct=1.-val_frac)
+                validation = (Xval, yval)
+            loader = minibatcher(X, y)
+        N = float(len(loader))
+
+        thetas = self.flatten_thetas()
+        self.unflatten_thetas(thetas) #the layers are views of thetas
+        step = np.zeros_like(thetas) #momentum / Adam's first moment
+        if fit_type == 'adam':
+            sqgrad = np.zeros_like(thetas)
+            t = 0
+        best_cost = np.inf
+        best_thetas = None
+        nbad = 0
+        start = 0
+        if state is not None:
+            thetas[:] = state['thetas']
+            step[:] = state['step']
+            if fit_type == 'adam':
+                sqgrad[:] = state['sqgrad']
+                t = state['t']
+            best_cost, best_thetas, nbad = state['best_cost'], state['best_thetas'], state['nbad']
+            start = state['epoch']
+            set_random_state(state['random'], loader)
+
+        def save(epoch, rstate):
+            ckpt.save({'fit_type':fit_type, 'nparams':thetas.size, 'epoch':epoch, 
+                       'thetas':thetas.copy(), 'step':step.copy(),
+                       'sqgrad':sqgrad.copy() if fit_type == 'adam' else None,
+                       't':t if fit_type == 'adam' else 0,
+                       'best_cost':best_cost, 'best_thetas':best_thetas, 'nbad':nbad,
+                       'random':rstate, 'pyrandom':pyrandom})
+
+        epoch = start
+        try:
+            for epoch in range(start, n_epochs):
+                #to redo an interrupted epoch
+                rstate = random_state(loader)
+                lr = learning_rate_schedule(lr0, epoch, lr_schedule)
+                for Xb, yb in loader.minibatches(batch_size):
+                    grad = self.gradient(thetas, Xb, yb, gamma*len(yb)/N)
+                    if fit_type == 'adam':
+                        t += 1
+                        step *= momentum
+                        step += (1. - momentum)*grad
+                        sqgrad *= beta2
+                        sqgrad += (1. - beta2)*grad*grad
+                        lrt = lr*np.sqrt(1. - beta2**t)/(1. - momentum**t)
+                        thetas -= lrt*step/(np.sqrt(sqgrad) + eps)
+                    else:
+                        step *= momentum
+                        step -= lr*grad
+                        thetas += step
+
+                stop = False
+                if validation is None:
+                    if verbose:
+                        sys.stdout.write("\r\t(fit %s) NN.fit epoch %s " % (self.nfit, epoch))
+                        sys.stdout.flush()
+                else:
+                    cost = self.costFunction(thetas, validation[0], validation[1], 0., verbose=False)
+                    if verbose:
+                        sys.stdout.write("\r\t(fit %s) NN.fit epoch %s, validation Cost %12.7f "
+                                         % (self.nfit, epoch, cost))
+                        sys.stdout.flush()
+                    if cost < best_cost:
+                        best_cost = cost
+                        best_thetas = thetas.copy()
+                        nbad = 0
+                    else:
+                        nbad += 1
+                        stop = nbad >= patience
+                if ckpt is not None and ckpt.due():
+                    save(epoch + 1, random_state(loader))
+                if stop:
+                    break
+        except KeyboardInterrupt:
+            #redo the interrupted epoch on resume
+            if ckpt is not None:
+                save(epoch, rstate)
+            self.clear_cache()
+            raise
+        if ckpt is not None:
+            ckpt.remove()
+
+        if best_thetas is not None:
+            thetas = best_thetas
+        self.unflatten_thetas(thetas)
+        self.clear_cache()
+        return thetas
+
     def predict(self, X):
         """
         Given a list of samples, predict their class.
@@ -641,20 +1259,9 @@ class NeuralNetwork(BaseEstimator):
         y = [nsamples]
         
         """
-        if isinstance(X, type([])):
-            X = np.array(X)
-        if len(X.shape) == 2:
-            N = X.shape[0] 
-        else:
-            N = 1
-
-        z, h  = self.forward_propagate(X)
         #find most-active label
-        if N == 1:
-            cls = np.array([h.argmax()])
-        else:
-            cls = h.argmax(axis=1)
-        return cls
+        #(the samples are propagated in blocks, through preallocated arrays)
+        return self.predict_proba_batch(X, dtype=np.float64).argmax(axis=1)
     
     def predict_proba(self, X):
         """
@@ -671,19 +1278,60 @@ class NeuralNetwork(BaseEstimator):
             the model, where classes are ordered by arithmetical
             order.
 
+        """
+        return self.predict_proba_batch(X, dtype=np.float64)
+
+    def predict_proba_batch(self, X, block_size=8192, dtype=np.float32):
+        """
+        predict_proba for large sample matrices: the samples are propagated
+        block_size at a time through preallocated activation arrays
+        (with the bias columns written once), so the memory used doesn't 
+        grow with the number of samples beyond the returned probabilities.
+
+        Args:
+        X : [nsamples x nfeatures] (eg. a memory-mapped feature store)
+        block_size : number of samples propagated at once
+        dtype : dtype of the computation and the result, default float32
+
+        returns:
+        [nsamples x nclasses] normalized class probabilities
+
         """
         if isinstance(X, type([])):
             X = np.array(X)
-        if len(X.shape) == 2:
-            N = X.shape[0] 
-        else:
-            N = 1
-
-        z, h  = self.forward_propagate(X)
-        norm = h.sum(axis=1)
-        for ni, nv in enumerate(norm):
-            h[ni] = h[ni] / nv
-        return h
+        if X.ndim == 1:
+            X = X[np.newaxis, :]
+        N = X.shape[0]
+        nl = len(self.layers)
+        thetas = [lv.theta.astype(dtype) for lv in self.layers]
+        proba = np.empty((N, thetas[-1].shape[1]), dtype=dtype)
+
+        nb = max(1, min(block_size, N))
+        acts = []
+        zs = []
+        for theta in thetas:
+            a = np.empty((nb, theta.shape[0]), dtype=dtype)
+            a[:, 0] = 1.
+            acts.append(a)
+            zs.append(np.empty((nb, theta.shape[1]), dtype=dtype))
+
+        for bi in range(0, N, nb):
+            n = min(nb, N - bi)
+            a = acts[0][:n]
+            a[:, 1:] = X[bi:bi+n]
+            for li, theta in enumerate(thetas):
+                if li == nl - 1:
+                    #the output layer goes straight into the result
+                    z = proba[bi:bi+n]
+                    _backend['matmult'](a, theta, z)
+                    sigmoid(z, out=z)
+                else:
+                    z = zs[li][:n]
+                    _backend['matmult'](a, theta, z)
+                    a = acts[li+1][:n]
+                    sigmoid(z, out=a[:, 1:])
+            z /= z.sum(axis=1)[:, np.newaxis]
+        return proba
 
     def score_weiwei(self, X, y, verbose=None):
         """
@@ -758,6 +1406,11 @@ class NeuralNetwork(BaseEstimator):
         
         Note: if Xval == None, then we assume (X,y) is the entire set of data,
               and we split them up using split_data(data,target)
+              The fits for the different training sizes run in parallel
+              (on copies of this network, which is left untouched).
+              They start from random thetas: a warm start from weights
+              fit to more data would bias the training curve.
+              The smallest training set holds every class (see min_training_size).
 
         returns three vectors of length(ntrials):
         error_train : training error for the N=length(pct*X) 
@@ -777,27 +1430,32 @@ class NeuralNetwork(BaseEstimator):
            or increase the regularization parameter)
 
         """
-        if Xval == None:
+        from ubc_AI.threadit import threadit
+        if Xval is None:
             X, y, Xval, yval = split_data(X, y, pct=pct)
 
         if gamma == None:
             gamma = self.gamma
 
         m = X.shape[0]
-#need at least one training item...
+#need at least two training items, and every class
         stepsize = max(m/25,1)
-        ntrials = range(1,m,stepsize)
-        mm = len(ntrials)
-        t_error = np.zeros(mm)
-        v_error = np.zeros(mm)
-        for i, v in enumerate(ntrials):
+        ntrials = range(max(min_training_size(y, yval), 2) - 1, m, stepsize)
+
+        def trial(v, seed):
+            np.random.seed(seed)
+            nn = deepcopy(self)
             #fit with regularization
-            self.fit(X[0:v+1], y[0:v+1], gamma=gamma, maxiter=50, raninit=True)
-            
+            nn.fit(X[0:v+1], y[0:v+1], gamma=gamma, maxiter=50, raninit=True)
             # but compute error without regularization
-            t_error[i] = self.costFunctionU(X[0:v+1], y[0:v+1], gamma=0.)
             # use entire x-val set
-            v_error[i] = self.costFunctionU(Xval, yval, gamma=0.)
+            return (nn.costFunctionU(X[0:v+1], y[0:v+1], gamma=0.),
+                    nn.costFunctionU(Xval, yval, gamma=0.))
+
+        seeds = np.random.randint(0, 2**31 - 1, len(ntrials))
+        resultdict = threadit(trial, zip(ntrials, seeds))
+        t_error = np.array([resultdict[i][0] for i in range(len(ntrials))])
+        v_error = np.array([resultdict[i][1] for i in range(len(ntrials))])
             
         if plot:
             plt.plot(ntrials, t_error, 'r+', label='training')
@@ -814,7 +1472,8 @@ class NeuralNetwork(BaseEstimator):
                          yval=None,
                          gammas=None,
                          pct=0.6,
-                         plot=False):
+                         plot=False,
+                         warm_start=True):
         """
         use a cross-validation set to evaluate various regularization 
         parameters (gamma)
@@ -834,31 +1493,47 @@ class NeuralNetwork(BaseEstimator):
                 default None uses
                 [0., 0.0001, 0.0005, 0.001, 0.05, 0.1, .5, 1, 1.5, 15]
         plot : False/[True] optionally plot the validation cure
+        warm_start : [True]/False, fit once (with self.gamma) and start the fit 
+                     for every gamma from those thetas, otherwise start from random thetas
         
         Note: if Xval == None, then we assume (X,y) is the entire set of data,
               and we split them up using split_data(data,target)
               Again, we train with regularization, but the erorr
               is calculated without
+              The fits for the different gammas run in parallel
+              (on copies of this network, which is left untouched).
 
         returns:
         train_error(gamma), cross_val_error(gamma), gamma, best_gamma
 
         """
-        if Xval == None:
+        from ubc_AI.threadit import threadit
+        if Xval is None:
             X, y, Xval, yval = split_data(X, y, pct)
         
         if gammas == None:
             gammas = [0., 0.0001, 0.0005, 0.001, 0.05, 0.1, .5, 1., 1.5, 15.]
-        
-        train_error = np.zeros(len(gammas))
-        xval_error = np.zeros(len(gammas))
-        for gi, gv in enumerate(gammas):
+        #every class of the cross-validation set must be in the training set
+        min_training_size(y, yval)
+
+        #the same training data for every gamma: a common starting point is valid
+        ref = deepcopy(self)
+        if warm_start:
+            ref.fit(X, y, maxiter=40, raninit=True)
+
+        def trial(gv, seed):
+            np.random.seed(seed)
+            nn = deepcopy(ref)
 #train with reg.
-            self.fit(X, y, gamma=gv, maxiter=40, raninit=True)
-           
+            nn.fit(X, y, gamma=gv, maxiter=40, raninit=not warm_start)
 #evaluate error without reg. 
-            train_error[gi] = self.costFunctionU(X, y, gamma=0.)
-            xval_error[gi] = self.costFunctionU(Xval, yval, gamma=0.)
+            return (nn.costFunctionU(X, y, gamma=0.),
+                    nn.costFunctionU(Xval, yval, gamma=0.))
+
+        seeds = np.random.randint(0, 2**31 - 1, len(gammas))
+        resultdict = threadit(trial, zip(gammas, seeds))
+        train_error = np.array([resultdict[i][0] for i in range(len(gammas))])
+        xval_error = np.array([resultdict[i][1] for i in range(len(gammas))])
 
         if plot:
             plt.plot(gammas, train_error, label='Train')
@@ -1054,8 +1729,9 @@ def checkGradients(nin=3, nout=3, ninternal=np.array([5]),
 #labels from 0 <= y < nlabels = nout
     y =  np.array(np.random.uniform(0, nout, Nsamples), dtype=int)
 
-# neural network, delta=0 and thetas=[] --> theta is randomly inited.
-    nn = create_NN(nin, nout, ninternal=ninternal, thetas=np.array([]), delta=0)
+# neural network, theta is randomly inited.
+    nn = NeuralNetwork(gamma=gamma, design=list(ninternal))
+    nn.create_layers(nin, nout)
 
     numgrad = nn.numericalGradients(X, y)
     grad = nn.gradientU(X, y, gamma)
@@ -1122,7 +1798,8 @@ def feature_curve(feature,
                   bounds=None,
                   Npts=10,
                   plot=False,
-                  pct=0.4):
+                  pct=0.4,
+                  verbose=False):
     """
     returns the training and cross validation set errors
     for a range of sizes of a given feature.
@@ -1142,16 +1819,18 @@ def feature_curve(feature,
                    only if Xval = None
                    default pct = 0.6
     plot : False/[True] optionally plot the learning curve
+    verbose : print the errors of every feature size
     
     Note: if Xval == None, then we assume (X,y) is the entire set of data,
           and we split them up using split_data(data,target)
+          The feature sizes are extracted and fit in parallel
+          (different input sizes, so there is no warm start).
 
-    returns three vectors of length(ntrials):
+    returns:
     train_score: training error for the N=length(pct*X) 
     test_score: error on x-val data, when trainined on "i" samples
-    ntrials
-
     vals = values of feature sizes (e.g. 8 -- 32)
+    the feature size with the lowest test error
 
     notes:
     * a high error indicates lots of bias,
@@ -1175,23 +1854,26 @@ def feature_curve(feature,
     else:
         vals = mgrid[bounds[0]:bounds[1]:1j*Npts]
 
-    kws = {'phasebins':0}
-    train_score = np.zeros_like(vals)
-    test_score = np.zeros_like(vals)
-    for i, val in enumerate(vals):
+    from ubc_AI.threadit import threadit
+    def trial(i, val, seed):
+        np.random.seed(seed)
+        kws = {'phasebins':0}
         kws[feature] = int(val)
         data = [pf.getdata(**kws) for pf in pfds]
         train_data, train_target, test_data, test_target = split_data(data,target, pct=pct)
-        classifier = create_NN(train_data,train_target,
-                               ninternal=[9],
-                               gamma=0.00025)
-        print "\nfeature idx, size, data_shape: %s, %s, %s" %\
-            (i, int(val),train_data.shape)
-
+        classifier = NeuralNetwork(design=[9], gamma=0.00025)
         classifier.fit(train_data,train_target,maxiter=2222,raninit=True)
 #record erro
-        train_score[i] = 1-classifier.score(train_data, train_target)
-        test_score[i] = 1-classifier.score(test_data, test_target)
+        return (1-classifier.score(train_data, train_target),
+                1-classifier.score(test_data, test_target))
+
+    seeds = np.random.randint(0, 2**31 - 1, len(vals))
+    resultdict = threadit(trial, [[i, v, s] for i, (v, s) in enumerate(zip(vals, seeds))])
+    train_score = np.array([resultdict[i][0] for i in range(len(vals))])
+    test_score = np.array([resultdict[i][1] for i in range(len(vals))])
+    if verbose:
+        for val, tr, te in zip(vals, train_score, test_score):
+            print "%s %s: training error %.4f, x-val error %.4f" % (feature, int(val), tr, te)
     if plot:
         plt.plot(vals, train_score, 'r+', label='training')
         plt.plot(vals, test_score, 'bx', label='x-val')
@@ -1199,7 +1881,7 @@ def feature_curve(feature,
         plt.ylabel('error')
         plt.legend()
         plt.show()
-    return train_score, test_score, vals, vals[test_score.argmax()]
+    return train_score, test_score, vals, vals[test_score.argmin()]
 
 
 def labels2vectors(y, Nclass=1):
@@ -1231,24 +1913,24 @@ def labels2vectors(y, Nclass=1):
 
 
 # map labels onto column vectors
+    y = np.asarray(y, dtype=np.intp).ravel()
     if N == 1:
         yy = np.zeros(nclass, dtype=np.uint8)
+        yy[y[0]] = 1
     else:
         yy = np.zeros((nclass, N), dtype=np.uint8)
-
-    for yi, yv in enumerate(y):
-        if N == 1:
-            yy[yv] = 1
-        else:
-            yy[yv, yi] = 1
+        yy[y, np.arange(N)] = 1
     return yy
 
-def sigmoid(z):
+def sigmoid(z, out=None):
     """
     compute element-wise the sigmoid of input array
+    (using the selected backend, see set_backend)
+
+    out : optional array to write the result into (may be z itself)
 
     """
-    return 1./(1.0 + np.exp(-z))
+    return _backend['sigmoid'](z, out)
 
 def sigmoidGradient(z):
     """
@@ -1257,6 +1939,61 @@ def sigmoidGradient(z):
     """
     return sigmoid(z) * (1-sigmoid(z))
         
+def learning_rate_schedule(lr0, epoch, schedule=None):
+    """
+    the learning rate for this epoch of minibatch training
+
+    Args:
+    lr0 : the initial learning rate
+    epoch : the epoch number (starting at 0)
+    schedule : None (constant), 'step' (halve every 10 epochs), 
+               'inverse' (lr0/(1+epoch/10)), or a function f(epoch, lr0)
+
+    """
+    if schedule is None or schedule == 'constant':
+        return lr0
+    elif schedule == 'step':
+        return lr0 * 0.5**(epoch//10)
+    elif schedule == 'inverse':
+        return lr0 / (1. + epoch/10.)
+    elif callable(schedule):
+        return schedule(epoch, lr0)
+    else:
+        raise ValueError("unknown lr_schedule %s" % schedule)
+
+class minibatcher(object):
+    """
+    serve (shuffled) minibatches of an in-memory training set,
+    with the same interface as ubc_AI.augment.shiftbatches
+
+    Usage:
+    for Xb, yb in minibatcher(X, y).minibatches(100):
+        ...
+
+    """
+    def __init__(self, data, target, rng=None):
+        self.data = np.asarray(data)
+        self.target = np.asarray(target)
+        if rng is None:
+            rng = np.random
+        self.rng = rng
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def minibatches(self, batch_size, shuffle=True):
+        """
+        yield (Xbatch, ybatch) minibatches covering one epoch
+
+        """
+        if shuffle:
+            order = self.rng.permutation(len(self))
+        else:
+            order = np.arange(len(self))
+        for bi in range(0, order.size, batch_size):
+            rows = order[bi:bi+batch_size]
+            yield self.data[rows], self.target[rows]
+
 def split_data(data, target, pct=0.6):
     """
     Given some complete set of data and their targets,
@@ -1265,6 +2002,7 @@ def split_data(data, target, pct=0.6):
     Args:
     data = input data
     target = data classifications
+             (or 2D (nsamples, nclasses) soft targets, split by their argmax class)
     pct = 0 < pct < 1, default 0.6
 
     returns:
@@ -1274,6 +2012,8 @@ def split_data(data, target, pct=0.6):
     from random import shuffle
     if isinstance(data,type([])):
         data = np.array(data)
+    target = np.asarray(target)
+    labels = target.argmax(axis=1) if target.ndim == 2 else target
 
     L = len(target)
     index = range(L)
@@ -1289,7 +2029,7 @@ def split_data(data, target, pct=0.6):
         test_data = data[test_idx]
         
 # make sure training has samples from all classes
-        if len(np.unique(training_target)) == len(np.unique(target)):
+        if len(np.unique(labels[training_idx])) == len(np.unique(labels)):
             break
 
     return training_data, training_target, test_data, test_target
@@ -0,0 +1,377 @@
+"""
+A module for post-training int8 quantization of the trained
+NeuralNetwork (pnnclf) and MetaCNN (cnnclf, mcnnclf) members, for scoring at survey scale.
+
+The weights are stored as int8, with one scale per output channel
+(neuron, or convolution kernel), and the activations are rounded to an int8 grid
+a ~ (aq - zero)*scale: per sample, from its range, for the input features, the full
+[-128, 127] range over [0, 1] for the sigmoid activations, and a fixed 1/127 for tanh.
+The int8 x int8 products are accumulated in int32.
+The forward passes are plain numpy, so scoring doesn't need theano.
+
+Notes:
+The gain is the size of the members (the pickled ensemble, and the weights in memory,
+about 4x smaller than float32). numpy has no integer BLAS, so the int8 forward pass
+is *slower* than the float one; accuracy_report prints both latencies.
+
+Usage:
+qclf = quantize(clf)           #a trained pnnclf/cnnclf/mcnnclf
+qclf.predict_proba(pfds)
+accuracy_report(clf, qclf, pfds, target)
+#or the whole ensemble:
+cAI.list_of_AIs = [quantize(clf) for clf in cAI.list_of_AIs]
+
+"""
+import time
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy.special import expit
+
+
+def quantize_weights(W):
+    """
+    quantize W to int8, with one scale per output channel (column)
+
+    Args:
+    W : [ninputs x noutputs] weights
+
+    returns:
+    (Wq, scale) : the [ninputs x noutputs] int8 weights, and the [noutputs] float32 scales,
+                  W ~ Wq * scale
+
+    """
+    W = np.asarray(W, dtype=np.float64)
+    scale = np.abs(W).max(axis=0) / 127.
+    scale[scale == 0] = 1.
+    Wq = np.clip(np.rint(W / scale), -127, 127).astype(np.int8)
+    return Wq, scale.astype(np.float32)
+
+
+def quantize_activations(a, scale=None, zero=0):
+    """
+    round the activations to the int8 grid a ~ (aq - zero) * scale
+
+    Args:
+    a : [nsamples x nfeatures] activations
+    scale, zero : the fixed grid of bounded activations
+                  (1/255 and -128 for sigmoid's [0, 1], 1/127 and 0 for tanh),
+                  default scale None = one grid per sample, spanning its range (and 0)
+
+    returns:
+    (aq, scale, zero) : int8 activations in [-128, 127], the scale ([nsamples x 1] float32,
+                        or the fixed scale) and the int32 zero-point (same shape)
+
+    """
+    if scale is None:
+        lo = np.minimum(a.min(axis=1), 0)[:, np.newaxis]
+        hi = np.maximum(a.max(axis=1), 0)[:, np.newaxis]
+        scale = (hi - lo) / 255.
+        scale[scale == 0] = 1.
+        zero = np.clip(np.rint(-128 - lo / scale), -128, 127)
+    aq = np.clip(np.rint(a / scale) + zero, -128, 127).astype(np.int8)
+    return aq, np.asarray(scale, dtype=np.float32), np.asarray(zero, dtype=np.int32)
+
+
+def int8_dot(aq, wq):
+    """
+    the int8 product aq.wq, accumulated in int32
+    (in one pass, without upcast copies of the operands)
+
+    Args:
+    aq : [n x K] int8
+    wq : [K x m] int8
+
+    returns:
+    [n x m] int32 array
+
+    """
+    return np.einsum('ij,jk->ik', aq, wq, dtype=np.int32)
+
+
+class qlinear(object):
+    """
+    an int8 linear map z = a.W + b (bias kept in float32)
+
+    """
+    def __init__(self, W, b):
+        self.wq, self.wscale = quantize_weights(W)
+        #for the zero-point of the activations
+        self.wsum = self.wq.sum(axis=0, dtype=np.int32)
+        self.b = np.asarray(b, dtype=np.float32).ravel()
+
+    def nbytes(self):
+        """ size of the quantized parameters [bytes] """
+        return self.wq.nbytes + self.wscale.nbytes + self.b.nbytes
+
+    def __call__(self, aq, ascale, zero=0):
+        """
+        Args:
+        aq : [n x K] int8-grid activations (see quantize_activations)
+        ascale, zero : their scale and zero-point, [n x 1] or scalars
+
+        returns: [n x m] float32 z = a.W + b
+        """
+        acc = int8_dot(aq, self.wq)
+        if np.any(zero):
+            acc -= zero * self.wsum
+        return (acc * (ascale * self.wscale) + self.b).astype(np.float32)
+
+
+class qconv(object):
+    """
+    an int8 convolution + max-pooling layer (as sktheano_cnn.LeNetConvPoolLayer,
+    before its tanh), on images stored [n x rows x cols x channels]
+
+    """
+    def __init__(self, W, b, poolsize):
+        """
+        W : theano's [nkerns x nchannels x fx x fy] filters
+        b : [nkerns] bias
+        poolsize : (px, py) max-pooling
+        """
+        K, C, fx, fy = W.shape
+        #theano's conv2d convolves (flips the filters), we correlate image patches
+        Wc = np.asarray(W)[:, :, ::-1, ::-1].transpose(2, 3, 1, 0).reshape(fx*fy*C, K)
+        self.linear = qlinear(Wc, b)
+        self.fshape = (fx, fy)
+        self.poolsize = tuple(poolsize)
+
+    def nbytes(self):
+        return self.linear.nbytes()
+
+    def __call__(self, xq, ascale, zero=0):
+        """
+        Args:
+        xq : [n x rows x cols x channels] int8-grid images
+        ascale, zero : their scale and zero-point, [n x 1] or scalars
+
+        returns: [n x prows x pcols x nkerns] pooled float32 maps
+        """
+        n, H, W, C = xq.shape
+        fx, fy = self.fshape
+        Ho, Wo = H - fx + 1, W - fy + 1
+        st = xq.strides
+        #the image patches, one row per output pixel
+        cols = as_strided(xq, shape=(n, Ho, Wo, fx, fy, C),
+                          strides=(st[0], st[1], st[2], st[1], st[2], st[3]))
+        cols = cols.reshape(n*Ho*Wo, fx*fy*C)
+        if np.ndim(ascale):
+            ascale = np.repeat(ascale, Ho*Wo, axis=0)
+        if np.ndim(zero):
+            zero = np.repeat(zero, Ho*Wo, axis=0)
+        #(the bias commutes with the max-pooling)
+        z = self.linear(cols, ascale, zero).reshape(n, Ho, Wo, -1)
+        px, py = self.poolsize
+        Hp, Wp = Ho // px, Wo // py
+        z = z[:, :Hp*px, :Wp*py].reshape(n, Hp, px, Wp, py, -1)
+        return z.max(axis=4).max(axis=2)
+
+
+class QuantizedNN(object):
+    """
+    int8 copy of a trained pulsar_nnetwork.NeuralNetwork
+
+    """
+    def __init__(self, nn):
+        #theta[0] is the bias
+        self.layers = [qlinear(lv.theta[1:], lv.theta[0]) for lv in nn.layers]
+
+    def nbytes(self):
+        """ size of the quantized parameters [bytes] """
+        return sum([l.nbytes() for l in self.layers])
+
+    def predict_proba(self, X, block_size=8192):
+        """
+        [nsamples x nclasses] normalized class probabilities,
+        as NeuralNetwork.predict_proba
+        """
+        X = np.atleast_2d(X)
+        N = X.shape[0]
+        proba = np.empty((N, self.layers[-1].b.size), dtype=np.float32)
+        for bi in range(0, N, block_size):
+            aq, s, zero = quantize_activations(np.asarray(X[bi:bi+block_size], dtype=np.float32))
+            for li, layer in enumerate(self.layers):
+                a = expit(layer(aq, s, zero))
+                if li < len(self.layers) - 1:
+                    aq, s, zero = quantize_activations(a, 1./255, -128)
+            proba[bi:bi+block_size] = a / a.sum(axis=1)[:, np.newaxis]
+        return proba
+
+    def predict(self, X):
+        return self.predict_proba(X).argmax(axis=1)
+
+
+class QuantizedCNN(object):
+    """
+    int8 copy of a trained sktheano_cnn.MetaCNN
+
+    """
+    def __init__(self, cnn):
+        W3, b3, W2, b2, W1, b1, W0, b0 = [p.get_value() for p in cnn.cnn.params]
+        if isinstance(cnn.n_in, (tuple, list)):
+            self.shape = tuple(cnn.n_in)
+        else:
+            self.shape = (cnn.n_in, cnn.n_in)
+        self.n_channels = getattr(cnn, 'n_channels', 1)
+        self.conv = [qconv(W0, b0, cnn.poolsize[0]), qconv(W1, b1, cnn.poolsize[1])]
+        self.hidden = qlinear(W2, b2)
+        self.logreg = qlinear(W3, b3)
+
+    def nbytes(self):
+        """ size of the quantized parameters [bytes] """
+        return sum([l.nbytes() for l in self.conv + [self.hidden, self.logreg]])
+
+    def predict_proba(self, X, block_size=64):
+        """
+        [nsamples x nclasses] class probabilities, as MetaCNN.predict_proba
+        (block_size samples at a time, the image patches of a block take
+         block_size*rows*cols*fx*fy*channels*4 bytes)
+        """
+        X = np.atleast_2d(X)
+        N = X.shape[0]
+        nx, ny = self.shape
+        proba = np.empty((N, self.logreg.b.size), dtype=np.float32)
+        for bi in range(0, N, block_size):
+            x = np.asarray(X[bi:bi+block_size], dtype=np.float32)
+            n = x.shape[0]
+            aq, s, zero = quantize_activations(x)
+            aq = aq.reshape(n, self.n_channels, nx, ny).transpose(0, 2, 3, 1).copy()
+            for conv in self.conv:
+                a = np.tanh(conv(aq, s, zero))
+                aq, s, zero = quantize_activations(a, 1./127)
+            #flatten in theano's (kernel, row, col) order
+            aq = aq.transpose(0, 3, 1, 2).reshape(n, -1)
+            aq, s, zero = quantize_activations(np.tanh(self.hidden(aq, s)), 1./127)
+            z = self.logreg(aq, s)
+            z = np.exp(z - z.max(axis=1)[:, np.newaxis])
+            proba[bi:bi+n] = z / z.sum(axis=1)[:, np.newaxis]
+        return proba
+
+    def predict(self, X):
+        return self.predict_proba(X).argmax(axis=1)
+
+
+class quantized(object):
+    """
+    a quantized ensemble member: scores the pfds like the trained
+    pnnclf/cnnclf/mcnnclf it was made from (same feature), with its int8 copy.
+    Only the feature, the PCA (if used) and the int8 weights are pickled.
+
+    """
+    def __init__(self, clf):
+        from ubc_AI import sktheano_cnn as skcnn
+        from ubc_AI import pulsar_nnetwork as pnn
+        if isinstance(clf, skcnn.MetaCNN):
+            self.model = QuantizedCNN(clf)
+        elif isinstance(clf, pnn.NeuralNetwork):
+            self.model = QuantizedNN(clf)
+        else:
+            raise ValueError("can only quantize NeuralNetwork and MetaCNN members, not %s" % type(clf))
+        self.member_class = clf.__class__
+        self.feature = clf.feature
+        self.use_pca = getattr(clf, 'use_pca', False)
+        if self.use_pca:
+            self.pca = clf.pca
+
+    def extractor(self):
+        """
+        an (untrained) instance of the member's class, for its getfeatures
+        """
+        if getattr(self, '_extractor', None) is None:
+            ext = self.member_class.__new__(self.member_class)
+            ext.feature = self.feature
+            self._extractor = ext
+        return self._extractor
+
+    def getfeatures(self, pfds):
+        return self.extractor().getfeatures(pfds)
+
+    def predict_proba_features(self, data):
+        if self.use_pca:
+            data = self.pca.transform(data)
+        return self.model.predict_proba(data)
+
+    def predict_proba(self, pfds):
+        if not type(pfds) in [list, np.ndarray]:
+            pfds = [pfds]
+        return self.predict_proba_features(self.getfeatures(pfds))
+
+    def predict_features(self, data):
+        return self.predict_proba_features(data).argmax(axis=1)
+
+    def predict(self, pfds):
+        if not type(pfds) in [list, np.ndarray]:
+            pfds = [pfds]
+        return self.predict_features(self.getfeatures(pfds))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_extractor', None)
+        return state
+
+
+def quantize(clf):
+    """
+    return the quantized copy of a trained pnnclf/cnnclf/mcnnclf member,
+    other classifiers are returned as they are
+
+    """
+    try:
+        return quantized(clf)
+    except ValueError:
+        return clf
+
+
+def accuracy_report(clf, qclf, pfds, target, verbose=True):
+    """
+    compare the scores of a quantized member with the float member's, on a labelled set
+
+    Args:
+    clf : the trained (float) member
+    qclf : its quantized copy (from quantize(clf))
+    pfds : the labelled pfds
+    target : their labels (pulsars are class 1)
+    verbose : print the report
+
+    returns:
+    dictionary of
+      'max_dscore', 'mean_dscore' : largest and mean |quantized - float| pulsar score
+      'agreement' : fraction of identical predictions
+      'F1', 'qF1' : F1 score of the float and quantized predictions
+      'time', 'qtime' : predict_proba time [s] of the float and quantized members (given the features)
+      'latency', 'qlatency' : the same per sample [s]
+      'nbytes', 'qnbytes' : size of the float and quantized parameters [bytes]
+
+    """
+    from ubc_AI.data import F1score
+    target = np.asarray(target)
+    if target.ndim > 1:
+        target = target[..., 0]
+    data = clf.getfeatures(pfds)
+    t0 = time.time()
+    p = clf.predict_proba_features(data)
+    t1 = time.time()
+    qp = qclf.predict_proba_features(data)
+    t2 = time.time()
+
+    pred, qpred = p.argmax(axis=1), qp.argmax(axis=1)
+    dscore = np.abs(qp[:, 1] - p[:, 1])
+    if hasattr(clf, 'cnn'):
+        nbytes = sum([prm.get_value(borrow=True).nbytes for prm in clf.cnn.params])
+    else:
+        nbytes = sum([lv.theta.nbytes for lv in clf.layers])
+    report = {'max_dscore': dscore.max(), 'mean_dscore': dscore.mean(),
+              'agreement': np.mean(pred == qpred),
+              'F1': F1score(pred, target), 'qF1': F1score(qpred, target),
+              'time': t1 - t0, 'qtime': t2 - t1,
+              'latency': (t1 - t0)/len(target), 'qlatency': (t2 - t1)/len(target),
+              'nbytes': nbytes, 'qnbytes': qclf.model.nbytes()}
+    if verbose:
+        print "%s %s, %s samples" % (clf.__class__.__name__, clf.feature, len(target))
+        print "prediction agreement: %.4f, score difference: max %.4f, mean %.5f" % \
+            (report['agreement'], report['max_dscore'], report['mean_dscore'])
+        print "F1: float %.4f, int8 %.4f" % (report['F1'], report['qF1'])
+        print "latency: float %.3gms, int8 %.3gms per sample (total %.3fs, %.3fs)" % \
+            (1e3*report['latency'], 1e3*report['qlatency'], report['time'], report['qtime'])
+        print "size: float %s bytes, int8 %s bytes" % (report['nbytes'], report['qnbytes'])
+    return report
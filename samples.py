@@ -42,7 +42,8 @@ from scipy import ndimage, array, ogrid, mgrid
 
 def downsample(a, n, align=0):
     '''a: input array of 1-3 dimentions
-       n: downsample to n bins
+       n: downsample to n bins,
+          or (rows, cols) for 2D arrays (eg. keep the native 32 subints x 64 phase bins)
        optional:
        align : if non-zero, downsample grid (coords) 
                will have a bin at same location as 'align'
@@ -62,18 +63,26 @@ def downsample(a, n, align=0):
             coords = mgrid[0:1-1./n:1j*n]
         elif D == 2:
             d1,d2 = shape
+            if isinstance(n, tuple):
+                n1, n2 = n
+            else:
+                n1, n2 = n, n
+            if isinstance(n, tuple) and (n1, n2) == (d1, d2):
+                #already the requested native (rows, cols) 
+                #(integer n keeps the interpolation, so square features are unchanged)
+                return np.array(a, dtype=float)
             if align: 
                 #original phase bins
                 x2 = mgrid[0:1.-1./d2:1j*d2]
                 #downsampled phase bins
-                crd = mgrid[0:1-1./n:1j*n]
+                crd = mgrid[0:1-1./n2:1j*n2]
                 crd += x2[align]
                 crd = (crd % 1)
                 crd.sort()
                 offset = crd[0]*d2
-                coords = mgrid[0:d1-1:1j*n, offset:d2-float(d2)/n+offset:1j*n]
+                coords = mgrid[0:d1-1:1j*n1, offset:d2-float(d2)/n2+offset:1j*n2]
             else:
-                coords = mgrid[0:d1-1:1j*n, 0:d2-1:1j*n]
+                coords = mgrid[0:d1-1:1j*n1, 0:d2-1:1j*n2]
         elif D == 3:
             d1,d2,d3 = shape
             coords = mgrid[0:d1-1:1j*n, 0:d2-1:1j*n, 0:d3-1:1j*n]
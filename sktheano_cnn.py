@@ -13,7 +13,11 @@ tips/tricks/notes:
 *  
 """
 import cPickle as pickle
+import hashlib
 import logging
+import multiprocessing as MP
+import os
+import time
 import numpy as np
 from collections import OrderedDict
 
@@ -22,7 +26,7 @@ import theano
 import theano.tensor as T
 from theano.tensor.signal import downsample
 from theano.tensor.nnet import conv
-import logging
+from ubc_AI.checkpoint import random_state, set_random_state
 _logger = logging.getLogger("theano.gof.compilelock")
 _logger.setLevel(logging.WARN)
 logger = logging.getLogger(__name__)
@@ -30,6 +34,119 @@ logger = logging.getLogger(__name__)
 mode = theano.Mode(linker='cvm')
 #mode = 'DEBUG_MODE'
 
+#compiled inference functions, by architecture (see MetaCNN.proba_function)
+#kept in memory (inherited by forked threadit workers) and pickled to _cachedir
+_functions = {}
+_cachedir = os.environ.get('UBC_AI_CNN_CACHE', 
+                           os.path.join(os.path.expanduser('~'), '.ubc_AI', 'cnn_cache'))
+
+def _load_function(key):
+    """
+    return the compiled function cached (in memory or on disk) for this key, or None
+    """
+    if key in _functions:
+        return _functions[key]
+    fname = os.path.join(_cachedir, hashlib.md5(key).hexdigest() + '.pkl')
+    if not os.access(fname, os.R_OK):
+        return None
+    #skip re-optimizing the graph, it was optimized when compiled
+    reopt = getattr(theano.config, 'reoptimize_unpickled_function', None)
+    try:
+        if reopt is not None:
+            theano.config.reoptimize_unpickled_function = False
+        with open(fname, 'rb') as f:
+            fn = pickle.load(f)
+    except Exception as detail:
+        logger.warn("could not load cached function %s: %s" % (fname, detail))
+        return None
+    finally:
+        if reopt is not None:
+            theano.config.reoptimize_unpickled_function = reopt
+    _functions[key] = fn
+    return fn
+
+def _save_function(key, fn):
+    """
+    keep the compiled function in memory and (if possible) on disk
+    """
+    _functions[key] = fn
+    fname = os.path.join(_cachedir, hashlib.md5(key).hexdigest() + '.pkl')
+    try:
+        if not os.path.isdir(_cachedir):
+            os.makedirs(_cachedir)
+        tmpname = '%s.%s.tmp' % (fname, os.getpid())
+        with open(tmpname, 'wb') as f:
+            pickle.dump(fn, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, fname)
+    except (IOError, OSError) as detail:
+        logger.warn("could not cache the compiled function: %s" % detail)
+
+def _shared_array(shape, dtype):
+    """
+    numpy view of a new block of shared memory, inherited by forked processes
+    """
+    typecode = {'float32':'f', 'float64':'d', 'int32':'i'}[np.dtype(dtype).name]
+    buf = MP.RawArray(typecode, int(np.prod(shape)))
+    return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+def _replica(conn, k, grad_fn, params, bufs):
+    """
+    the loop of a MetaCNN.fit_parallel worker process.
+
+    On (start, stop) from conn: load the shared weights into this replica,
+    compute the gradient on rows start:stop of the shared batch
+    into row k of the shared gradients, and send back the loss.
+    None ends the loop.
+
+    """
+    weights, grads = bufs['weights'], bufs['grads']
+    shapes = [p.get_value(borrow=True).shape for p in params]
+    offsets = np.cumsum([0] + [int(np.prod(s)) for s in shapes])
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        start, stop = msg
+        try:
+            for p, s, o0, o1 in zip(params, shapes, offsets[:-1], offsets[1:]):
+                p.set_value(weights[o0:o1].reshape(s))
+            out = grad_fn(bufs['X'][start:stop], bufs['y'][start:stop])
+            for g, o0, o1 in zip(out[1:], offsets[:-1], offsets[1:]):
+                grads[k, o0:o1] = np.ravel(g)
+            conn.send(float(out[0]))
+        except Exception as detail:
+            conn.send(detail)
+    conn.close()
+
+def benchmark_parallel(X, y, nworkers=[1, 2, 4, 8], nbatches=20, verbose=True, **kwds):
+    """
+    time MetaCNN.fit_parallel on nbatches minibatches of (X, y) for every 
+    number of workers, to see how the training throughput scales with the cores
+
+    Args:
+    X, y : training samples and labels (a few minibatches worth is enough)
+    nworkers : list of the number of worker processes to try
+    nbatches : number of minibatches timed
+    verbose : print a table of the throughputs
+    kwds : passed on to MetaCNN (eg. batch_size=200, nkerns=[20,40])
+
+    returns:
+    dictionary {nworkers: throughput [samples/s]}
+
+    """
+    timings = {}
+    for n in nworkers:
+        cnn = MetaCNN(**kwds)
+        timings[n] = cnn.fit_parallel(X, y, nworkers=n, n_epochs=nbatches, 
+                                      max_batches=nbatches)
+    if verbose:
+        n0 = nworkers[0]
+        print "%8s %14s %8s %10s" % ('nworkers', 'samples/s', 'speedup', 'efficiency')
+        for n in nworkers:
+            speedup = timings[n]/timings[n0]
+            print "%8i %14.1f %8.2f %10.2f" % (n, timings[n], speedup, speedup*n0/n)
+    return timings
+
 class CNN(object):
     """
     Conformal Neural Network, 
@@ -41,7 +158,7 @@ class CNN(object):
     There are three layers:
     layer0 : a convolutional filter making filters[0] shifted copies,
              then downsampled by max pooling in grids of poolsize[0]
-             (N, 1, nx, ny)
+             (N, n_channels, nx, ny)
              --> (N, nkerns[0], nx1, ny1)  (nx1 = nx - filters[0][0] + 1)
                                   (ny1 = ny - filters[0][1] + 1)
              --> (N, nkerns[0], nx1/poolsize[0][1], ny1/poolsize[0][1])
@@ -61,11 +178,13 @@ class CNN(object):
                  poolsize=[(3,3),(2,2)],
                  n_hidden=500,
                  output_type='softmax', batch_size=25,
-                 use_symbolic_softmax=False):
+                 use_symbolic_softmax=False, n_channels=1):
 
         """
-        n_in : width (or length) of input image (assumed square)
+        n_in : width (or length) of input image if square, or (rows, cols) of the image
         n_out : number of class labels
+        n_channels : number of input images (channels) per sample,
+                     each sample is the n_channels images raveled one after another
         
         :type nkerns: list of ints
         :param nkerns: number of kernels on each layer
@@ -86,12 +205,16 @@ class CNN(object):
         
         :type batch_size: int
         :param batch_size: number of samples in each training batch. Default 200.
+                           (not part of the graph, which takes any number of samples)
         """    
         self.activation = activation
         self.output_type = output_type
 
         #shape of input images
-        nx, ny = n_in, n_in
+        if isinstance(n_in, (tuple, list)):
+            nx, ny = n_in
+        else:
+            nx, ny = n_in, n_in
 
         if use_symbolic_softmax:
             def symbolic_softmax(x):
@@ -101,9 +224,10 @@ class CNN(object):
         else:
             self.softmax = T.nnet.softmax
 
-        # Reshape matrix of rasterized images of shape (batch_size, nx*ny)
+        # Reshape matrix of rasterized images of shape (batch_size, n_channels*nx*ny)
         # to a 4D tensor, compatible with our LeNetConvPoolLayer
-        layer0_input = input.reshape((batch_size, 1, nx, ny))
+        # (the batch dimension is symbolic, so any number of samples can be passed)
+        layer0_input = input.reshape((input.shape[0], n_channels, nx, ny))
 
         # Construct the first convolutional pooling layer:
         # filtering reduces the image size to (nx-filx+1,ny-fily+1)
@@ -118,8 +242,8 @@ class CNN(object):
             fil1y = nim[1]
         rng = np.random.RandomState(23455)
         self.layer0 = LeNetConvPoolLayer(rng, input=layer0_input,
-                                  image_shape=(batch_size, 1, nx, ny),
-                                  filter_shape=(nkerns[0], 1, fil1x, fil1y),
+                                  image_shape=(None, n_channels, nx, ny),
+                                  filter_shape=(nkerns[0], n_channels, fil1x, fil1y),
                                          poolsize=poolsize[0])
         # Construct the second convolutional pooling layer
         # filtering reduces the image size to (nbin-nim+1,nbin-nim+1) = x
@@ -135,7 +259,7 @@ class CNN(object):
             fil2x = nconf[0]
             fil2y = nconf[1]
         self.layer1 = LeNetConvPoolLayer(rng, input=self.layer0.output,
-                image_shape=(batch_size, nkerns[0], poox, pooy),
+                image_shape=(None, nkerns[0], poox, pooy),
                 filter_shape=(nkerns[1], nkerns[0], fil2x, fil2y),
                                          poolsize=poolsize[1])
 
@@ -227,9 +351,29 @@ class CNN(object):
 class MetaCNN(BaseEstimator):
     """
     the actual CNN is not init-ed until .fit is called.
-    We determine the image input size (assumed square images) and
+    We determine the image input size (assumed square images, unless image_shape is given) and
     the number of outputs in .fit from the training data
 
+    training options:
+    update_rule : 'sgd' (default), 'momentum' or 'adam'
+    momentum : momentum of the 'momentum' rule (and Adam's beta1), default 0.9
+    lr_decay : the learning rate is multiplied by lr_decay after every epoch, default 1.
+
+    n_channels : number of same-size images per sample (eg. intervals and subbands),
+                 learnt jointly as the input channels of the first convolution, default 1.
+                 Each row of the data is the n_channels raveled images, one after another.
+                 (see ubc_AI.classifier.mcnnclf)
+    image_shape : (rows, cols) of the (non-square) input images, 
+                  eg. (32, 64) for 32 subints x 64 phase bins. 
+                  default None = square images, of the size inferred from the data
+                  (set from the feature by ubc_AI.classifier's cnnclf and mcnnclf)
+
+    checkpoint : filename to save the training state of fit to (see ubc_AI.checkpoint):
+                 the weights, the optimizer state, the epoch, early-stopping and random state,
+                 every checkpoint_interval seconds (at the end of an epoch) and when interrupted.
+                 fit resumes from it if it exists, and removes it when done. default None
+    checkpoint_interval : seconds between checkpoints, default 300
+
     """
     def __init__(self, learning_rate=0.05,
                  n_epochs=60, batch_size=25, activation='tanh', 
@@ -240,6 +384,9 @@ class MetaCNN(BaseEstimator):
                  output_type='softmax',
                  L1_reg=0.00, L2_reg=0.00,
                  use_symbolic_softmax=False,
+                 update_rule='sgd', momentum=0.9, lr_decay=1.,
+                 n_channels=1, image_shape=None,
+                 checkpoint=None, checkpoint_interval=300.,
                  ### Note, n_in and n_out are actually set in 
                  ### .fit, they are here to help cPickle
                  n_in=50, n_out=2):
@@ -255,14 +402,39 @@ class MetaCNN(BaseEstimator):
         self.activation = activation
         self.output_type = output_type
         self.use_symbolic_softmax = use_symbolic_softmax
+        self.update_rule = update_rule
+        self.momentum = float(momentum)
+        self.lr_decay = float(lr_decay)
+        self.n_channels = int(n_channels)
+        self.image_shape = image_shape
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
         self.n_in = n_in
         self.n_out = n_out
 
+    def input_shape(self, nfeatures):
+        """
+        the size of the input images (n_in of the CNN), given the number of features:
+        the image_shape if set (as a tuple), otherwise the width of the square images
+        """
+        n_channels = getattr(self, 'n_channels', 1)
+        image_shape = getattr(self, 'image_shape', None)
+        if image_shape is not None:
+            image_shape = tuple(image_shape)
+            if n_channels*image_shape[0]*image_shape[1] != nfeatures:
+                raise ValueError("%s features don't make %s images of %s" % 
+                                 (nfeatures, n_channels, image_shape))
+            return image_shape
+        return int(np.sqrt(nfeatures // n_channels))
+
     def ready(self):
         """
         this routine is called from "fit" since we determine the
         image size (assumed square) and output labels from the training data.
 
+        (only the symbolic graph is built here, the inference function
+        is compiled on first use, see proba_function)
+
         """
         #input
         self.x = T.matrix('x')
@@ -288,16 +460,58 @@ class MetaCNN(BaseEstimator):
                        poolsize=self.poolsize,
                        output_type=self.output_type,
                        batch_size=self.batch_size,
-                       use_symbolic_softmax=self.use_symbolic_softmax)
-        
-        #self.cnn.predict expects batch_size number of inputs. 
-        #we wrap those functions and pad as necessary in 'def predict' and 'def predict_proba'
-        self.predict_wrap = theano.function(inputs=[self.x],
-                                            outputs=self.cnn.y_pred,
-                                            mode=mode)
-        self.predict_proba_wrap = theano.function(inputs=[self.x],
-                                                  outputs=self.cnn.p_y_given_x,
-                                                  mode=mode)
+                       use_symbolic_softmax=self.use_symbolic_softmax,
+                       n_channels=getattr(self, 'n_channels', 1))
+        #name the weights, to bind them to cached functions
+        for pi, param in enumerate(self.cnn.params):
+            param.name = 'param%s' % pi
+        self._proba_fn = None
+
+    def architecture_key(self):
+        """
+        the hyperparameters that determine the compiled inference function
+        (the batch size is symbolic, so it is not part of the key)
+
+        """
+        return repr((tuple(self.n_in) if isinstance(self.n_in, (tuple, list)) else self.n_in,
+                     self.n_out, list(self.nkerns), list(self.filters),
+                     list(self.poolsize), self.n_hidden, self.activation, 
+                     self.output_type, self.use_symbolic_softmax,
+                     getattr(self, 'n_channels', 1), theano.config.floatX, theano.__version__))
+
+    def proba_function(self):
+        """
+        return the compiled function mapping samples to class probabilities,
+        bound to this CNN's current weights.
+
+        The function is compiled on first use, and cached by architecture 
+        in memory and on disk (in $UBC_AI_CNN_CACHE, default ~/.ubc_AI/cnn_cache), 
+        so unpickled classifiers (and threadit workers) don't recompile it.
+        A cached function is bound to the weights (shared variables) 
+        of the CNN that compiled it, so every other CNN gets its own copy
+        with those swapped for its own weights.
+
+        """
+        fn = getattr(self, '_proba_fn', None)
+        if fn is None:
+            key = self.architecture_key()
+            fn = _load_function(key)
+            if fn is None:
+                fn = theano.function(inputs=[self.x],
+                                     outputs=self.cnn.p_y_given_x,
+                                     mode=mode)
+                _save_function(key, fn)
+            weights = dict((p.name, p) for p in self.cnn.params)
+            swap = {}
+            for inp in fn.maker.inputs:
+                name = inp.variable.name
+                if inp.implicit and name in weights and inp.variable is not weights[name]:
+                    swap[inp.variable] = weights[name]
+            if swap:
+                #(the copy returns its output in a list, see predict_proba)
+                fn = fn.copy(swap=swap)
+            self._proba_fn = fn
+        return fn
 
 
     def score(self, X, y):
@@ -320,21 +534,34 @@ class MetaCNN(BaseEstimator):
 
 
     def fit(self, X_train, Y_train, X_test=None, Y_test=None,
-            validation_frequency=2, n_epochs=None):
+            validation_frequency=None, n_epochs=None, loss_decay=0.98):
         """ Fit model
 
         Pass in X_test, Y_test to compute test error and report during
         training.
 
-        X_train : ndarray (T x n_in)
+        X_train : ndarray (T x n_in), 
+                  or a minibatch loader (Y_train=None) with .minibatches(batch_size), 
+                  .data and .target (eg. ubc_AI.featurestore.streamloader)
+                  which is streamed instead of stored in a theano shared variable
         Y_train : ndarray (T x n_out)
 
         validation_frequency : int
             in terms of number of sequences (or number of weight updates)
+            between evaluations of the loss on X_test.
+            default None = once per epoch
         n_epochs : None (used to override self.n_epochs from init.
+        loss_decay : the reported training loss is a running (exponentially-weighted)
+            average of the minibatch losses, ema = loss_decay*ema + (1-loss_decay)*batch_loss,
+            bias-corrected (loss = ema/(1 - loss_decay**nbatches), as the ema starts at 0)
+            (the training set isn't re-evaluated)
         """
         #prepare the CNN 
-        self.n_in = int(np.sqrt(X_train.shape[1]))
+        streaming = hasattr(X_train, 'minibatches')
+        if streaming:
+            loader = X_train
+            X_train, Y_train = loader.data, loader.target
+        self.n_in = self.input_shape(X_train.shape[1])
         self.n_out = len(np.unique(Y_train))
         self.ready()
 
@@ -345,14 +572,17 @@ class MetaCNN(BaseEstimator):
         else:
             interactive = False
 
-        train_set_x, train_set_y = self.shared_dataset((X_train, Y_train))
-
-        n_train_batches = train_set_x.get_value(borrow=True).shape[0]
-        n_train_batches /= self.batch_size
+        #(the last batch holds the remainder)
+        n_train = len(loader) if streaming else X_train.shape[0]
+        n_train_batches = (n_train + self.batch_size - 1) // self.batch_size
+        if not streaming:
+            train_set_x, train_set_y = self.shared_dataset((X_train, Y_train))
+            #the samples of the epoch, in (shuffled) order
+            order = theano.shared(np.arange(n_train))
 
         if interactive:
-            n_test_batches = test_set_x.get_value(borrow=True).shape[0]
-            n_test_batches /= self.batch_size
+            n_test = test_set_x.get_value(borrow=True).shape[0]
+            n_test_batches = (n_test + self.batch_size - 1) // self.batch_size
 
         ######################
         # BUILD ACTUAL MODEL #
@@ -365,13 +595,6 @@ class MetaCNN(BaseEstimator):
             + self.L1_reg * self.cnn.L1\
             + self.L2_reg * self.cnn.L2_sqr
 
-        compute_train_error = theano.function(inputs=[index, ],
-                                              outputs=self.cnn.loss(self.y),
-                                              givens={
-                self.x: train_set_x[index * self.batch_size: (index + 1) * self.batch_size],
-                self.y: train_set_y[index * self.batch_size: (index + 1) * self.batch_size]},
-                                              mode=mode)
-
         if interactive:
             compute_test_error = theano.function(inputs=[index, ],
                                                  outputs=self.cnn.loss(self.y),
@@ -391,15 +614,26 @@ class MetaCNN(BaseEstimator):
         # manually create an update rule for each model parameter. We thus
         # create the updates dictionary by automatically looping over all
         # (params[i],grads[i]) pairs.
-        self.updates = OrderedDict()
-        for param_i, grad_i in zip(self.params, self.grads):
-            self.updates[param_i] = param_i - self.learning_rate * grad_i
-
-        train_model = theano.function([index], cost, updates=self.updates,
-                                      givens={
-                self.x: train_set_x[index * self.batch_size: (index + 1) * self.batch_size],
-                self.y: train_set_y[index * self.batch_size: (index + 1) * self.batch_size]}
-                                      )
+        lr = theano.shared(np.asarray(self.learning_rate, dtype=theano.config.floatX))
+        self.updates = self.get_updates(self.params, self.grads, lr)
+
+        #the training functions return the (regularized) cost and the loss of the minibatch
+        outputs = [cost, self.cnn.loss(self.y)]
+        if streaming:
+            #the minibatches are fed in directly
+            train_batch = theano.function([self.x, self.y], outputs, 
+                                          updates=self.updates, mode=mode)
+            def train_model(batch):
+                Xb, yb = batch
+                return train_batch(np.asarray(Xb, dtype=theano.config.floatX),
+                                   np.asarray(yb, dtype='int32'))
+        else:
+            batch = order[index * self.batch_size: (index + 1) * self.batch_size]
+            train_model = theano.function([index], outputs, updates=self.updates,
+                                          givens={
+                self.x: train_set_x[batch],
+                self.y: train_set_y[batch]}
+                                          )
 
         ###############
         # TRAIN MODEL #
@@ -412,11 +646,15 @@ class MetaCNN(BaseEstimator):
                                # found
         improvement_threshold = 0.995  # a relative improvement of this much is
                                        # considered significant
-        validation_frequency = min(n_train_batches, patience / 2)
+        if validation_frequency is None:
+            validation_frequency = min(n_train_batches, patience / 2)
                                   # go through this many
                                   # minibatche before checking the network
                                   # on the validation set; in this case we
                                   # check every epoch
+        validation_frequency = max(1, validation_frequency)
+        #the running training loss
+        loss_ema, nloss = 0., 0
         best_test_loss = np.inf
         best_iter = 0
         epoch = 0
@@ -425,58 +663,277 @@ class MetaCNN(BaseEstimator):
         if n_epochs is None:
             n_epochs = self.n_epochs
 
-        while (epoch < n_epochs) and (not done_looping):
-            epoch = epoch + 1
-            for idx in xrange(n_train_batches):
-
-                iter = epoch * n_train_batches + idx
-
-                cost_ij = train_model(idx)
+        #resume from the checkpoint
+        ckpt = None
+        if getattr(self, 'checkpoint', None) is not None:
+            from ubc_AI.checkpoint import checkpointer
+            ckpt = checkpointer(self.checkpoint, getattr(self, 'checkpoint_interval', 300.))
+            state = ckpt.load(architecture=self.architecture_key(),
+                              update_rule=getattr(self, 'update_rule', 'sgd'))
+            if state is not None:
+                #the weights and the optimizer's shared variables
+                for var, value in zip(self.updates, state['updates']):
+                    var.set_value(value)
+                epoch, patience = state['epoch'], state['patience']
+                best_test_loss, best_iter = state['best_test_loss'], state['best_iter']
+                loss_ema, nloss = state['train_loss']
+                set_random_state(state['random'], loader if streaming else None)
+
+        def save_checkpoint(epoch, rstate):
+            ckpt.save({'architecture':self.architecture_key(),
+                       'update_rule':getattr(self, 'update_rule', 'sgd'),
+                       'updates':[var.get_value() for var in self.updates],
+                       'epoch':epoch, 'patience':patience, 
+                       'best_test_loss':best_test_loss, 'best_iter':best_iter,
+                       'train_loss':(loss_ema, nloss), 'random':rstate})
+
+        lr_decay = getattr(self, 'lr_decay', 1.)
+        try:
+            while (epoch < n_epochs) and (not done_looping):
+                #to redo an interrupted epoch
+                rstate = random_state(loader if streaming else None)
+                lr.set_value(np.asarray(self.learning_rate * lr_decay**epoch, 
+                                        dtype=theano.config.floatX))
+                epoch = epoch + 1
+                if streaming:
+                    batches = loader.minibatches(self.batch_size)
+                else:
+                    #a new permutation every epoch
+                    order.set_value(np.random.permutation(n_train))
+                    batches = xrange(n_train_batches)
+                for idx, batch in enumerate(batches):
+
+                    iter = epoch * n_train_batches + idx
+
+                    cost_ij, loss_ij = train_model(batch)
+                    # running loss on the training set
+                    loss_ema = loss_decay*loss_ema + (1. - loss_decay)*float(loss_ij)
+                    nloss += 1
+                    this_train_loss = loss_ema/(1. - loss_decay**nloss)
                 
-                if iter % validation_frequency == 0:
-                    # compute loss on training set
-                    train_losses = [compute_train_error(i)
-                                    for i in xrange(n_train_batches)]
-                    this_train_loss = np.mean(train_losses)
-
-                    if interactive:
-                        test_losses = [compute_test_error(i)
-                                        for i in xrange(n_test_batches)]
-                        this_test_loss = np.mean(test_losses)
-                        note = 'epoch %i, seq %i/%i, tr loss %f '\
-                            'te loss %f lr: %f' % \
-                            (epoch, idx + 1, n_train_batches,
-                             this_train_loss, this_test_loss, self.learning_rate)
-                        logger.info(note)
-                        print note
-
-                        if this_test_loss < best_test_loss:
-                            #improve patience if loss improvement is good enough
-                            if this_test_loss < best_test_loss *  \
-                                    improvement_threshold:
-                                patience = max(patience, iter * patience_increase)
-
-                            # save best validation score and iteration number
-                            best_test_loss = this_test_loss
-                            best_iter = iter
-                    else:
-                        logger.info('epoch %i, seq %i/%i, train loss %f '
-                                    'lr: %f' % \
-                                    (epoch, idx + 1, n_train_batches, this_train_loss,
-                                     self.learning_rate))
-                if patience <= iter:
-                    done_looping = True
-                    break
+                    if iter % validation_frequency == 0:
+                        if interactive:
+                            #weight the (smaller) last batch by its size
+                            test_losses = [compute_test_error(i)
+                                            for i in xrange(n_test_batches)]
+                            sizes = [min(self.batch_size, n_test - i*self.batch_size)
+                                     for i in xrange(n_test_batches)]
+                            this_test_loss = np.average(test_losses, weights=sizes)
+                            note = 'epoch %i, seq %i/%i, tr loss %f '\
+                                'te loss %f lr: %f' % \
+                                (epoch, idx + 1, n_train_batches,
+                                 this_train_loss, this_test_loss, lr.get_value())
+                            logger.info(note)
+                            print note
+
+                            if this_test_loss < best_test_loss:
+                                #improve patience if loss improvement is good enough
+                                if this_test_loss < best_test_loss *  \
+                                        improvement_threshold:
+                                    patience = max(patience, iter * patience_increase)
+
+                                # save best validation score and iteration number
+                                best_test_loss = this_test_loss
+                                best_iter = iter
+                        else:
+                            logger.info('epoch %i, seq %i/%i, train loss %f '
+                                        'lr: %f' % \
+                                        (epoch, idx + 1, n_train_batches, this_train_loss,
+                                         lr.get_value()))
+                    if patience <= iter:
+                        done_looping = True
+                        break
+                if ckpt is not None and ckpt.due():
+                    save_checkpoint(epoch, random_state(loader if streaming else None))
+        except KeyboardInterrupt:
+            #redo the interrupted epoch on resume
+            if ckpt is not None:
+                save_checkpoint(max(0, epoch - 1), rstate)
+            raise
+        if ckpt is not None:
+            ckpt.remove()
+
         logger.info("Optimization complete")
         logger.info("Best xval score of %f %% obtained at iteration %i" %
                     (best_test_loss * 100., best_iter))
 
 
-    def predict(self, data):
+    def fit_parallel(self, X_train, Y_train, nworkers=None, n_epochs=None,
+                     loss_decay=0.98, max_batches=None):
+        """
+        Same as fit (without the test set), but synchronous data-parallel:
+        every minibatch is split over nworkers processes, each holding a replica of the CNN.
+        The replicas write the gradient of their slice to shared memory, 
+        and the (slice size weighted) average gradient is applied in a single update
+        of self.update_rule, so the training follows fit with the same batch_size.
+
+        Args:
+        X_train : ndarray (T x n_in), or a minibatch loader (Y_train=None) as in fit
+        Y_train : ndarray of labels
+        nworkers : number of worker processes, default number of cpus - 1
+        n_epochs : None (used to override self.n_epochs from init)
+        loss_decay : the reported training loss is a running average, as in fit
+        max_batches : stop after this many minibatches, default None (see benchmark_parallel)
+
+        returns:
+        training throughput [samples/s] of the training steps (excluding the compilation)
+
+        Notes:
+        * each worker gets batch_size/nworkers samples, so use large batches
+          (O(10) samples per worker at least) to outweigh the synchronization
+        * run with OMP_NUM_THREADS=1 so the workers don't compete for the cores with BLAS threads
+
+        """
+        streaming = hasattr(X_train, 'minibatches')
+        if streaming:
+            loader = X_train
+            X_train, Y_train = loader.data, loader.target
+        self.n_in = self.input_shape(X_train.shape[1])
+        self.n_out = len(np.unique(Y_train))
+        self.ready()
+        if nworkers is None:
+            nworkers = max(1, MP.cpu_count() - 1)
+        if n_epochs is None:
+            n_epochs = self.n_epochs
+        floatX = theano.config.floatX
+        bs = self.batch_size
+
+        cost = self.cnn.loss(self.y)\
+            + self.L1_reg * self.cnn.L1\
+            + self.L2_reg * self.cnn.L2_sqr
+        self.params = self.cnn.params
+        #the replicas: loss and gradients of a slice
+        grad_fn = theano.function([self.x, self.y], 
+                                  [self.cnn.loss(self.y)] + T.grad(cost, self.params),
+                                  mode=mode)
+        #the master: apply the averaged gradient
+        avg_grads = [theano.shared(np.zeros_like(p.get_value())) for p in self.params]
+        lr = theano.shared(np.asarray(self.learning_rate, dtype=floatX))
+        apply_update = theano.function([], [], mode=mode,
+                                       updates=self.get_updates(self.params, avg_grads, lr))
+
+        shapes = [p.get_value(borrow=True).shape for p in self.params]
+        offsets = np.cumsum([0] + [int(np.prod(s)) for s in shapes])
+        bufs = {'X': _shared_array((bs, X_train.shape[1]), floatX),
+                'y': _shared_array((bs,), np.int32),
+                'weights': _shared_array((offsets[-1],), floatX),
+                'grads': _shared_array((nworkers, offsets[-1]), floatX)}
+
+        #fork the replicas (after compiling, so they inherit grad_fn)
+        conns, procs = [], []
+        for k in range(nworkers):
+            parent, child = MP.Pipe()
+            p = MP.Process(target=_replica, args=(child, k, grad_fn, self.params, bufs))
+            p.daemon = True
+            p.start()
+            conns.append(parent)
+            procs.append(p)
+
+        n_train = len(loader) if streaming else X_train.shape[0]
+        n_train_batches = (n_train + bs - 1) // bs
+        lr_decay = getattr(self, 'lr_decay', 1.)
+        loss_ema, nloss = 0., 0
+        nbatches, nseen, t_train = 0, 0, 0.
+        try:
+            for epoch in range(n_epochs):
+                lr.set_value(np.asarray(self.learning_rate * lr_decay**epoch, dtype=floatX))
+                if streaming:
+                    batches = loader.minibatches(bs)
+                else:
+                    perm = np.random.permutation(n_train)
+                    batches = ((X_train[perm[i:i+bs]], Y_train[perm[i:i+bs]])
+                               for i in xrange(0, n_train, bs))
+                for idx, (Xb, yb) in enumerate(batches):
+                    t0 = time.time()
+                    nb = len(yb)
+                    bufs['X'][:nb] = Xb
+                    bufs['y'][:nb] = yb
+                    for p, o0, o1 in zip(self.params, offsets[:-1], offsets[1:]):
+                        bufs['weights'][o0:o1] = p.get_value(borrow=True).ravel()
+                    #split the batch over the replicas
+                    bounds = np.linspace(0, nb, nworkers + 1).astype(int)
+                    active = [k for k in range(nworkers) if bounds[k+1] > bounds[k]]
+                    for k in active:
+                        conns[k].send((bounds[k], bounds[k+1]))
+                    losses = [conns[k].recv() for k in active]
+                    for res in losses:
+                        if isinstance(res, Exception):
+                            raise res
+                    w = np.diff(bounds)[active] / float(nb)
+                    g = np.dot(w, bufs['grads'][active])
+                    for ag, s, o0, o1 in zip(avg_grads, shapes, offsets[:-1], offsets[1:]):
+                        ag.set_value(np.asarray(g[o0:o1].reshape(s), dtype=floatX))
+                    apply_update()
+                    t_train += time.time() - t0
+                    nseen += nb
+                    nbatches += 1
+
+                    loss_ema = loss_decay*loss_ema + (1. - loss_decay)*np.dot(w, losses)
+                    nloss += 1
+                    this_train_loss = loss_ema/(1. - loss_decay**nloss)
+                    if max_batches is not None and nbatches >= max_batches:
+                        break
+                logger.info('epoch %i, seq %i/%i, train loss %f lr: %f (%i workers, %.1f samples/s)' %
+                            (epoch + 1, idx + 1, n_train_batches, this_train_loss,
+                             lr.get_value(), nworkers, nseen/max(t_train, 1e-12)))
+                if max_batches is not None and nbatches >= max_batches:
+                    break
+        finally:
+            for c in conns:
+                c.send(None)
+            for p in procs:
+                p.join()
+        logger.info("Optimization complete")
+        return nseen/max(t_train, 1e-12)
+
+    def get_updates(self, params, grads, lr):
+        """
+        the parameter updates of a training step, for self.update_rule
+        'sgd', 'momentum' or 'adam'
+
+        Args:
+        params : list of shared variables to fit
+        grads : their (symbolic) gradients
+        lr : the (shared) learning rate
+
+        returns: OrderedDict of updates for theano.function
+
         """
-        the CNN expects inputs with Nsamples = self.batch_size.
-        In order to run 'predict' on an arbitrary number of samples we
-        pad as necessary.
+        rule = getattr(self, 'update_rule', 'sgd')
+        momentum = getattr(self, 'momentum', 0.9)
+        floatX = theano.config.floatX
+        updates = OrderedDict()
+        if rule == 'sgd':
+            for param_i, grad_i in zip(params, grads):
+                updates[param_i] = param_i - lr * grad_i
+        elif rule == 'momentum':
+            for param_i, grad_i in zip(params, grads):
+                v = theano.shared(np.zeros_like(param_i.get_value()))
+                v_new = momentum * v - lr * grad_i
+                updates[v] = v_new
+                updates[param_i] = param_i + v_new
+        elif rule == 'adam':
+            beta2, eps = 0.999, 1e-8
+            t = theano.shared(np.asarray(0., dtype=floatX))
+            t_new = t + 1
+            updates[t] = t_new
+            lr_t = lr * T.sqrt(1. - beta2**t_new) / (1. - momentum**t_new)
+            for param_i, grad_i in zip(params, grads):
+                m = theano.shared(np.zeros_like(param_i.get_value()))
+                v = theano.shared(np.zeros_like(param_i.get_value()))
+                m_new = momentum * m + (1. - momentum) * grad_i
+                v_new = beta2 * v + (1. - beta2) * grad_i**2
+                updates[m] = m_new
+                updates[v] = v_new
+                updates[param_i] = param_i - lr_t * m_new / (T.sqrt(v_new) + eps)
+        else:
+            raise NotImplementedError("update_rule %s" % rule)
+        return updates
+
+    def predict(self, data, block_size=4096):
+        """
+        predict the class of an arbitrary number of samples,
+        passed to the CNN block_size samples at a time (no padding)
 
         """
         if isinstance(data, list):
@@ -484,26 +941,12 @@ class MetaCNN(BaseEstimator):
         if data.ndim == 1:
             data = np.array([data])
 
-        nsamples = data.shape[0]
-        n_batches = nsamples//self.batch_size
-        n_rem = nsamples%self.batch_size
-        if n_batches > 0:
-            preds = [list(self.predict_wrap(data[i*self.batch_size:(i+1)*self.batch_size]))\
-                                           for i in range(n_batches)]
-        else:
-            preds = []
-        if n_rem > 0:
-            z = np.zeros((self.batch_size, self.n_in * self.n_in))
-            z[0:n_rem] = data[n_batches*self.batch_size:n_batches*self.batch_size+n_rem]
-            preds.append(self.predict_wrap(z)[0:n_rem])
-        
-        return np.hstack(preds).flatten()
+        return self.predict_proba(data, block_size=block_size).argmax(axis=1)
     
-    def predict_proba(self, data):
+    def predict_proba(self, data, block_size=4096):
         """
-        the CNN expects inputs with Nsamples = self.batch_size.
-        In order to run 'predict_proba' on an arbitrary number of samples we
-        pad as necessary.
+        the class probabilities of an arbitrary number of samples,
+        passed to the CNN block_size samples at a time (no padding)
 
         """
         if isinstance(data, list):
@@ -511,20 +954,20 @@ class MetaCNN(BaseEstimator):
         if data.ndim == 1:
             data = np.array([data])
 
+        fn = self.proba_function()
         nsamples = data.shape[0]
-        n_batches = nsamples//self.batch_size
-        n_rem = nsamples%self.batch_size
-        if n_batches > 0:
-            preds = [list(self.predict_proba_wrap(data[i*self.batch_size:(i+1)*self.batch_size]))\
-                                           for i in range(n_batches)]
-        else:
-            preds = []
-        if n_rem > 0:
-            z = np.zeros((self.batch_size, self.n_in * self.n_in))
-            z[0:n_rem] = data[n_batches*self.batch_size:n_batches*self.batch_size+n_rem]
-            preds.append(self.predict_proba_wrap(z)[0:n_rem])
-        
-        return np.vstack(preds)
+        preds = []
+        for i in range(0, nsamples, block_size):
+            proba = fn(np.asarray(data[i:i+block_size], dtype=theano.config.floatX))
+            #a copy of a cached function (see proba_function) 
+            #returns its single output in a list
+            if isinstance(proba, list):
+                proba = proba[0]
+            preds.append(proba)
+        proba = np.vstack(preds)
+        assert proba.shape == (nsamples, self.n_out), \
+            "CNN output has shape %s, expected %s" % (proba.shape, (nsamples, self.n_out))
+        return proba
         
 
     def shared_dataset(self, data_xy):
@@ -828,6 +1271,7 @@ class LeNetConvPoolLayer(object):
         :type image_shape: tuple or list of length 4
         :param image_shape: (batch size, num input feature maps,
                              image height, image width)
+                            batch size can be None (any number of samples)
 
         :type poolsize: tuple or list of length 2
         :param poolsize: the downsampling (pooling) factor (#rows,#cols)
@@ -0,0 +1,46 @@
+"""
+tests for ubc_AI.augment
+"""
+import numpy as np
+import pytest
+
+from ubc_AI.augment import shift_augment, shiftbatches
+
+
+@pytest.mark.parametrize('shape', [None, (4, 6), (3, 5)])
+def test_shift_augment_matches_roll(shape):
+    rng = np.random.RandomState(0)
+    nfeatures = 6 if shape is None else shape[0]*shape[1]
+    data = rng.rand(7, nfeatures)
+    rowshape = (1, nfeatures) if shape is None else shape
+    ncols = rowshape[1]
+    shifts = rng.randint(-ncols, 2*ncols, (7, 3))
+    out = shift_augment(data, shifts, shape)
+    assert out.shape == (21, nfeatures)
+    for i in range(7):
+        for k in range(3):
+            rolled = np.roll(data[i].reshape(rowshape), shifts[i, k], axis=-1).ravel()
+            assert np.all(out[i*3 + k] == rolled)
+
+
+def test_shift_augment_single_shift():
+    data = np.arange(12.).reshape(3, 4)
+    shifts = np.array([0, 1, 5])
+    out = shift_augment(data, shifts)
+    for row, x, s in zip(out, data, shifts):
+        assert np.all(row == np.roll(x, s))
+
+
+def test_shiftbatches_epoch():
+    data = np.arange(40.).reshape(10, 4)
+    target = np.arange(10)
+    sb = shiftbatches(data, target, ncopies=3, rng=np.random.RandomState(1))
+    assert len(sb) == 30
+    batches = list(sb.minibatches(8))
+    assert [yb.size for Xb, yb in batches] == [8, 8, 8, 6]
+    y = np.concatenate([yb for Xb, yb in batches])
+    assert np.all(np.bincount(y) == 3)
+    for Xb, yb in batches:
+        #every row is a rolled copy of its sample
+        for x, t in zip(Xb, yb):
+            assert any([np.all(x == np.roll(data[t], s)) for s in range(4)])
@@ -0,0 +1,98 @@
+"""
+tests for checkpointing and resuming the NeuralNetwork and MetaCNN fits
+"""
+import random
+import numpy as np
+import pytest
+
+from ubc_AI.checkpoint import checkpointer
+from ubc_AI import pulsar_nnetwork as pnn
+from ubc_AI.featurestore import streamloader
+
+
+def test_checkpointer(tmpdir):
+    fname = str(tmpdir.join('fit.ckpt'))
+    ckpt = checkpointer(fname, interval=0.)
+    assert ckpt.due()
+    assert ckpt.load() is None
+    ckpt.save({'fit_type':'adam', 'epoch':3, 'thetas':np.arange(4.)})
+    assert tmpdir.listdir() == [tmpdir.join('fit.ckpt')]
+    state = checkpointer(fname).load(fit_type='adam')
+    assert state['epoch'] == 3 and np.all(state['thetas'] == np.arange(4.))
+    #a checkpoint of another fit is ignored
+    assert checkpointer(fname).load(fit_type='sgd') is None
+    ckpt.remove()
+    assert not tmpdir.listdir()
+    assert not checkpointer(fname, interval=60.).due()
+
+
+def nn_fit(fname, interrupt_at=None):
+    np.random.seed(0)
+    random.seed(0)
+    rng = np.random.RandomState(1)
+    X = rng.rand(50, 5)
+    y = (X[:, 0] > X[:, 1]).astype(int)
+    nn = pnn.NeuralNetwork(design=[4], fit_type='adam', n_epochs=4, batch_size=10,
+                           val_frac=0.2, patience=10, checkpoint=fname,
+                           checkpoint_interval=0.)
+    if interrupt_at is not None:
+        gradient = nn.gradient
+        ncalls = [0]
+        def interrupting(*args, **kwds):
+            ncalls[0] += 1
+            if ncalls[0] == interrupt_at:
+                raise KeyboardInterrupt
+            return gradient(*args, **kwds)
+        nn.gradient = interrupting
+    nn.fit(X, y)
+    return nn.flatten_thetas()
+
+
+def test_nn_resume(tmpdir):
+    fname = str(tmpdir.join('nn.ckpt'))
+    full = nn_fit(fname)
+    assert not tmpdir.listdir()
+    #40 training samples, 4 minibatches per epoch: stop at the start of the third epoch
+    with pytest.raises(KeyboardInterrupt):
+        nn_fit(fname, interrupt_at=9)
+    assert tmpdir.join('nn.ckpt').check()
+    resumed = nn_fit(fname)
+    assert np.allclose(resumed, full, rtol=1e-12, atol=0)
+    assert not tmpdir.listdir()
+
+
+class interruptingloader(streamloader):
+    """ a streamloader interrupted when epoch 'interrupt_at' starts """
+    def minibatches(self, batch_size, shuffle=True):
+        self.nepochs = getattr(self, 'nepochs', 0) + 1
+        if self.nepochs == getattr(self, 'interrupt_at', None):
+            raise KeyboardInterrupt
+        return streamloader.minibatches(self, batch_size, shuffle)
+
+
+def cnn_fit(fname, interrupt_at=None):
+    from ubc_AI.sktheano_cnn import MetaCNN
+    np.random.seed(0)
+    rng = np.random.RandomState(2)
+    X = rng.rand(40, 256).astype(np.float32)
+    y = (X[:, :128].sum(1) > X[:, 128:].sum(1)).astype(int)
+    loader = interruptingloader(X, y, block_size=8, nbuffer=2, seed=3)
+    loader.interrupt_at = interrupt_at
+    cnn = MetaCNN(nkerns=[2, 3], filters=[3, 2], poolsize=[(2, 2), (2, 2)], n_hidden=5,
+                  batch_size=10, n_epochs=3, update_rule='adam', learning_rate=0.01,
+                  checkpoint=fname, checkpoint_interval=0.)
+    cnn.fit(loader, None)
+    return [p.get_value() for p in cnn.cnn.params]
+
+
+def test_cnn_resume(tmpdir):
+    pytest.importorskip('theano')
+    fname = str(tmpdir.join('cnn.ckpt'))
+    full = cnn_fit(fname)
+    with pytest.raises(KeyboardInterrupt):
+        cnn_fit(fname, interrupt_at=3)
+    assert tmpdir.join('cnn.ckpt').check()
+    resumed = cnn_fit(fname)
+    for p, q in zip(resumed, full):
+        assert np.allclose(p, q)
+    assert not tmpdir.listdir()
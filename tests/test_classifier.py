@@ -0,0 +1,229 @@
+"""
+tests for ubc_AI.classifier
+"""
+import numpy as np
+import pytest
+
+classifier = pytest.importorskip('ubc_AI.classifier')
+
+
+class fakepfd(object):
+    """ stands in for a pfddata, returning a fixed profile """
+    def __init__(self, profile):
+        self.profile = profile
+
+    def getdata(self, phasebins=0, **kwds):
+        return self.profile
+
+
+class teacher(object):
+    """ scores a candidate by the height of its first phase bin """
+    def predict_proba(self, pfds):
+        p = np.array([1. / (1 + np.exp(-8 * (pfd.profile[0] - 0.5))) for pfd in pfds])
+        return np.column_stack([1 - p, p])
+
+
+def pool(N=80, nbins=16, seed=0):
+    rng = np.random.RandomState(seed)
+    return [fakepfd(rng.rand(nbins)) for i in range(N)]
+
+
+@pytest.mark.parametrize('fit_type', ['sgd', 'adam'])
+def test_distill_minibatch_student(fit_type):
+    pfds = pool()
+    student = classifier.pnnclf(feature={'phasebins': 16}, design=[4],
+                                fit_type=fit_type, n_epochs=3, batch_size=20)
+    score = student.distill(teacher(), pfds, report=False)
+    assert np.allclose(score, teacher().predict_proba(pfds)[:, 1])
+    p = student.predict_proba(pfds)
+    assert p.shape == (len(pfds), 2)
+    assert np.all((p >= 0) & (p <= 1))
+
+
+def test_distill_restarts_student():
+    pfds = pool(seed=1)
+    student = classifier.pnnclf(feature={'phasebins': 16}, design=[4], fit_type='adam',
+                                n_epochs=2, batch_size=20, nrestarts=2)
+    student.distill(teacher(), pfds, report=False)
+    assert student.predict_proba(pfds).shape == (len(pfds), 2)
+
+
+class stage(object):
+    """ a cascade stage scoring a candidate by one of its profile bins """
+    def __init__(self, bin):
+        self.bin = bin
+        self.nscored = 0
+
+    def predict_proba(self, pfds):
+        self.nscored += len(pfds)
+        p = np.array([pfd.profile[self.bin] for pfd in pfds])
+        return np.column_stack([1 - p, p])
+
+
+def labelled_pool(N=400, seed=2):
+    rng = np.random.RandomState(seed)
+    target = rng.randint(0, 2, N)
+    pfds = []
+    for t in target:
+        profile = rng.rand(4)
+        #the stages see the pulsars (class 1) score higher, with noise
+        profile[:2] = np.clip(0.35 * t + 0.65 * profile[:2], 0, 1)
+        profile[2] = 0.9 if t else 0.1
+        pfds.append(fakepfd(profile))
+    return pfds, target
+
+
+def test_cascade_tune_thresholds():
+    pfds, target = labelled_pool()
+    cascade = classifier.cascadeAI([stage(0), stage(1), stage(2)])
+    #default thresholds: the last stage decides everything
+    assert np.all(cascade.predict(pfds) == target)
+    assert cascade.stage_counts == [400, 400, 400]
+
+    thresholds = cascade.tune_thresholds(pfds, target, max_recall_loss=0.02)
+    assert len(thresholds) == 2 and min(thresholds) > 0
+    pred = cascade.predict(pfds)
+    lost = ((target == 1) & (pred == 0)).sum()
+    assert lost <= 0.02 * (target == 1).sum()
+    assert cascade.stage_counts[0] == 400
+    assert cascade.stage_counts[2] < cascade.stage_counts[1] < 400
+    #no false positives: the rejected candidates keep their (low) early scores
+    assert not ((target == 0) & (pred == 1)).any()
+
+
+def test_cascade_early_exit_skips_later_stages():
+    pfds, target = labelled_pool(seed=3)
+    last = stage(2)
+    cascade = classifier.cascadeAI([stage(0), last], thresholds=[0.5])
+    cascade.predict_proba(pfds)
+    passed = sum([pfd.profile[0] >= 0.5 for pfd in pfds])
+    assert last.nscored == passed == cascade.stage_counts[1]
+
+
+def test_cascade_tune_pass_fraction():
+    pfds, target = labelled_pool(seed=4)
+    cascade = classifier.cascadeAI([stage(0), stage(2)])
+    cascade.tune_pass_fraction(pfds, pass_frac=0.25)
+    cascade.predict_proba(pfds)
+    assert cascade.stage_counts[1] == 100
+
+
+def test_agreement_report_list_target():
+    pfds, target = labelled_pool()
+    results = classifier.agreement_report(stage(2), stage(2), pfds, list(target),
+                                          fractions=[0.5, 1.], verbose=False)
+    assert results['agreement'] == 1. and results['mean_dscore'] == 0.
+    #the teacher's positives are the pulsars
+    assert results['recall'] == results['psr_recall']
+    assert results['psr_recall'][1.] == 1.
+    assert np.allclose(results['psr_recall'][0.5], min(1., 0.5 * len(target) / target.sum()))
+
+
+def reference_adaboost_weights(preds, targets):
+    """ the loop implementation of adaboost.fit (before vectorizing), platt=False """
+    npreds = preds.shape[1]
+    Wrong_pred = np.transpose([v != targets for v in preds.transpose()])
+    y = np.where(targets != 1, -1, 1)
+    preds2 = np.where(preds != 1, -1, 1)
+    I = np.where(Wrong_pred, 1., 0.)
+    clfs = {}
+    alphas = {}
+    D = np.ones(len(y), dtype=np.float)/len(y)
+    allclfs = set(range(npreds))
+    for t in range(npreds):
+        idcs = list(allclfs - set(clfs.values()))
+        W_e = np.dot(D, I)
+        best = np.argmax(np.abs(0.5 - W_e[idcs]))
+        h_t = np.where(W_e == W_e[idcs][best])[0][0]
+        e_t = W_e[h_t]
+        if np.abs(0.5 - e_t) <= .10: break
+        clfs[t] = h_t
+        alpha_t = np.log((1. - e_t)/e_t)/2.
+        alphas[t] = alpha_t
+        Z_t = D*np.exp(-alpha_t*y*preds2[:, h_t]).sum()
+        D = D*np.exp(-alpha_t*y*preds2[:, h_t])/Z_t
+    if len(clfs) <= 2:
+        w = np.ones(npreds, dtype=float)/npreds
+    else:
+        w = np.zeros(npreds, dtype=float)
+    for k, v in clfs.iteritems():
+        w[v] = alphas[k]
+    return w
+
+
+def reference_adaboost_proba(weights, lops, nclass):
+    npreds = len(weights)
+    lops = 2.*lops - 1.
+    w = np.ones((npreds, nclass), dtype=np.float)/float(npreds)
+    w[:, 1] = weights
+    f = np.transpose([np.dot(lops[:, c::nclass], v) for c, v in enumerate(w.transpose())])
+    return 1./(1.0 + np.exp(-f))
+
+
+def member_predictions(seed, N=500, nflips=[20, 45, 70, 95, 130, 160]):
+    """ labels and the predictions of members with different (distinct) error counts """
+    rng = np.random.RandomState(seed)
+    targets = rng.randint(0, 2, N)
+    preds = []
+    for k in nflips:
+        p = targets.copy()
+        idx = rng.permutation(N)[:k]
+        p[idx] = 1 - p[idx]
+        preds.append(p)
+    return np.transpose(preds), targets
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_adaboost_matches_loop_implementation(seed):
+    preds, targets = member_predictions(seed)
+    ab = classifier.adaboost()
+    ab.fit(preds, targets)
+    assert np.allclose(ab.weights, reference_adaboost_weights(preds, targets))
+
+    rng = np.random.RandomState(seed + 10)
+    for nclass in [2, 3]:
+        lops = rng.rand(50, preds.shape[1]*nclass)
+        assert np.allclose(ab.predict_proba(lops),
+                           reference_adaboost_proba(ab.weights, lops, nclass))
+    H = np.where(np.dot(np.where(preds != 1, -1, 1), ab.weights) >= 0., 1, 0)
+    assert np.all(ab.predict(preds) == H)
+
+
+class featurepfd(object):
+    """ a pfd with fixed intervals/subbands images and phasebins/DMbins profiles """
+    def __init__(self, seed, shape=(4, 6)):
+        rng = np.random.RandomState(seed)
+        self.features = {'intervals': rng.rand(*shape).ravel(),
+                         'subbands': rng.rand(*shape).ravel(),
+                         'phasebins': rng.rand(shape[1]),
+                         'DMbins': rng.rand(shape[0])}
+
+    def getdata(self, **feature):
+        return self.features[feature.keys()[0]]
+
+
+def test_mcnnclf_channels():
+    clf = classifier.mcnnclf(feature={'phasebins': 6, 'DMbins': 4, 'subbands': (4, 6),
+                                      'intervals': (4, 6)})
+    assert clf.channels() == ['intervals', 'subbands', 'phasebins', 'DMbins']
+    assert clf.channel_shape() == (4, 6)
+    pfds = [featurepfd(s) for s in range(3)]
+    data = clf.getfeatures(pfds)
+    assert data.shape == (3, 4*4*6)
+    for pfd, x in zip(pfds, data):
+        chans = x.reshape(4, 4, 6)
+        assert np.all(chans[0].ravel() == pfd.features['intervals'])
+        assert np.all(chans[1].ravel() == pfd.features['subbands'])
+        #the profile repeated on every row, the DM curve on every column
+        assert np.all(chans[2] == pfd.features['phasebins'][np.newaxis, :])
+        assert np.all(chans[3] == pfd.features['DMbins'][:, np.newaxis])
+
+
+def test_mcnnclf_mismatched_sizes():
+    clf = classifier.mcnnclf(feature={'intervals': (4, 6), 'subbands': 8})
+    with pytest.raises(classifier.MyError):
+        clf.channel_shape()
+    #a 6-bin profile can't be tiled to 6x4 images
+    clf = classifier.mcnnclf(feature={'intervals': (6, 4), 'phasebins': 6})
+    with pytest.raises(classifier.MyError):
+        clf.getfeatures([featurepfd(0)])
@@ -0,0 +1,144 @@
+"""
+tests for the ensemble member selection of ubc_AI.data
+"""
+import numpy as np
+import pytest
+
+data = pytest.importorskip('ubc_AI.data')
+
+
+def proba(pred):
+    return np.column_stack([1 - pred, pred]).astype(float)
+
+
+def oof_members(seed=0, N=200):
+    rng = np.random.RandomState(seed)
+    target = rng.randint(0, 2, N)
+    flip = lambda frac: np.where(rng.rand(N) < frac, 1 - target, target)
+    #two good members, and a random one
+    oof = [proba(flip(0.05)), proba(flip(0.1)), proba(rng.randint(0, 2, N))]
+    return oof, target
+
+
+def test_subset_search_vote():
+    oof, target = oof_members()
+    combo, F1, history = data.subset_search(oof, target, strategy='vote', cv=3)
+    assert 0 in combo and 2 not in combo
+    assert F1 > 0.8
+    combo, F1, history = data.subset_search(oof, target, strategy='vote', method='exhaustive',
+                                            nvote=1, cv=3)
+    assert len(history) == 7
+    assert combo == [0]
+
+
+def test_subset_search_vote_nvote():
+    oof, target = oof_members(1)
+    with pytest.raises(ValueError):
+        data.subset_search(oof, target, strategy='vote', nvote=0)
+
+
+def test_subset_search_lr():
+    oof, target = oof_members(2)
+    combo, F1, history = data.subset_search(oof, target, strategy='lr', cv=3)
+    assert 2 not in combo and F1 > 0.8
+
+
+class fakepfd(object):
+    """ a pfd whose (already extracted) feature is a fixed profile """
+    def __init__(self, profile):
+        self.profile = profile
+        self.extracted_feature = ['phasebins:4']
+
+    def getdata(self, phasebins=0, **kwds):
+        return self.profile
+
+
+class thresholdclf(object):
+    """ predicts a pulsar if the first feature is above 'cut' """
+    def __init__(self, cut=0.5, feature=None):
+        self.cut = cut
+
+    def fit_features(self, data, target):
+        pass
+
+    def predict_features(self, data):
+        return np.where(data[:, 0] > self.cut, 1, 0)
+
+
+class refitclf(thresholdclf):
+    """ fails if the configurations of the first search are fit again """
+    def fit_features(self, data, target):
+        if self.cut in [0.2, 0.5]:
+            raise RuntimeError("configuration %s was refit" % self.cut)
+
+
+def labelled_pfds(N=60, seed=3):
+    rng = np.random.RandomState(seed)
+    target = rng.randint(0, 2, N)
+    pfds = [fakepfd(np.r_[0.6*t + 0.4*rng.rand(), rng.rand(3)]) for t in target]
+    return pfds, target
+
+
+def test_param_search_grid():
+    pfds, target = labelled_pfds()
+    grid = {'cut': [0.2, 0.5, 0.9], 'feature': [{'phasebins': 4}]}
+    results = data.param_search(thresholdclf, pfds, target, grid, cv=2, seed=0)
+    assert len(results) == 3
+    assert results[0][0]['cut'] == 0.5 and results[0][1] == 1.
+    assert [r[1] for r in results] == sorted([r[1] for r in results], reverse=True)
+
+
+def test_param_search_resume(tmpdir):
+    pfds, target = labelled_pfds()
+    ckpt = str(tmpdir.join('search.pkl'))
+    grid = {'cut': [0.2, 0.5], 'feature': [{'phasebins': 4}]}
+    first = data.param_search(thresholdclf, pfds, target, grid, cv=2, seed=0, checkpoint=ckpt)
+    #the finished configurations are not refit
+    grid['cut'].append(0.9)
+    resumed = data.param_search(refitclf, pfds, target, grid, cv=2, checkpoint=ckpt)
+    assert len(resumed) == 3
+    F1 = dict((r[0]['cut'], r[1]) for r in resumed)
+    for params, meanF1, stdF1 in first:
+        assert F1[params['cut']] == meanF1
+
+
+
+def test_param_search_random_duplicates(tmpdir):
+    import cPickle
+    pfds, target = labelled_pfds()
+    ckpt = str(tmpdir.join('search.pkl'))
+    grid = {'cut': [0.2, 0.5]}
+    results = data.param_search(thresholdclf, pfds, target, grid, n_iter=12, cv=2, seed=1,
+                                base_params={'feature': {'phasebins': 4}}, checkpoint=ckpt)
+    #each configuration is fit (and its F1s kept) once
+    assert sorted([r[0]['cut'] for r in results]) == [0.2, 0.5]
+    done = cPickle.load(open(ckpt, 'rb'))
+    done.pop('__splits__')
+    assert [len(F1s) for params, F1s in done.values()] == [2, 2]
+
+
+def test_param_search_needs_feature():
+    pfds, target = labelled_pfds()
+    with pytest.raises(ValueError):
+        data.param_search(thresholdclf, pfds, target, {'cut': [0.5]})
+
+class memorizer(object):
+    """ scores 1 the samples it was trained on, 0 the others """
+    feature = {'phasebins': 4}
+
+    def fit_features(self, data, target):
+        self.seen = set([tuple(x) for x in data])
+
+    def predict_proba_features(self, data):
+        p = np.array([float(tuple(x) in self.seen) for x in data])
+        return np.column_stack([1 - p, p])
+
+
+def test_oof_predictions_out_of_fold():
+    pfds, target = labelled_pfds(N=30)
+    oof = data.oof_predictions([memorizer(), memorizer()], pfds, target, cv=3)
+    assert len(oof) == 2
+    for p in oof:
+        assert p.shape == (30, 2)
+        #every sample is predicted by a copy which didn't train on it
+        assert np.all(p[:, 1] == 0.)
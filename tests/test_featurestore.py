@@ -0,0 +1,53 @@
+"""
+tests for ubc_AI.featurestore.streamloader
+"""
+import numpy as np
+
+from ubc_AI.featurestore import streamloader
+from ubc_AI.checkpoint import random_state, set_random_state
+
+
+def loader(seed=None):
+    X = np.arange(600, dtype=float).reshape(100, 6)
+    y = np.arange(100)
+    return streamloader(X, y, block_size=8, nbuffer=3, prefetch=2, shape=(2, 3),
+                        randomshift=True, seed=seed)
+
+
+def epoch(ldr, batch_size=16):
+    return [(Xb.copy(), yb.copy()) for Xb, yb in ldr.minibatches(batch_size)]
+
+
+def same(e1, e2):
+    return len(e1) == len(e2) and \
+        all([np.all(X1 == X2) and np.all(y1 == y2) for (X1, y1), (X2, y2) in zip(e1, e2)])
+
+
+def test_epoch_covers_samples():
+    batches = epoch(loader(0))
+    y = np.concatenate([yb for Xb, yb in batches])
+    assert sorted(y) == range(100)
+    assert [yb.size for Xb, yb in batches] == [16]*6 + [4]
+
+
+def test_seeded_loaders_agree():
+    assert same(epoch(loader(1)), epoch(loader(1)))
+    assert not same(epoch(loader(1)), epoch(loader(2)))
+
+
+def test_own_rng_not_global():
+    state = np.random.get_state()
+    epoch(loader(3))
+    assert np.all(np.random.get_state()[1] == state[1])
+
+
+def test_resume_random_state():
+    ldr = loader(4)
+    epoch(ldr)
+    saved = random_state(ldr)
+    second = epoch(ldr)
+    #a new loader (a resumed fit) restored to the checkpointed state
+    ldr2 = loader()
+    epoch(ldr2)
+    set_random_state(saved, ldr2)
+    assert same(epoch(ldr2), second)
@@ -0,0 +1,228 @@
+"""
+tests for ubc_AI.pulsar_nnetwork
+"""
+import random
+import numpy as np
+import pytest
+
+from ubc_AI import pulsar_nnetwork as pnn
+
+
+def split_datas():
+    """ the split_data of pulsar_nnetwork, and of training (needs presto) """
+    funcs = [pnn.split_data]
+    try:
+        from ubc_AI import training
+        funcs.append(training.split_data)
+    except ImportError:
+        pass
+    return funcs
+
+
+@pytest.mark.parametrize('split_data', split_datas())
+def test_split_data_soft_targets(split_data):
+    rng = np.random.RandomState(0)
+    X = rng.rand(40, 3)
+    score = rng.rand(40)
+    y = np.column_stack([1 - score, score])
+    X1, y1, X2, y2 = split_data(X, y, pct=0.9)
+    assert y1.shape == (36, 2) and y2.shape == (4, 2)
+    assert set(y1.argmax(1)) == set(y.argmax(1))
+    #the rows stay with their targets
+    rows = dict((tuple(x), tuple(t)) for x, t in zip(X, y))
+    for x, t in zip(np.vstack([X1, X2]), np.vstack([y1, y2])):
+        assert rows[tuple(x)] == tuple(t)
+
+
+@pytest.mark.parametrize('split_data', split_datas())
+def test_split_data_labels(split_data):
+    X = np.arange(20).reshape(10, 2)
+    y = np.array([0] * 8 + [1] * 2)
+    X1, y1, X2, y2 = split_data(X, y, pct=0.6)
+    assert len(y1) == 6 and len(y2) == 4
+    assert set(y1) == set([0, 1])
+
+
+def test_fit_restarts_soft_targets():
+    rng = np.random.RandomState(1)
+    X = rng.rand(60, 4)
+    score = 1. / (1 + np.exp(-4 * (X[:, 0] - X[:, 1])))
+    y = np.column_stack([1 - score, score])
+    nn = pnn.NeuralNetwork(design=[3], gamma=0., nrestarts=2, fit_type='adam',
+                           n_epochs=2, batch_size=20, val_frac=0.1)
+    nn.fit(X, y)
+    p = nn.predict_proba(X)
+    assert p.shape == (60, 2)
+
+
+def small_network(nin=6, nout=3, design=[5], shiftlayer=None, gamma=0.1, seed=0):
+    np.random.seed(seed)
+    nn = pnn.NeuralNetwork(gamma=gamma, design=design, shiftlayer=shiftlayer)
+    nn.create_layers(nin, nout, shiftlayer=shiftlayer)
+    rng = np.random.RandomState(seed)
+    X = rng.rand(12, nin)
+    y = rng.randint(0, nout, 12)
+    return nn, X, y
+
+
+def reference_proba(nn, X):
+    """ the unnormalized output activations, one layer at a time """
+    a = X
+    for lv in nn.layers:
+        a = 1. / (1 + np.exp(-np.dot(np.column_stack([np.ones(len(a)), a]), lv.theta)))
+    return a
+
+
+@pytest.mark.parametrize('shiftlayer', [None, 0])
+@pytest.mark.parametrize('design', [[5], [6, 4]])
+def test_gradient_matches_numerical(design, shiftlayer):
+    nn, X, y = small_network(design=design, shiftlayer=shiftlayer)
+    if shiftlayer is not None:
+        assert isinstance(nn.layers[shiftlayer], pnn.convlayer)
+    thetas = nn.flatten_thetas()
+    grad = nn.gradient(thetas.copy(), X, y).copy()
+    numgrad = nn.numericalGradients(X, y)
+    assert np.allclose(grad, numgrad, rtol=1e-4, atol=1e-7)
+
+
+def test_gradient_soft_targets():
+    nn, X, y = small_network(nout=2)
+    score = np.random.RandomState(5).rand(len(X))
+    soft = np.column_stack([1 - score, score])
+    grad = nn.gradient(nn.flatten_thetas().copy(), X, soft).copy()
+    assert np.allclose(grad, nn.numericalGradients(X, soft), rtol=1e-4, atol=1e-7)
+
+
+def test_gradient_workspace_resized():
+    #the preallocated workspaces follow the number of samples
+    nn, X, y = small_network()
+    thetas = nn.flatten_thetas()
+    full = nn.gradient(thetas.copy(), X, y).copy()
+    nn.gradient(thetas.copy(), X[:5], y[:5])
+    assert np.allclose(nn.gradient(thetas.copy(), X, y), full, rtol=1e-12, atol=0)
+
+
+def test_convlayer_is_circulant():
+    nn, X, y = small_network(nin=8, design=[4], shiftlayer=0)
+    conv = nn.layers[0]
+    w = conv.get_params()
+    for i in range(4):
+        assert np.all(conv.theta[0, i] == w[0])
+        assert np.all(conv.theta[1:, i] == np.roll(w[1:], i * (8 // 4)))
+
+
+def test_cost_from_logits():
+    nn, X, y = small_network(gamma=0.)
+    h = reference_proba(nn, X)
+    yy = np.zeros_like(h)
+    yy[np.arange(len(y)), y] = 1.
+    J = -(yy*np.log(h) + (1 - yy)*np.log(1 - h)).sum() / len(y)
+    assert np.allclose(nn.costFunctionU(X, y), J)
+    #saturated activations stay finite
+    for lv in nn.layers:
+        lv.theta *= 1000.
+    assert np.isfinite(nn.costFunctionU(X, y))
+
+
+def test_predict_proba_batch():
+    nn, X, y = small_network()
+    h = reference_proba(nn, X)
+    p = h / h.sum(axis=1)[:, np.newaxis]
+    assert np.allclose(nn.predict_proba(X), p)
+    assert np.allclose(nn.predict_proba_batch(X, block_size=5), p, atol=1e-5)
+    assert np.all(nn.predict(X) == p.argmax(axis=1))
+    assert np.all(nn.predict(X[0]) == p[:1].argmax(axis=1))
+
+
+def test_forward_propagate():
+    nn, X, y = small_network(design=[6, 4])
+    z, h = nn.forward_propagate(X)
+    assert np.allclose(h, reference_proba(nn, X))
+    z1, h1 = nn.forward_propagate(X[3])
+    assert h1.shape == (h.shape[1],) and np.allclose(h1, h[3])
+    #internal layers include the bias column
+    z, a = nn.forward_propagate(X, nl=1)
+    assert a.shape == (X.shape[0], 7) and np.all(a[:, 0] == 1.)
+
+
+@pytest.mark.parametrize('backend', sorted(pnn._backends))
+def test_backends_agree(backend):
+    nn, X, y = small_network()
+    p = nn.predict_proba(X)
+    grad = nn.gradient(nn.flatten_thetas().copy(), X, y).copy()
+    pnn.set_backend(backend)
+    try:
+        assert np.allclose(nn.predict_proba(X), p)
+        assert np.allclose(nn.gradient(nn.flatten_thetas().copy(), X, y), grad)
+    finally:
+        pnn.set_backend('numpy')
+
+
+def separable(N=200, seed=6):
+    rng = np.random.RandomState(seed)
+    X = rng.rand(N, 4)
+    y = (X[:, 0] + X[:, 1] > 1).astype(int)
+    return X, y
+
+
+@pytest.mark.parametrize('fit_type', ['sgd', 'adam'])
+def test_minibatch_fit_learns(fit_type):
+    X, y = separable()
+    np.random.seed(0)
+    nn = pnn.NeuralNetwork(design=[6], fit_type=fit_type, n_epochs=60, batch_size=20,
+                           learning_rate={'sgd':0.5, 'adam':0.02}[fit_type], val_frac=0.)
+    nn.create_layers(4, 2)
+    J0 = nn.costFunctionU(X, y, gamma=0.)
+    nn.fit(X, y)
+    assert nn.costFunctionU(X, y, gamma=0.) < 0.7 * J0
+    assert np.mean(nn.predict(X) == y) > 0.85
+
+
+def test_minibatch_early_stopping():
+    X, y = separable(seed=7)
+    Xval, yval = separable(N=50, seed=8)
+    np.random.seed(1)
+    nn = pnn.NeuralNetwork(design=[6], fit_type='adam', n_epochs=30, batch_size=20,
+                           learning_rate=0.05, patience=3)
+    nn.fit(X, y, validation=(Xval, yval))
+    best = nn.costFunctionU(Xval, yval, gamma=0.)
+    #the kept thetas are the best of the validated epochs
+    assert np.isfinite(best) and best < np.log(2) * 2
+
+
+def test_min_training_size():
+    assert pnn.min_training_size(np.array([0, 0, 0, 1, 0, 1])) == 4
+    assert pnn.min_training_size(np.array([1, 0, 2, 2]), np.array([0, 2])) == 3
+    assert pnn.min_training_size(np.eye(2)[[0, 0, 1]]) == 1
+    with pytest.raises(ValueError):
+        pnn.min_training_size(np.array([0, 0]), np.array([0, 1]))
+
+
+def test_learning_curve_starts_with_every_class():
+    X, y = separable(N=60, seed=3)
+    order = np.argsort(y, kind='mergesort')
+    #the first training samples are all of class 0
+    X, y = X[order], y[order]
+    np.random.seed(1)
+    nn = pnn.NeuralNetwork(design=[3], gamma=0.01)
+    t_error, v_error, ntrials = nn.learning_curve(X[::2], y[::2], X[1::2], y[1::2])
+    assert ntrials[0] + 1 == pnn.min_training_size(y[::2])
+    assert np.all(np.isfinite(v_error))
+
+
+def test_parallel_curves():
+    X, y = separable(N=120, seed=9)
+    random.seed(2)
+    np.random.seed(2)
+    nn = pnn.NeuralNetwork(design=[3], gamma=0.01)
+    t_error, v_error, ntrials = nn.learning_curve(X, y, pct=0.6)
+    assert len(t_error) == len(v_error) == len(ntrials)
+    assert np.all(np.isfinite(t_error)) and np.all(np.isfinite(v_error))
+    gammas = [0., 0.1, 10.]
+    train_error, xval_error, g, best = nn.validation_curve(X, y, gammas=gammas)
+    assert train_error.shape == xval_error.shape == (3,)
+    assert best in gammas
+    #the strongest regularization fits the training data worst
+    assert train_error[2] >= train_error[0]
+    #the network itself is left untouched
+    assert not hasattr(nn, 'layers')
@@ -0,0 +1,71 @@
+"""
+tests for the int8 quantization of the NN/CNN members (ubc_AI.quantize)
+"""
+import cPickle
+import numpy as np
+import pytest
+
+from ubc_AI import pulsar_nnetwork as pnn
+from ubc_AI.quantize import int8_dot, quantize_weights, quantize_activations, QuantizedNN
+
+
+def test_int8_dot_exact():
+    rng = np.random.RandomState(0)
+    a = rng.randint(-127, 128, (5, 3000)).astype(np.int8)
+    w = rng.randint(-127, 128, (3000, 4)).astype(np.int8)
+    acc = int8_dot(a, w)
+    assert acc.dtype == np.int32
+    assert np.all(acc == np.dot(a.astype(np.int64), w.astype(np.int64)))
+
+
+def test_quantize_weights():
+    W = np.random.RandomState(1).randn(20, 6)
+    Wq, scale = quantize_weights(W)
+    assert Wq.dtype == np.int8 and scale.shape == (6,)
+    assert np.abs(Wq).max() == 127
+    assert np.all(np.abs(Wq * scale - W) <= scale / 2 + 1e-6)
+    aq, s, zero = quantize_activations(W)
+    assert aq.dtype == np.int8 and s.shape == zero.shape == (20, 1)
+    assert np.all(np.abs((aq.astype(np.int32) - zero) * s - W) <= s / 2 + 1e-6)
+
+
+def test_quantize_sigmoid_activations():
+    a = np.random.RandomState(4).rand(10, 50)
+    aq, s, zero = quantize_activations(a, 1./255, -128)
+    assert aq.min() >= -128 and aq.max() <= 127
+    assert np.abs((aq.astype(np.int32) - zero) * s - a).max() <= 0.5/255 + 1e-6
+
+
+def test_quantized_nn_agrees():
+    #(measured over 100 seeds: max |dp| up to 0.021 with these 5x weights,
+    # the difference grows with the steepness of the sigmoids near p = 0.5)
+    np.random.seed(2)
+    X = np.random.RandomState(2).rand(500, 32)
+    nn = pnn.NeuralNetwork(design=[12])
+    nn.create_layers(32, 2)
+    for layer in nn.layers:
+        layer.theta *= 5
+    qnn = QuantizedNN(nn)
+    p, qp = nn.predict_proba(X), qnn.predict_proba(X)
+    assert qp.shape == p.shape
+    assert np.abs(qp - p).max() < 0.05
+    assert np.abs(qp - p).mean() < 0.01
+    clear = np.abs(p[:, 1] - 0.5) > 0.05
+    assert np.all(qp[clear].argmax(1) == p[clear].argmax(1))
+    assert qnn.nbytes() < sum([l.theta.nbytes for l in nn.layers]) / 3.
+    #only the int8 weights are pickled
+    qnn2 = cPickle.loads(cPickle.dumps(qnn, protocol=2))
+    assert np.all(qnn2.predict_proba(X) == qp)
+
+
+def test_quantized_cnn_agrees():
+    pytest.importorskip('theano')
+    from ubc_AI.sktheano_cnn import MetaCNN
+    from ubc_AI.quantize import QuantizedCNN
+    cnn = MetaCNN(nkerns=[2, 3], filters=[3, 2], poolsize=[(2, 2), (2, 2)],
+                  n_hidden=5, batch_size=4, n_in=16, n_out=2)
+    cnn.ready()
+    X = np.random.RandomState(3).rand(40, 256)
+    p = cnn.predict_proba(X)
+    qp = QuantizedCNN(cnn).predict_proba(X)
+    assert np.abs(qp - p).max() < 0.05
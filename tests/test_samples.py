@@ -0,0 +1,28 @@
+"""
+tests for ubc_AI.samples.downsample
+"""
+import numpy as np
+import pytest
+
+samples = pytest.importorskip('ubc_AI.samples')
+from scipy import ndimage, mgrid
+
+
+def test_native_shape_kept():
+    a = np.random.RandomState(0).rand(32, 64)
+    out = samples.downsample(a, (32, 64))
+    assert out.dtype == float and np.all(out == a)
+
+
+def test_square_unchanged():
+    #an integer n still interpolates, as before the (rows, cols) shortcut
+    a = np.random.RandomState(1).rand(16, 16)
+    coords = mgrid[0:15:16j, 0:15:16j]
+    expected = ndimage.map_coordinates(a, coords, cval=np.median(a))
+    assert np.all(samples.downsample(a, 16) == expected)
+
+
+def test_rectangular():
+    a = np.random.RandomState(2).rand(32, 64)
+    assert samples.downsample(a, (16, 48)).shape == (16, 48)
+    assert samples.downsample(a, 24).shape == (24, 24)
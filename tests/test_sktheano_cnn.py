@@ -0,0 +1,134 @@
+"""
+tests for the compiled-function cache of sktheano_cnn.MetaCNN
+"""
+import numpy as np
+import pytest
+
+theano = pytest.importorskip('theano')
+from ubc_AI import sktheano_cnn
+from ubc_AI.sktheano_cnn import MetaCNN
+
+
+def randomize(cnn, seed):
+    """ nonzero random weights everywhere (the output layer starts at zero) """
+    rng = np.random.RandomState(seed)
+    for p in cnn.cnn.params:
+        v = p.get_value()
+        p.set_value(np.asarray(rng.uniform(-0.5, 0.5, v.shape), dtype=v.dtype))
+
+
+def small_cnn(seed=None):
+    cnn = MetaCNN(nkerns=[2, 3], filters=[3, 2], poolsize=[(2, 2), (2, 2)],
+                  n_hidden=5, batch_size=4, n_in=16, n_out=2)
+    cnn.ready()
+    if seed is not None:
+        randomize(cnn, seed)
+    return cnn
+
+
+@pytest.fixture
+def cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(sktheano_cnn, '_cachedir', str(tmpdir))
+    monkeypatch.setattr(sktheano_cnn, '_functions', {})
+    return tmpdir
+
+
+def test_shared_architecture_keeps_own_weights(cache):
+    X = np.random.RandomState(0).rand(6, 256)
+    a = small_cnn(seed=10)
+    pa = a.predict_proba(X)
+    assert pa.shape == (6, 2)
+    b = small_cnn(seed=11)
+    wa = [p.get_value().copy() for p in a.cnn.params]
+    pb = b.predict_proba(X)
+    assert pb.shape == (6, 2)
+    #b's weights didn't leak into a
+    for w, p in zip(wa, a.cnn.params):
+        assert np.all(w == p.get_value())
+    assert np.allclose(a.predict_proba(X), pa)
+    assert not np.allclose(pa, pb)
+    assert a.predict(X).shape == b.predict(X).shape == (6,)
+
+
+def test_function_follows_weight_updates(cache):
+    X = np.random.RandomState(1).rand(6, 256)
+    a = small_cnn(seed=12)
+    p0 = a.predict_proba(X)
+    randomize(a, 13)
+    p1 = a.predict_proba(X)
+    assert p1.shape == (6, 2)
+    assert not np.allclose(p1, p0)
+
+
+def test_disk_cache_reused(cache):
+    X = np.random.RandomState(2).rand(6, 256)
+    a = small_cnn(seed=14)
+    pa = a.predict_proba(X)
+    assert len(cache.listdir()) == 1
+    #a fresh process: only the disk cache
+    sktheano_cnn._functions.clear()
+    b = small_cnn()
+    for pb, pa_ in zip(b.cnn.params, a.cnn.params):
+        pb.set_value(pa_.get_value())
+    pb = b.predict_proba(X)
+    assert pb.shape == (6, 2)
+    assert np.allclose(pb, pa)
+    assert b.predict(X).shape == (6,)
+    assert np.all(b.predict(X) == pa.argmax(axis=1))
+
+
+def images(N, shape=(16, 16), seed=4):
+    """ a bright left or right half, the class """
+    rng = np.random.RandomState(seed)
+    y = rng.randint(0, 2, N)
+    X = rng.rand(N, shape[0], shape[1]) * 0.5
+    half = shape[1] // 2
+    for x, t in zip(X, y):
+        if t:
+            x[:, :half] += 0.5
+        else:
+            x[:, half:] += 0.5
+    return X.reshape(N, -1).astype(np.float32), y
+
+
+@pytest.mark.parametrize('update_rule', ['sgd', 'momentum', 'adam'])
+def test_fit_update_rules(cache, update_rule):
+    #46 samples: the last minibatch holds the remaining 6
+    X, y = images(46)
+    np.random.seed(0)
+    cnn = MetaCNN(nkerns=[2, 3], filters=[3, 2], poolsize=[(2, 2), (2, 2)], n_hidden=5,
+                  batch_size=10, n_epochs=15, update_rule=update_rule,
+                  learning_rate={'sgd':0.1, 'momentum':0.05, 'adam':0.01}[update_rule])
+    cnn.fit(X, y)
+    assert np.mean(cnn.predict(X) == y) > 0.8
+
+
+def test_predict_any_batch_size(cache):
+    #the batch dimension is symbolic: any number of samples
+    cnn = small_cnn()
+    X = np.random.RandomState(5).rand(7, 256)
+    p = cnn.predict_proba(X)
+    assert p.shape == (7, 2)
+    assert np.allclose(p.sum(axis=1), 1.)
+    assert np.allclose(cnn.predict_proba(X[:1]), p[:1])
+    assert np.allclose(cnn.predict_proba(X, block_size=3), p)
+
+
+def test_fit_parallel(cache):
+    X, y = images(40, seed=6)
+    np.random.seed(1)
+    cnn = MetaCNN(nkerns=[2, 3], filters=[3, 2], poolsize=[(2, 2), (2, 2)], n_hidden=5,
+                  batch_size=10, n_epochs=1, update_rule='adam', learning_rate=0.01)
+    cnn.fit_parallel(X, y, nworkers=2, max_batches=3)
+    w = [p.get_value().copy() for p in cnn.cnn.params]
+    assert all([np.all(np.isfinite(v)) for v in w])
+    assert cnn.predict_proba(X).shape == (40, 2)
+
+
+def test_rectangular_images(cache):
+    X, y = images(30, shape=(12, 20))
+    cnn = MetaCNN(nkerns=[2, 3], filters=[3, 2], poolsize=[(2, 2), (2, 2)], n_hidden=5,
+                  batch_size=10, n_epochs=2, image_shape=(12, 20))
+    cnn.fit(X, y)
+    assert tuple(cnn.n_in) == (12, 20)
+    assert cnn.predict_proba(X).shape == (30, 2)
@@ -506,6 +506,7 @@ def split_data(data, target, pct=0.6):
     Args:
     data = input data
     target = data classifications
+             (or 2D (nsamples, nclasses) soft targets, split by their argmax class)
     pct = 0 < pct < 1, default 0.6
 
     returns:
@@ -515,6 +516,8 @@ def split_data(data, target, pct=0.6):
     from random import shuffle
     if isinstance(data,type([])):
         data = np.array(data)
+    target = np.asarray(target)
+    labels = target.argmax(axis=1) if target.ndim == 2 else target
 
     L = len(target)
     index = range(L)
@@ -530,7 +533,7 @@ def split_data(data, target, pct=0.6):
         test_data = data[test_idx]
         
 # make sure training has samples from all classes
-        if len(np.unique(training_target)) == len(np.unique(target)):
+        if len(np.unique(labels[training_idx])) == len(np.unique(labels)):
             break
 
     return training_data, training_target, test_data, test_target
@@ -755,7 +758,8 @@ class datafitter(object):
                     feature = [k for k in sorted(self.kwds, key=lambda x:self.kwds.get(x), reverse=True)][0]
                     if feature in ['intervals', 'subbands']:
                         N = self.kwds[feature]
-                        ax.imshow(self.test_data[what[i]].reshape(N,N))
+                        shape = N if isinstance(N, tuple) else (N, N)
+                        ax.imshow(self.test_data[what[i]].reshape(shape))
                     else:
                         ax.plot(self.test_data[what[i]])
                 except IndexError:pass
@@ -791,7 +795,8 @@ class datafitter(object):
                     feature = [k for k in sorted(self.kwds, key=lambda x:self.kwds.get(x), reverse=True)][0]
                     if feature in ['intervals', 'subbands']:
                         N = self.kwds[feature]
-                        ax.imshow(self.test_data[sample_list[i]].reshape(N,N),
+                        shape = N if isinstance(N, tuple) else (N, N)
+                        ax.imshow(self.test_data[sample_list[i]].reshape(shape),
                                   cmap=plt.cmap.gray)
                     else:
                         ax.plot(self.test_data[sample_list[i]])